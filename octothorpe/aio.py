@@ -0,0 +1,192 @@
+# Copyright (c) 2013, 2014 Matt Behrens <matt@zigg.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+import logging
+
+try:
+    import asyncio
+except ImportError: # pragma: no cover
+    import trollius as asyncio
+
+from octothorpe.core import AMIParser, EVENT, resolveAction, serializeAction
+from octothorpe.core import IDGenerator
+from octothorpe.core import ProtocolError, UnknownActionException
+
+
+"""asyncio (or trollius) front-end for the AMI core"""
+
+
+log = logging.getLogger(__name__)
+
+
+class ConnectionLostException(Exception):
+    """Connection closed cleanly before a response was received"""
+
+
+class AsyncioAMIProtocol(asyncio.Protocol):
+    """Base AMI protocol support for asyncio event loops.
+
+    Mirrors BaseAMIProtocol, except that sendAction returns an asyncio
+    Future instead of a Deferred.
+
+    """
+    MAX_LENGTH = 16384
+    idGeneratorClass = IDGenerator
+
+
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.started = False
+        self.closing = False
+        self.parser = AMIParser()
+        self.pendingActions = {}
+        self.generateID = self.idGeneratorClass()
+
+
+    def data_received(self, data):
+        parser = self.parser
+        parser.feed(data)
+
+        while not self.started:
+            line = parser.nextLine()
+            if line is None:
+                break
+            try:
+                if not line.startswith('Asterisk Call Manager/'):
+                    raise ProtocolError('unknown banner: %r' % (line,))
+                self.bannerReceived(line)
+            except Exception, e:
+                self.protocolExceptionReceived(e)
+            if self.closing:
+                parser.clear()
+                return
+
+        while self.started:
+            try:
+                parsed = parser.nextMessage()
+                if parsed is None:
+                    break
+                kind, name, message, body = parsed
+                if kind is EVENT:
+                    self.eventReceived(name, message)
+                else:
+                    self.responseReceived(name, message, body)
+            except Exception, e:
+                self.protocolExceptionReceived(e)
+            if self.closing:
+                parser.clear()
+                return
+
+        if parser.buffered() > self.MAX_LENGTH:
+            parser.clear()
+            self.loseConnection()
+
+
+    noDropExceptions = [UnknownActionException]
+    def protocolExceptionReceived(self, exception):
+        if exception.__class__ in self.noDropExceptions:
+            log.info('ignoring exception %s (%r)', exception, exception)
+        else:
+            log.error('protocol exception %r', exception)
+            self.loseConnection()
+
+
+    def loseConnection(self):
+        """Close the transport and stop processing received data."""
+
+        self.closing = True
+        self.transport.close()
+
+
+    def connection_lost(self, exc):
+        """The connection was lost.
+
+        As with BaseAMIProtocol, everything waiting on the connection
+        fails straight away: each Future in pendingActions gets its
+        exception set to exc or, if the connection was closed cleanly,
+        a ConnectionLostException.
+
+        """
+        self.closing = True
+        if exc is None:
+            exc = ConnectionLostException('connection closed')
+        pending = self.pendingActions
+        while pending:
+            actionid, future = pending.popitem()
+            if not future.done():
+                future.set_exception(exc)
+
+
+    def eventReceived(self, event, message):
+        """An event was received.
+
+        The event message will be dispatched to an event handler method
+        (e.g. event_fullybooted), if it exists.
+
+        """
+        eventHandler = getattr(self, 'event_' + event, None)
+        if eventHandler:
+            eventHandler(message)
+
+
+    def responseReceived(self, response, message, body):
+        """A response was received.
+
+        The matching Future from pendingActions gets its result set to
+        a tuple (message, body), or its exception set to an
+        ActionException containing the message if an Error response.
+
+        """
+        future, success, result = resolveAction(self.pendingActions,
+                                                response, message, body)
+        if future.cancelled():
+            return
+        if success:
+            future.set_result(result)
+        else:
+            future.set_exception(result)
+
+
+    def bannerReceived(self, banner):
+        """A banner was received.
+
+        As with BaseAMIProtocol, the basic implementation just sets the
+        started attribute to True.
+
+        """
+        self.started = True
+
+
+    def sendAction(self, actionName, fields):
+        """Send an action.
+
+        Returns a Future that will be done when a response is received.
+
+        """
+        fields['action'] = actionName
+        if 'actionid' not in fields:
+            fields['actionid'] = self.generateID()
+        actionid = fields['actionid']
+
+        self.transport.write(serializeAction(fields))
+        future = self.pendingActions[actionid] = asyncio.Future(loop=self.loop)
+        return future
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
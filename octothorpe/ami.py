@@ -17,17 +17,55 @@ try:
     from hashlib import md5
 except ImportError: # pragma: no cover
     from md5 import md5
-from uuid import uuid1
 
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, succeed
+from twisted.python import log
+from twisted.python.failure import Failure
 
-from octothorpe.base import BaseAMIProtocol
+from octothorpe.base import BaseAMIProtocol, ProtocolError
+from octothorpe.base import UnknownActionException
+from octothorpe.base import eventHandlerNames, failPending
 from octothorpe.channel import Channel
+from octothorpe.index import ChannelCounter, ChannelIndex
+from octothorpe.index import callerIdNumKey, paramKey, stateKey, technologyKey
 
 
 """Higher-level Asterisk Manager Interface protocol"""
 
 
+# Routes from events to the Channels they are directed to.  Each route
+# is a sequence of alternatives; the first alternative whose keys are
+# all present in the message gives the names of the Channels.  Events
+# not listed here follow DEFAULT_ROUTE.
+#
+# Subclasses can extend this by setting their own routes attribute,
+# e.g. for Asterisk 12+ DialBegin events:
+#
+#     routes = dict(AMIProtocol.routes,
+#                   dialbegin=(('channel', 'destchannel'),))
+
+DEFAULT_ROUTE = (('channel',),)
+
+ROUTES = {
+    # Old-school (circa 1.4) rename events use the 'Oldname' key
+    # instead of 'Channel'.
+    'rename': (('oldname',), ('channel',)),
+
+    # Most messages with a 'Channel' key can be directed to the Channel
+    # named therein.  These cannot.
+    'channelreload': (),
+    'newchannel': (),
+
+    # Link events are distributed to Channels named by 'Channel1' and
+    # 'Channel2'.
+    'link': (('channel',), ('channel1', 'channel2')),
+    'unlink': (('channel',), ('channel1', 'channel2')),
+
+    # 1.4 Dial events are distributed to the Channel named in 'Source'.
+    'dial': (('channel',), ('source',)),
+}
+
+
 class OriginateException(Exception):
     def __init__(self, reason):
         self.reason = reason
@@ -41,21 +79,262 @@ class AMIProtocol(BaseAMIProtocol):
     """AMI protocol"""
 
     channelClass = Channel
+    routes = ROUTES
+
+    # If set, originations whose OriginateResponse doesn't arrive within
+    # originateTimeout seconds of being queued are erred back with an
+    # ActionTimeoutException.
+
+    originateTimeout = None
+
+    # Secondary channel indexes kept up to date as events arrive, as
+    # (name, key function, events, unique) tuples; see addIndex.
+
+    defaultIndexes = (
+        ('uniqueid', paramKey('uniqueid'), (), True),
+        ('linkedid', paramKey('linkedid'), (), False),
+        ('calleridnum', callerIdNumKey, ('newcallerid',), False),
+        ('state', stateKey, ('newstate',), False),
+    )
+
+    # Aggregate channel counters kept up to date as events arrive, as
+    # (name, key function, events) tuples; see addCounter.
+
+    defaultCounters = (
+        ('state', stateKey, ('newstate',)),
+        ('context', paramKey('context'), ('newexten',)),
+        ('technology', technologyKey, ('rename',)),
+    )
+
+    # If true, the channels already up when we log in are fetched with
+    # bootstrapAction (CoreShowChannels, or Status for Asterisk 1.4)
+    # right after logging in; see bootstrap.
+
+    bootstrapChannels = False
+    bootstrapAction = 'CoreShowChannels'
+
+    # If reconcileInterval is set, our channels are checked against a
+    # fresh bootstrapAction listing that often (in seconds) once we're
+    # logged in; see reconcile.  Each reactor iteration checks no more
+    # than reconcileSliceSize channels.
+
+    reconcileInterval = None
+    reconcileSliceSize = 500
+
+    # Channel callbacks decorated with octothorpe.executor.pooled run in
+    # callbackPool, an OrderedPool, if it is set; otherwise they run on
+    # the reactor thread as usual.  Pooled callbacks must not touch
+    # channel state (see pooled).
+
+    callbackPool = None
 
 
     def connectionMade(self):
         BaseAMIProtocol.connectionMade(self)
         self.channels = {}
         self.pendingOrigs = {}
+        self.synchronized = False
+        self._bootstrapID = None
+        self._bootstrapChannels = None
+        self._bootstrapEvents = None
+        self._bootstrapWaiters = None
+        self._adoptedChannels = None
+        self._reconciling = False
+        self._reconcileCall = None
+        self.reconcileStats = {
+            'runs': 0,
+            'vanished': 0,
+            'lastVanished': 0,
+            'lastMissing': 0,
+        }
+        self.indexes = {}
+        self.counters = {}
+        self._trackers = []
+        self._trackersByEvent = {}
+        for name, key, events, unique in self.defaultIndexes:
+            self.addIndex(name, key, events, unique)
+        for name, key, events in self.defaultCounters:
+            self.addCounter(name, key, events)
+
+
+    def connectionLost(self, reason):
+        self.stopReconciling()
+        BaseAMIProtocol.connectionLost(self, reason)
+        failPending(self.pendingOrigs, reason)
+
+
+    def addTracker(self, tracker):
+        """Start keeping an index or counter up to date.
+
+        tracker -- ChannelIndex or ChannelCounter; our channels are
+        added to it straight away
+
+        Trackers key their entries by channel object, so one tracker
+        may be shared by several protocols to index all of their
+        channels together (see octothorpe.federation).
+
+        """
+        self._trackers.append(tracker)
+        for event in tracker.events | set(['hangup']):
+            self._trackersByEvent.setdefault(event, []).append(tracker)
+        for channel in self.channels.itervalues():
+            tracker.add(channel)
+
+
+    def removeTracker(self, tracker):
+        """Stop keeping an index or counter up to date."""
+
+        self._trackers.remove(tracker)
+        for event, trackers in self._trackersByEvent.items():
+            if tracker in trackers:
+                trackers.remove(tracker)
+                if not trackers:
+                    del self._trackersByEvent[event]
+
+
+    def addIndex(self, name, key, events=(), unique=False):
+        """Add a secondary channel index.
+
+        name -- name to look the index up by in findChannels
+
+        key -- function returning a channel's key, or None to leave the
+        channel out of the index (see paramKey and variableKey in
+        octothorpe.index)
+
+        events -- names of the channel events after which a channel's
+        key may have changed, e.g. ['varset'] for a variable index;
+        channels are always indexed on Newchannel and dropped on Hangup
+
+        unique -- if True, each key maps to a single channel
+
+        Channels we already know are indexed straight away.  Returns the
+        new ChannelIndex.
+
+        """
+        if name in self.indexes:
+            self.removeIndex(name)
+        index = self.indexes[name] = ChannelIndex(key, events, unique)
+        self.addTracker(index)
+        return index
+
+
+    def removeIndex(self, name):
+        """Remove a secondary channel index."""
+
+        self.removeTracker(self.indexes.pop(name))
+
+
+    def findChannels(self, name, key):
+        """Look a key up in a secondary channel index.
+
+        Returns the matching Channel (or None) for a unique index, or a
+        set of matching Channels otherwise.
+
+        """
+        return self.indexes[name].get(key)
+
+
+    def channelByUniqueId(self, uniqueid):
+        """Return the Channel with a Uniqueid, or None."""
+
+        return self.indexes['uniqueid'].get(uniqueid)
+
+
+    def addCounter(self, name, key, events=()):
+        """Add an aggregate channel counter.
+
+        name -- name of the counter in counts, and as passed to
+        countChanged
+
+        key, events -- as for addIndex
+
+        Each event only adjusts the counts it affects, so reading them
+        is cheap no matter how many channels there are.  Returns the new
+        ChannelCounter.
+
+        """
+        if name in self.counters:
+            self.removeCounter(name)
+
+        def changed(key, count):
+            self.countChanged(name, key, count)
+
+        counter = self.counters[name] = ChannelCounter(key, events, changed)
+        self.addTracker(counter)
+        return counter
+
+
+    def removeCounter(self, name):
+        """Remove an aggregate channel counter."""
+
+        self.removeTracker(self.counters.pop(name))
+
+
+    def counts(self):
+        """Return a snapshot of our aggregate channel counts.
+
+        The snapshot is a dict mapping each counter's name to a dict of
+        per-key counts, plus 'total' giving the number of channels.
+
+        """
+        snapshot = dict([(name, counter.counts.copy())
+                         for name, counter in self.counters.iteritems()])
+        snapshot['total'] = len(self.channels)
+        return snapshot
+
+
+    def countChanged(self, name, key, count):
+        """Called when an aggregate channel count changes."""
+
+
+    def callbacksQueued(self):
+        """Return the number of pooled callbacks waiting or running.
+
+        The count covers everything in callbackPool, which may be shared
+        with other protocols; see OrderedPool.depth for one channel's.
+
+        """
+        if self.callbackPool is None:
+            return 0
+        return self.callbackPool.queued
+
+
+    def _retrackChannel(self, channel, trackers):
+        """Bring a channel's entries in indexes and counters up to date."""
+
+        if self.channels.get(channel.name) is channel:
+            for tracker in trackers:
+                tracker.add(channel)
+        else:
+            for tracker in trackers:
+                tracker.remove(channel)
 
 
     def _cbRespondToLoginChallenge(self, (fields, body), username, secret):
-        return self.sendAction('Login', {
+        loginFields = {
             'authtype': 'MD5',
             'username': username,
             'key': md5(fields['challenge'] + secret).hexdigest()
-        })
+        }
+        mask = self.eventMask()
+        if mask is not None:
+            loginFields['events'] = mask
+        d = self.sendAction('Login', loginFields)
+        if self.bootstrapChannels:
+            d.addCallback(self._cbBootstrapAfterLogin)
+        if self.reconcileInterval is not None:
+            d.addCallback(self._cbReconcileAfterLogin)
+        return d
+
 
+    def _cbReconcileAfterLogin(self, result):
+        self.startReconciling()
+        return result
+
+
+    def _cbBootstrapAfterLogin(self, result):
+        self.bootstrap().addErrback(log.err)
+        return result
 
 
     def eventReceived(self, event, message):
@@ -67,78 +346,395 @@ class AMIProtocol(BaseAMIProtocol):
         Channel event handlers are found, we fall back on
         BaseAMIProtocol behavior.
 
-        """
-	# Old-school (circa 1.4) rename events use the 'Oldname'
-        # key instead of 'Channel'.
-
-        if 'oldname' in message and event == 'rename':
-            names = [message['oldname']]
-
-        # Most messages with a 'Channel' key can be directed to the
-        # Channel named therein.  Some cannot.
+        Which Channels an event is directed to is looked up in our
+        routes attribute (see ROUTES).
 
-        elif 'channel' in message and event not in ['channelreload',
-                                                    'newchannel']:
+        While a bootstrap's channel listing is coming in, other events
+        are held back and received once it is complete.
 
-            # Most OriginateResponses can be directed to their Channel.
-            # 'Failure' responses cannot.
-
-            if (event == 'originateresponse' and
-                message['response'] == 'Failure'):
-                names = []
+        """
+        if (self._bootstrapID is not None and
+                self._bootstrapID in self.pendingLists):
+            self._bootstrapEvents.append((event, message))
+            return
 
+        names = ()
+        for headers in self.routes.get(event, DEFAULT_ROUTE):
+            for header in headers:
+                if header not in message:
+                    break
             else:
-                names = [message['channel']]
-
-        # Link events are distributed to Channels named by 'Channel1'
-        # and 'Channel2'.
-        
-        elif (event in ('link', 'unlink') and
-              'channel1' in message and 'channel2' in message):
-            names = [message['channel1'], message['channel2']]
+                names = [message[header] for header in headers]
+                break
 
-        # Dial events are distributed to the Channel named in 'Source'.
+        # Most OriginateResponses can be directed to their Channel.
+        # 'Failure' responses cannot.
 
-        elif 'source' in message and event == 'dial':
-            names = [message['source']]
+        if (event == 'originateresponse' and
+                message.get('response') == 'Failure'):
+            names = ()
 
-        else:
-            names = []
-
-        eventHandlers = []
+        targets = []
         for name in names:
             channel = self.channels.get(name)
-            if name is not None:
+            if channel is not None:
                 eventHandler = getattr(channel, 'event_' + event, None)
                 if eventHandler:
-                    eventHandlers.append(eventHandler)
-
-        if eventHandlers:
-            for eventHandler in eventHandlers:
-                eventHandler(message)
+                    targets.append((channel, eventHandler))
+
+        if targets:
+            # A handler may raise after changing its channel; indexes
+            # and counters must follow the change all the same.
+
+            try:
+                for channel, eventHandler in targets:
+                    try:
+                        eventHandler(message)
+                    except Exception, e:
+                        self.handlerExceptionReceived(e, event, eventHandler)
+            finally:
+                trackers = self._trackersByEvent.get(event)
+                if trackers:
+                    for channel, eventHandler in targets:
+                        self._retrackChannel(channel, trackers)
         else:
             BaseAMIProtocol.eventReceived(self, event, message)
             return
 
 
+    def handledEvents(self):
+        """Return the set of event names worth parsing.
+
+        As BaseAMIProtocol.handledEvents, but also includes the events
+        our channelClass has event_* handlers for.
+
+        """
+        if (self.__class__.eventReceived.im_func is not
+                AMIProtocol.eventReceived.im_func):
+            return None
+        return eventHandlerNames(self.__class__, self.channelClass)
+
+
     def loginMD5(self, username, secret):
-        """Log in using MD5 challenge-response"""
+        """Log in using MD5 challenge-response.
+
+        The Login action asks for just the event classes we need (see
+        eventMask).
+
+        """
 
         d = self.sendAction('Challenge', {'authtype': 'MD5'})
         d.addCallback(self._cbRespondToLoginChallenge, username, secret)
         return d
 
 
+    def bootstrap(self):
+        """Learn about the channels that are already up.
+
+        Sends our bootstrapAction and creates a channelClass object for
+        each channel listed in response, much as for Newchannel events.
+        Events that arrive while the listing is coming in are held back
+        until it is complete, then received in order, so they apply on
+        top of the listing.  Once the new channels are in our channels
+        dict, our newChannel method is called for each of them and our
+        channelsSynchronized method is called.
+
+        Returns a Deferred that fires with the number of channels
+        listed once done.  If a bootstrap is already in progress (e.g.
+        one started by bootstrapChannels), no other is started; the
+        Deferred fires with that one's result instead.
+
+        """
+        if self._bootstrapID is not None:
+            d = Deferred()
+            self._bootstrapWaiters.append(d)
+            return d
+        self.synchronized = False
+        self._bootstrapID = actionid = self.generateID()
+        self._bootstrapChannels = {}
+        self._bootstrapEvents = []
+        waiters = self._bootstrapWaiters = []
+        d = self.sendAction(self.bootstrapAction, {'actionid': actionid},
+                            eventList=self._bootstrapChannel)
+        d.addBoth(self._bootstrapComplete)
+        d.addBoth(self._notifyBootstrapWaiters, waiters)
+        return d
+
+
+    def adoptChannels(self, channels):
+        """Take over channels from an earlier connection.
+
+        channels -- dict of Channels by name, e.g. the channels dict of
+        a protocol whose connection was lost
+
+        The channels are moved over to us, then a bootstrap brings them
+        up to date: those no longer listed are evicted (see
+        channelVanished), those listed with a new state or caller ID
+        get the Newstate or NewCallerid they missed, and channels that
+        came up in the meantime are added as usual.
+
+        Returns the bootstrap's Deferred.
+
+        """
+        for name, channel in channels.iteritems():
+            channel.protocol = self
+            self.channels[name] = channel
+        for tracker in self._trackers:
+            for channel in channels.itervalues():
+                tracker.add(channel)
+        self._adoptedChannels = dict(channels)
+        return self.bootstrap()
+
+
+    def _refreshChannel(self, channel, listed):
+        """Bring an adopted channel up to date with its listing."""
+
+        if listed.state != channel.state:
+            channel.event_newstate({
+                'channelstate': str(listed.state),
+                'channelstatedesc': listed.params['channelstatedesc'],
+            })
+        number, name = listed.callerId
+        if number != channel.callerId[0]:
+            channel.event_newcallerid({
+                'calleridnum': number,
+                'calleridname': name or channel.callerId[1],
+            })
+        for tracker in self._trackers:
+            tracker.add(channel)
+
+
+    def _bootstrapChannel(self, event, message):
+        """Stage a channel from a bootstrap listing item."""
+
+        name = message['channel']
+        self._bootstrapChannels[name] = self.channelClass(self, name,
+                                                          message)
+
+
+    def _bootstrapComplete(self, result):
+        """Finish a bootstrap once its listing is complete."""
+
+        staged = self._bootstrapChannels
+        events = self._bootstrapEvents
+        adopted = self._adoptedChannels
+        self._bootstrapID = self._bootstrapChannels = None
+        self._bootstrapEvents = self._adoptedChannels = None
+        self._bootstrapWaiters = None
+        if isinstance(result, Failure):
+            return result
+
+        # Channels we already know about (from Newchannel events that
+        # beat the listing) are kept as they are.  Adopted channels are
+        # kept too, as long as the listing has the same Uniqueid for
+        # them, but updated from it.
+
+        added = []
+        listings = []
+        channels = self.channels
+        for name, channel in staged.iteritems():
+            known = channels.get(name)
+            if known is not None and adopted and adopted.get(name) is known:
+                if (known.params.get('uniqueid') ==
+                        channel.params.get('uniqueid')):
+                    self._refreshChannel(known, channel)
+                    listings.append((known, channel))
+                    continue
+                self._evictChannel(known)
+                known = None
+            if known is None:
+                channels[name] = channel
+                added.append((name, channel))
+                listings.append((channel, channel))
+        if adopted:
+            for name, channel in adopted.iteritems():
+                if name not in staged and channels.get(name) is channel:
+                    self._evictChannel(channel)
+
+        for tracker in self._trackers:
+            for name, channel in added:
+                tracker.add(channel)
+        for channel, listed in listings:
+            params = listed.params
+            bridged = params.get('bridgedchannel') or params.get('link')
+            channel.linkedTo = channels.get(bridged) if bridged else None
+        for name, channel in added:
+            self.newChannel(name, channel)
+
+        # A Newchannel that raced the listing for a channel the listing
+        # already has would only set the channel back to how it began.
+
+        for event, message in events:
+            if event == 'newchannel':
+                listed = staged.get(message.get('channel'))
+                if (listed is not None and
+                        listed.params.get('uniqueid') ==
+                        message.get('uniqueid')):
+                    continue
+            try:
+                self.eventReceived(event, message)
+            except Exception, e:
+                self.handlerExceptionReceived(e, event, self.eventReceived)
+
+        self.synchronized = True
+        self.channelsSynchronized()
+        return len(staged)
+
+
+    def _notifyBootstrapWaiters(self, result, waiters):
+        """Pass a bootstrap's result on to those who asked for it too."""
+
+        for d in waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        return result
+
+
+    def channelsSynchronized(self):
+        """Called when a bootstrap is complete."""
+
+
+    def startReconciling(self, interval=None):
+        """Reconcile our channels every interval seconds.
+
+        interval defaults to reconcileInterval.
+
+        """
+        self.stopReconciling()
+        if interval is None:
+            interval = self.reconcileInterval
+        self._reconcileCall = self.clock.callLater(
+            interval, self._periodicReconcile, interval)
+
+
+    def stopReconciling(self):
+        """Stop reconciling our channels periodically."""
+
+        if self._reconcileCall is not None:
+            if self._reconcileCall.active():
+                self._reconcileCall.cancel()
+            self._reconcileCall = None
+
+
+    def _periodicReconcile(self, interval):
+        self._reconcileCall = None
+        if self._reconciling:
+            d = succeed(None)
+        else:
+            d = self.reconcile()
+            d.addErrback(log.err)
+        d.addCallback(self._cbReschedule, interval)
+
+
+    def _cbReschedule(self, result, interval):
+        if self._reconcileCall is None and self.connected:
+            self._reconcileCall = self.clock.callLater(
+                interval, self._periodicReconcile, interval)
+
+
+    def reconcile(self):
+        """Check our channels against the server's.
+
+        Sends our bootstrapAction, and once its listing is complete,
+        evicts each channel we knew about beforehand that is no longer
+        listed (its Hangup must have been missed), calling our
+        channelVanished method for each.  Channels are matched by
+        Uniqueid where they have one, so renames don't matter.  The
+        check is done reconcileSliceSize channels at a time, one slice
+        per reactor iteration.
+
+        reconcileStats counts the runs and the channels evicted, both
+        in total and for the last run, along with how many listed
+        channels we did not know about when the last run started.
+
+        Returns a Deferred that fires with the list of evicted Channels.
+
+        """
+        if self._reconciling:
+            raise ProtocolError('reconciliation already in progress')
+        self._reconciling = True
+        known = self.channels.items()
+        listed = set()
+
+        def itemReceived(event, message):
+            listed.add(message.get('uniqueid') or message['channel'])
+
+        d = self.sendAction(self.bootstrapAction, {},
+                            eventList=itemReceived)
+        d.addCallback(self._cbReconcileListing, known, listed)
+        d.addBoth(self._reconcileDone)
+        return d
+
+
+    def _cbReconcileListing(self, result, known, listed):
+        d = Deferred()
+        self._reconcileSlice(known, 0, listed, [], 0, d)
+        return d
+
+
+    def _reconcileSlice(self, known, start, listed, vanished, found, d):
+        """Check one slice of the channels we knew about."""
+
+        channels = self.channels
+        end = start + self.reconcileSliceSize
+        for name, channel in known[start:end]:
+            if (channel.params.get('uniqueid') or name) in listed:
+                found += 1
+            elif channels.get(channel.name) is channel:
+                vanished.append(channel)
+                self._evictChannel(channel)
+
+        if end < len(known):
+            self.clock.callLater(0, self._reconcileSlice, known, end,
+                                 listed, vanished, found, d)
+            return
+
+        stats = self.reconcileStats
+        stats['runs'] += 1
+        stats['vanished'] += len(vanished)
+        stats['lastVanished'] = len(vanished)
+        stats['lastMissing'] = len(listed) - found
+        d.callback(vanished)
+
+
+    def _reconcileDone(self, result):
+        self._reconciling = False
+        return result
+
+
+    def _evictChannel(self, channel):
+        """Forget a channel that has gone without a Hangup."""
+
+        del self.channels[channel.name]
+        for tracker in self._trackers:
+            tracker.remove(channel)
+        self.channelVanished(channel.name, channel)
+
+
+    def channelVanished(self, name, channel):
+        """Called when reconciliation evicts a channel."""
+
+
     def event_newchannel(self, message):
         """Handle a Newchannel event.
 
         This method will create a new object of class specified by our
         channelClass attribute (default Channel) and call our
-        newChannel method with the channel name and object.
+        newChannel method with the channel name and object.  A channel
+        already known by the same name is replaced, and dropped from our
+        indexes and counters.
 
         """
         name = message['channel']
+        replaced = self.channels.get(name)
+        if replaced is not None:
+            for tracker in self._trackers:
+                tracker.remove(replaced)
         self.channels[name] = channel = self.channelClass(self, name, message)
+        for tracker in self._trackers:
+            tracker.add(channel)
         self.newChannel(name, channel)
 
 
@@ -164,6 +760,9 @@ class AMIProtocol(BaseAMIProtocol):
 
         """
         d = self.pendingOrigs[actionid] = Deferred()
+        if self.originateTimeout is not None:
+            self.expireAfter(self.originateTimeout, self.pendingOrigs,
+                             actionid, d, 'originate')
         return d
 
 
@@ -173,7 +772,11 @@ class AMIProtocol(BaseAMIProtocol):
         Calls back the Deferred originally returned by originateQueued.
         
         """
-        d = self.pendingOrigs.pop(message['actionid'])
+        actionid = message['actionid']
+        try:
+            d = self.pendingOrigs.pop(actionid)
+        except KeyError:
+            raise UnknownActionException('unknown actionid %r' % (actionid,))
         if message['response'] == 'Failure':
             d.errback(OriginateException(int(message['reason'])))
         else:
@@ -181,7 +784,7 @@ class AMIProtocol(BaseAMIProtocol):
 
 
     def _originate(self, channel, message, callerId=None):
-        actionid = str(uuid1())
+        actionid = self.generateID()
         message.update({
             'actionid': actionid,
             'channel': channel,
@@ -14,11 +14,11 @@
 
 
 from urllib import unquote
-from uuid import uuid1
 
 from twisted.internet.defer import Deferred
 
 from octothorpe.ami import AMIProtocol
+from octothorpe.base import failPending
 from octothorpe.channel import Channel
 
 
@@ -109,7 +109,7 @@ class AsyncAGIChannel(Channel):
         elif message['subevent'] == 'Exec':
             commandid = message['commandid']
             try:
-                d = self.pendingAGI[commandid]
+                d = self.pendingAGI.pop(commandid)
             except KeyError:
                 raise UnknownCommandException(commandid)
 
@@ -131,6 +131,10 @@ class AsyncAGIChannel(Channel):
 
         """
         d = self.pendingAGI[commandid] = Deferred()
+        timeout = self.protocol.agiTimeout
+        if timeout is not None:
+            self.protocol.expireAfter(timeout, self.pendingAGI, commandid, d,
+                                      'agi')
         return d
 
 
@@ -141,7 +145,7 @@ class AsyncAGIChannel(Channel):
         is received.
 
         """
-        commandid = str(uuid1())
+        commandid = self.protocol.generateID()
         d = self.sendAction('AGI', {
             'action': 'AGI',
             'command': command,
@@ -198,11 +202,25 @@ class AsyncAGIProtocol(AMIProtocol):
     channelClass = AsyncAGIChannel
     noDropExceptions = AMIProtocol.noDropExceptions + [UnknownCommandException]
 
+    # If set, AGI commands whose AsyncAGI Exec event doesn't arrive
+    # within agiTimeout seconds of being queued are erred back with an
+    # ActionTimeoutException.  originateTimeout covers the wait for the
+    # AsyncAGI Start event after an originateAsyncAGI, too.
+
+    agiTimeout = None
+
 
     def __init__(self, *args, **kwargs):
         self.pendingAsyncOrigs = {}
 
 
+    def connectionLost(self, reason):
+        AMIProtocol.connectionLost(self, reason)
+        failPending(self.pendingAsyncOrigs, reason)
+        for channel in self.channels.values():
+            failPending(channel.pendingAGI, reason)
+
+
     def _cbAsyncAGIOriginated(self, result, origId):
         """Called when the OriginateResponse event is received for an
         origination made by originateAsyncAGI.
@@ -211,6 +229,9 @@ class AsyncAGIProtocol(AMIProtocol):
 
         """
         d = self.pendingAsyncOrigs[origId] = Deferred()
+        if self.originateTimeout is not None:
+            self.expireAfter(self.originateTimeout, self.pendingAsyncOrigs,
+                             origId, d, 'asyncorig')
         return d
 
 
@@ -227,13 +248,13 @@ class AsyncAGIProtocol(AMIProtocol):
 
         This is implemented by requesting that a channel variable
         AsyncOrigId is set on the channel in the Originate action
-        with a UUID.  The origination callback then sets up another
-        Deferred that will fire when an AsyncAGI event is received
-        on a channel with the appropriate AsyncOrigId channel
-        variable set.
+        with an ID from generateID.  The origination callback then
+        sets up another Deferred that will fire when an AsyncAGI event
+        is received on a channel with the appropriate AsyncOrigId
+        channel variable set.
 
         """
-        origId = str(uuid1())
+        origId = self.generateID()
         d = self._originate(channel, {
             'application': 'AGI',
             'data': 'agi:async',
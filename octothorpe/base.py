@@ -13,84 +13,386 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 
-from uuid import uuid1
+from collections import deque
+from weakref import ref
 
-from twisted.internet.defer import Deferred
-from twisted.protocols.basic import LineOnlyReceiver
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.protocol import Protocol
+from twisted.internet.task import Cooperator
 from twisted.python import log
 
+from octothorpe.core import AMIParser, BODY, EVENT
+from octothorpe.core import resolveAction, serializeAction
+from octothorpe.core import IDGenerator, TimingWheel, endsEventList
+from octothorpe.core import eventFilter, eventMask
+from octothorpe.core import (ActionException, ActionTimeoutException,
+                             ProtocolError, UnknownActionException)
+
 
 """Asterisk Manager Interface support"""
 
 
-class ActionException(Exception):
-    """Error response to an action received"""
+def eventHandlerNames(*classes):
+    """Return the set of event names handled by classes.
+
+    That is, the lowercased names of all event_* methods on any of the
+    given classes.  It is computed afresh each time, so handlers added
+    to a class later count; protocols only ask for it once per
+    connection (see BaseAMIProtocol.refreshHandledEvents).
 
+    """
+    return frozenset([
+        attr[6:].lower()
+        for cls in classes
+        for attr in dir(cls)
+        if attr.startswith('event_')
+    ])
 
-class ProtocolError(Exception):
-    """Protocol error"""
 
+def failPending(table, reason):
+    """Err back, and remove, every Deferred in a table of them.
 
-class UnknownActionException(KeyError):
-    """Response to unknown action received"""
+    Entries are removed one at a time before being erred back, so any
+    that errbacks add are erred back too.
+
+    """
+    while table:
+        key, d = table.popitem()
+        d.errback(reason)
 
 
-class BaseAMIProtocol(LineOnlyReceiver):
+def _handlerName(handler):
+    """Return the name of a handler function.
+
+    Methods are named after their class, e.g. 'Channel.event_hangup'.
+
+    """
+    if handler is None:
+        return None
+    name = getattr(handler, '__name__', None)
+    if name is None:
+        return repr(handler)
+    obj = getattr(handler, 'im_self', None)
+    if obj is not None:
+        name = obj.__class__.__name__ + '.' + name
+    return name
+
+
+class BaseAMIProtocol(Protocol):
     """Base AMI protocol support.
 
     Supports banners, sending actions (and receiving responses), and
-    receiving events.
+    receiving events.  Framing, parsing and response matching are done
+    by octothorpe.core; this class glues them to Twisted.
 
     """
+    delimiter = '\r\n'
+    MAX_LENGTH = 16384
+    idGeneratorClass = IDGenerator
+
+    # If coalesceActions is True, actions sent during one reactor
+    # iteration are buffered and written together with a single
+    # writeSequence call at the start of the next.
+
+    coalesceActions = False
+
+    # If maxActionsInFlight is set, no more than that many actions are
+    # sent without a response; the rest wait in a local queue and are
+    # sent as responses arrive.
+
+    maxActionsInFlight = None
+
+    # Actions not responded to within actionTimeout seconds (if set)
+    # are erred back with an ActionTimeoutException.  Timeouts are
+    # checked every timeoutResolution seconds.  The time an action
+    # spends queued by maxActionsInFlight does not count: its timeout
+    # starts when it is sent.
+
+    actionTimeout = None
+    timeoutResolution = 1.0
+
+    # clock provides callLater; it defaults to the global reactor.
+
+    clock = None
+
+    # Exceptions raised by handlers (other than noDropExceptions) are
+    # logged and counted instead of dropping the
+    # connection, unless isolateHandlerErrors is False.  If errorBudget
+    # is set to (count, seconds), more than count of them within that
+    # many seconds drops the connection anyway.
+
+    isolateHandlerErrors = True
+    errorBudget = None
+
+    # If receiveEvents is False, we ask for no events at all (an Events
+    # mask of 'off') and skip any that arrive; the connection is then
+    # only good for actions.
+
+    receiveEvents = True
+
+    # If sliceBudget is set, received data is parsed and dispatched in
+    # slices of no more than sliceBudget seconds (at least one message
+    # each), giving the reactor a turn in between, so a large burst
+    # can't hold up timers, writes and other connections.  Data waiting
+    # to be dispatched stays in the parser; once more than
+    # highWaterMark bytes of it are waiting, the transport is paused
+    # until it gets down to lowWaterMark bytes.
+
+    sliceBudget = None
+    highWaterMark = 1048576
+    lowWaterMark = 65536
+
+
     def connectionMade(self):
-        LineOnlyReceiver.connectionMade(self)
+        Protocol.connectionMade(self)
+        if self.clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
         self.started = False
-        self.lines = []
+        self.parser = AMIParser()
         self.pendingActions = {}
+        self.pendingLists = {}
+        self._listModes = {}
+        self.parser.listIDs = self.pendingLists
+        self._bodyReceivers = {}
+        self.parser.bodyIDs = self._bodyReceivers
+        self.generateID = self.idGeneratorClass()
+        self._writeBuffer = []
+        self._flushCall = None
+        self._queuedActions = deque()
+        self._capacityWaiters = []
+        self._timeouts = TimingWheel(self.timeoutResolution)
+        self._reapCall = None
+        self.expiredCounts = {}
+        self.handlerErrorCounts = {}
+        self.eventErrorCounts = {}
+        if self.errorBudget is not None:
+            self._errorTimes = deque(maxlen=self.errorBudget[0] + 1)
+        self._drainTask = None
+        self._paused = False
+        self._wantedKnown = False
+        if self.sliceBudget is not None:
+            self._cooperator = Cooperator(self._sliceTimer,
+                                          self._scheduleSlice)
+
+
+    def connectionLost(self, reason):
+        """The connection was lost.
+
+        Everything still waiting on the connection (actions awaiting a
+        response or queued by maxActionsInFlight, EventLists, and
+        waitForCapacity callers) is erred back with reason straight
+        away.
 
+        """
+        if self._flushCall is not None:
+            self._flushCall.cancel()
+            self._flushCall = None
+        if self._reapCall is not None:
+            self._reapCall.cancel()
+            self._reapCall = None
+        if self.sliceBudget is not None:
+            self._cooperator.stop()
+            self._drainTask = None
+        del self._writeBuffer[:]
+        self._listModes.clear()
+        self._bodyReceivers.clear()
+        failPending(self.pendingActions, reason)
+        lists = self.pendingLists
+        while lists:
+            actionid, (d, itemReceived, items) = lists.popitem()
+            d.errback(reason)
+        queued = self._queuedActions
+        while queued:
+            queued.popleft()[2].errback(reason)
+        waiters = self._capacityWaiters
+        while waiters:
+            waiters.pop(0).errback(reason)
+        Protocol.connectionLost(self, reason)
+
+
+    def dataReceived(self, data):
+        """Feed received data to the parser and dispatch the results.
+
+        Until the protocol has started, each line is checked as a
+        banner.  After that, complete messages are dispatched to
+        eventReceived or responseReceived, except for the items of
+        EventLists we asked for, which go to listEventReceived.  If
+        sliceBudget is set, they are dispatched in slices instead (see
+        sliceBudget).
 
-    def lineReceived(self, line):
-        try:
-            if not self.started:
+        """
+        parser = self.parser
+        parser.feed(data)
+        if not self._wantedKnown:
+            self.refreshHandledEvents()
+
+        while not self.started:
+            line = parser.nextLine()
+            if line is None:
+                break
+            try:
                 if not line.startswith('Asterisk Call Manager/'):
                     raise ProtocolError('unknown banner: %r' % (line,))
                 self.bannerReceived(line)
-
+            except Exception, e:
+                self.protocolExceptionReceived(e)
+            if self.transport.disconnecting:
+                parser.clear()
+                return
+
+        if self.sliceBudget is not None:
+            if self.started and self._drainTask is None:
+                self._drainTask = self._cooperator.cooperate(self._drain())
+            if not self._paused and parser.buffered() > self.highWaterMark:
+                self._paused = True
+                self.transport.pauseProducing()
+            return
+
+        while self.started:
+            try:
+                parsed = parser.nextMessage()
+            except Exception, e:
+                self.protocolExceptionReceived(e)
+            else:
+                if parsed is None:
+                    break
+                self._dispatch(*parsed)
+            if self.transport.disconnecting:
+                parser.clear()
+                return
+
+        if parser.buffered() > self.MAX_LENGTH:
+            parser.clear()
+            self.lengthLimitExceeded()
+
+
+    def _drain(self):
+        """Dispatch buffered messages, one per iteration."""
+
+        parser = self.parser
+        while self.started:
+            try:
+                parsed = parser.nextMessage()
+            except Exception, e:
+                self.protocolExceptionReceived(e)
             else:
-                if line:
-                    self.lines.append(line)
-                    return
-
-                message = {}
-                body = None
-                for line in self.lines:
-                    if line.endswith('--END COMMAND--'):
-                        response = message.get('response')
-                        if response != 'Follows':
-                            raise ProtocolError('body in non-Follows response')
-                        body = line[:-15]
-                    else:
-                        # Normalize the key by lowercasing, and don't
-                        # require a space between the colon and value,
-                        # since some AMI fields don't supply it.
-                        key, value = line.split(':', 1)
-                        message[key.lower()] = value.lstrip()
-                self.lines = []
-
-                event = message.pop('event', None)
-                if event:
-                    self.eventReceived(event.lower(), message)
-                    return
-
-                response = message.pop('response', None)
-                if response:
-                    self.responseReceived(response, message, body)
-                    return
-
-                raise ProtocolError('bad message %r' % (message,))
+                if parsed is None:
+                    break
+                self._dispatch(*parsed)
+            if self.transport.disconnecting:
+                parser.clear()
+                break
+            if self._paused and parser.buffered() <= self.lowWaterMark:
+                self._paused = False
+                self.transport.resumeProducing()
+            yield None
+
+        self._drainTask = None
+        if self._paused:
+            self._paused = False
+            self.transport.resumeProducing()
+        if parser.buffered() > self.MAX_LENGTH:
+            parser.clear()
+            self.lengthLimitExceeded()
+
+
+    def _sliceTimer(self):
+        """Return a predicate telling when a slice's budget is spent."""
+
+        clock = self.clock
+        end = clock.seconds() + self.sliceBudget
+        return lambda: clock.seconds() >= end
+
+
+    def _scheduleSlice(self, step):
+        return self.clock.callLater(0, step)
+
 
+    def _dispatch(self, kind, name, message, body):
+        """Dispatch a parsed message, isolating handler exceptions.
+
+        ProtocolErrors raised matching a response to its action mean
+        we have lost track of the conversation, so they go to
+        protocolExceptionReceived; anything else raised goes to
+        handlerExceptionReceived.
+
+        """
+        handler = None
+        try:
+            if kind is EVENT:
+                lists = self.pendingLists
+                if lists and message.get('actionid') in lists:
+                    handler = self.listEventReceived
+                else:
+                    handler = self.eventReceived
+                handler(name, message)
+            elif kind is BODY:
+                handler = self._bodyReceivers.get(message['actionid'])
+                if handler is not None:
+                    handler(body)
+            else:
+                handler = self.responseReceived
+                handler(name, message, body)
+        except ProtocolError, e:
+            if kind is EVENT or kind is BODY:
+                self.handlerExceptionReceived(e, name, handler)
+            else:
+                self.protocolExceptionReceived(e)
         except Exception, e:
-            self.protocolExceptionReceived(e)
+            self.handlerExceptionReceived(e, name, handler)
+
+
+    def lengthLimitExceeded(self):
+        """Called when an unterminated banner or message is too long.
+
+        The default implementation drops the connection.
+
+        """
+        self.transport.loseConnection()
+
+
+    def handledEvents(self):
+        """Return the set of event names worth parsing.
+
+        Events not named in the set are discarded after reading only
+        their Event line.  The default set holds the events we have
+        event_* handlers for; if eventReceived is overridden, it is
+        None instead, meaning every event is parsed and dispatched.
+        Override this to return None if you want every event anyway.
+
+        """
+        if (self.__class__.eventReceived.im_func is not
+                BaseAMIProtocol.eventReceived.im_func):
+            return None
+        return eventHandlerNames(self.__class__)
+
+
+    def refreshHandledEvents(self):
+        """Recompute which events are worth parsing.
+
+        The set (see handledEvents) is worked out when the first data
+        arrives on a connection and kept.  Call this if you add event_*
+        handlers to the protocol or its class after that, so their
+        events are no longer skipped.
+
+        """
+        self.parser.wanted = self._wantedEvents()
+        self._wantedKnown = True
+
+
+    def _wantedEvents(self):
+        """Return handledEvents plus any handlers set on the instance."""
+
+        if not self.receiveEvents:
+            return frozenset()
+        wanted = self.handledEvents()
+        if wanted is not None:
+            extra = [key[6:] for key in self.__dict__
+                     if key.startswith('event_')]
+            if extra:
+                wanted = wanted.union(extra)
+        return wanted
 
 
     noDropExceptions = [UnknownActionException]
@@ -102,6 +404,50 @@ class BaseAMIProtocol(LineOnlyReceiver):
             self.transport.loseConnection()
 
 
+    def handlerExceptionReceived(self, exception, name, handler=None):
+        """An exception was raised while handling a message.
+
+        name -- the event name, or the response (e.g. 'Success'), or
+        None if no message was being handled (e.g. for an exception in
+        a pooled callback; see octothorpe.executor)
+
+        handler -- the handler the message was dispatched to, if known
+
+        noDropExceptions go to protocolExceptionReceived, as does
+        everything if isolateHandlerErrors is False.  Otherwise the
+        exception is logged and counted in handlerErrorCounts, keyed by
+        the handler (e.g. 'Channel.event_hangup'), and in
+        eventErrorCounts, keyed by name (unless name is None); the
+        connection is only dropped if errorBudget is exceeded.
+
+        """
+        if (not self.isolateHandlerErrors or
+                exception.__class__ in self.noDropExceptions):
+            self.protocolExceptionReceived(exception)
+            return
+
+        handler = _handlerName(handler)
+        counts = self.handlerErrorCounts
+        counts[handler] = counts.get(handler, 0) + 1
+        if name is None:
+            log.err(None, 'exception in %s' % (handler,))
+        else:
+            counts = self.eventErrorCounts
+            counts[name] = counts.get(name, 0) + 1
+            log.err(None, 'exception in %s handling %s' % (handler, name))
+
+        if self.errorBudget is not None:
+            limit, period = self.errorBudget
+            now = self.clock.seconds()
+            times = self._errorTimes
+            times.append(now)
+            while times[0] <= now - period:
+                times.popleft()
+            if len(times) > limit:
+                log.msg('handler error budget exceeded, dropping connection')
+                self.transport.loseConnection()
+
+
     def eventReceived(self, event, message):
         """An event was received.
 
@@ -111,7 +457,10 @@ class BaseAMIProtocol(LineOnlyReceiver):
         """
         eventHandler = getattr(self, 'event_' + event, None)
         if eventHandler:
-            eventHandler(message)
+            try:
+                eventHandler(message)
+            except Exception, e:
+                self.handlerExceptionReceived(e, event, eventHandler)
 
 
     def responseReceived(self, response, message, body):
@@ -122,22 +471,61 @@ class BaseAMIProtocol(LineOnlyReceiver):
         Success or Follows response, or erred back with an
         ActionException containing the message if an Error response.
 
+        If the action was sent in list mode, a Success response instead
+        starts collecting its EventList (see listEventReceived).  If it
+        was sent with a bodyReceived function, the end of its body is
+        passed to that first and the body in the result is None.
+
+        """
+        actionid = message.get('actionid')
+        bodyReceived = None
+        if self._bodyReceivers:
+            bodyReceived = self._bodyReceivers.pop(actionid, None)
+            if bodyReceived is not None and response == 'Follows':
+                if body:
+                    bodyReceived(body)
+                bodyReceived(None)
+                body = ''
+        d, success, result = resolveAction(self.pendingActions, response,
+                                           message, body)
+        if bodyReceived is not None and success:
+            result = (result[0], None)
+        if self._listModes:
+            itemReceived = self._listModes.pop(actionid, False)
+            if success and itemReceived is not False:
+                if itemReceived is None:
+                    self.pendingLists[actionid] = (d, None, [])
+                else:
+                    self.pendingLists[actionid] = (d, itemReceived, None)
+                self._releaseActions()
+                return
+        if success:
+            d.callback(result)
+        else:
+            d.errback(result)
+        self._releaseActions()
+
+
+    def listEventReceived(self, event, message):
+        """An item of an EventList we asked for was received.
+
+        Items are passed to the list's itemReceived function or, if it
+        has none, collected.  Once the event ending the list arrives,
+        the Deferred returned by sendAction is called back with a tuple
+        (items, message), where items is a list of (event, message)
+        tuples (or None, if they were passed to itemReceived) and
+        message is that of the final event.
+
         """
         actionid = message.pop('actionid')
-        try:
-            d = self.pendingActions.pop(actionid)
-        except KeyError:
-            raise UnknownActionException('unknown actionid %r' % (actionid,))
-        if response == 'Success':
-            d.callback((message, None))
-        elif response == 'Error':
-            d.errback(ActionException(message))
-        elif response == 'Follows':
-            if body is None:
-                raise ProtocolError('no body on Follows response')
-            d.callback((message, body))
+        d, itemReceived, items = self.pendingLists[actionid]
+        if endsEventList(event, message):
+            del self.pendingLists[actionid]
+            d.callback((items, message))
+        elif itemReceived is not None:
+            itemReceived(event, message)
         else:
-            raise ProtocolError('bad response %r' % (response,))
+            items.append((event, message))
 
 
     def bannerReceived(self, banner):
@@ -156,23 +544,226 @@ class BaseAMIProtocol(LineOnlyReceiver):
         self.started = True
 
 
-    def sendAction(self, actionName, fields):
+    def sendAction(self, actionName, fields, timeout=None, eventList=False,
+                   bodyReceived=None):
         """Send an action.
 
         Returns a Deferred that will fire when a Success response is
         received.
 
+        timeout -- seconds to wait for the response before erring back
+        with an ActionTimeoutException, counted from when the action is
+        sent (not queued); defaults to actionTimeout
+
+        eventList -- for actions answered with an EventList (e.g.
+        CoreShowChannels, QueueStatus), True to collect the list's
+        items, or a function to call with each item's event name and
+        message as it arrives; the Deferred then fires once the list
+        is complete (see listEventReceived).  Passing a function keeps
+        memory use flat however long the list is.
+
+        bodyReceived -- for actions answered with a Follows response
+        (e.g. Command), a function to call with each piece of the body
+        as it is received, then with None once it is complete, instead
+        of buffering the whole body (see BodyLines in octothorpe.core)
+
+        The action is serialized and written in one go, or buffered
+        until the next reactor iteration if coalesceActions is True.
+        If maxActionsInFlight actions are already awaiting responses,
+        it is queued until one arrives.
+
         """
         fields['action'] = actionName
         if 'actionid' not in fields:
-            fields['actionid'] = str(uuid1())
+            fields['actionid'] = self.generateID()
         actionid = fields['actionid']
+        if eventList is not False:
+            self._listModes[actionid] = (None if eventList is True
+                                         else eventList)
+        if bodyReceived is not None:
+            self._bodyReceivers[actionid] = bodyReceived
+
+        if timeout is None:
+            timeout = self.actionTimeout
+        action = (actionid, serializeAction(fields), Deferred(), timeout)
+        limit = self.maxActionsInFlight
+        if limit is not None and (self._queuedActions or
+                                  len(self.pendingActions) >= limit):
+            self._queuedActions.append(action)
+        else:
+            self._writeAction(*action)
+        return action[2]
+
+
+    def _writeAction(self, actionid, data, d, timeout):
+        """Write a serialized action and await its response with d."""
+
+        self.pendingActions[actionid] = d
+        if timeout is not None:
+            self.expireAfter(timeout, self.pendingActions, actionid, d,
+                             'action')
+        if self.coalesceActions:
+            self._writeBuffer.append(data)
+            if self._flushCall is None:
+                self._flushCall = self.clock.callLater(0, self.flushActions)
+        else:
+            self.transport.write(data)
+
+
+    def _hasCapacity(self):
+        """Return True if there is room in the in-flight window."""
+
+        limit = self.maxActionsInFlight
+        return limit is None or len(self.pendingActions) < limit
+
+
+    def _releaseActions(self):
+        """Fill the in-flight window.
+
+        Queued actions are sent first, then waitForCapacity callers are
+        woken, for as long as there is room.
+
+        """
+
+        queued = self._queuedActions
+        while queued and self._hasCapacity():
+            self._writeAction(*queued.popleft())
+        waiters = self._capacityWaiters
+        while waiters and not queued and self._hasCapacity():
+            waiters.pop(0).callback(None)
+
+
+    def expireAfter(self, timeout, table, key, d, kind):
+        """Expire an entry in a table of pending Deferreds.
+
+        timeout -- seconds until expiry
+
+        table, key -- where the pending Deferred d is kept
+
+        kind -- kind of entry, used to count expiries in expiredCounts
+        and in the ActionTimeoutException
+
+        If d is still in the table when the timeout passes, it is
+        removed and erred back with an ActionTimeoutException.  Only a
+        weak reference to d is kept meanwhile, so once it has fired and
+        been dropped, its result is not held on to until the timeout.
+
+        """
+        self._timeouts.add(self.clock.seconds() + timeout,
+                           (table, key, ref(d), kind))
+        if self._reapCall is None:
+            self._reapCall = self.clock.callLater(self.timeoutResolution,
+                                                  self._reap)
+
+
+    def _reap(self):
+        """Expire pending entries whose timeouts have passed."""
+
+        self._reapCall = None
+        counts = self.expiredCounts
+        for table, key, d, kind in self._timeouts.expire(self.clock.seconds()):
+            d = d()
+            if d is not None and table.get(key) is d:
+                del table[key]
+                if table is self.pendingActions:
+                    self._listModes.pop(key, None)
+                    self._bodyReceivers.pop(key, None)
+                counts[kind] = counts.get(kind, 0) + 1
+                d.errback(ActionTimeoutException(kind, key))
+        self._releaseActions()
+        if self._timeouts:
+            self._reapCall = self.clock.callLater(self.timeoutResolution,
+                                                  self._reap)
+
 
-        for field in fields:
-            self.sendLine(field.lower() + ': ' + fields[field])
-        self.sendLine('')
-        d = self.pendingActions[actionid] = Deferred()
+    def actionsInFlight(self):
+        """Return the number of actions sent and awaiting a response."""
+
+        return len(self.pendingActions)
+
+
+    def actionsQueued(self):
+        """Return the number of actions queued by maxActionsInFlight."""
+
+        return len(self._queuedActions)
+
+
+    def waitForCapacity(self):
+        """Wait for room in the in-flight window.
+
+        Returns a Deferred that will fire when an action could be sent
+        right away rather than being queued.
+
+        """
+        if not self._queuedActions and self._hasCapacity():
+            return succeed(None)
+        d = Deferred()
+        self._capacityWaiters.append(d)
         return d
 
 
+    def flushActions(self):
+        """Write any actions buffered by coalesceActions now."""
+
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        if self._writeBuffer:
+            self.transport.writeSequence(self._writeBuffer)
+            self._writeBuffer = []
+
+
+    def eventMask(self):
+        """Return the Events mask we want, or None to leave it alone.
+
+        The default is the smallest set of event classes covering the
+        events we handle (see handledEvents), or 'on' if that can't be
+        worked out.
+
+        """
+        return eventMask(self._wantedEvents())
+
+
+    def setEventMask(self, mask=None):
+        """Send an Events action setting the event mask.
+
+        mask -- Events mask (e.g. 'call,dtmf'); defaults to eventMask()
+
+        Returns a Deferred that will fire when a Success response is
+        received.
+
+        """
+        if mask is None:
+            mask = self.eventMask()
+        return self.sendAction('Events', {'eventmask': mask})
+
+
+    def addEventFilter(self, expression=None):
+        """Send a Filter action adding a whitelist filter.
+
+        expression -- filter regular expression; defaults to one
+        matching just the events we handle
+
+        Returns a Deferred that will fire when a Success response is
+        received, or immediately if there is no default filter to add.
+        Filter actions require Asterisk 11 or later.
+
+        """
+        if expression is None:
+            expression = eventFilter(self._wantedEvents() or ())
+            if expression is None:
+                return succeed(None)
+        return self.sendAction('Filter', {
+            'operation': 'Add',
+            'filter': expression,
+        })
+
+
+    def sendLine(self, line):
+        """Send a line followed by the delimiter."""
+
+        return self.transport.write(line + self.delimiter)
+
+
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
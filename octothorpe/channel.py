@@ -13,6 +13,8 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 
+from collections import MutableMapping
+
 from twisted.internet.defer import Deferred
 
 from octothorpe.base import ProtocolError
@@ -43,8 +45,216 @@ for state, desc in _states:
     globals()['STATE_' + constname] = state # Create STATE_XXX constants
 
 
-class Channel(object):
-    """Channel object"""
+class _Layout(object):
+    """Key layout shared by Params objects.
+
+    A layout maps each of its keys to an index into a Params object's
+    values.  Layouts are immutable; adding a key moves a Params object
+    to a child layout, which is cached so that every Params object
+    built up the same way shares it.
+
+    """
+    __slots__ = ('keys', 'index', '_children')
+
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.index = dict([(key, i) for i, key in enumerate(keys)])
+        self._children = {}
+
+
+    def child(self, key):
+        """Return the layout with key appended."""
+
+        try:
+            return self._children[key]
+        except KeyError:
+            layout = self._children[key] = _Layout(self.keys + (intern(key),))
+            return layout
+
+
+_emptyLayout = _Layout(())
+_missing = object()
+
+
+class Params(object):
+    """Compact dict-like store for channel parameters.
+
+    Keys (interned) live in a layout shared with other Params objects
+    holding the same keys; each Params object only keeps a list of
+    values.  The mapping methods are written out here rather than
+    inherited from MutableMapping, which has no __slots__ on Python 2
+    and would give every Params object an instance dict; Params is
+    registered as a MutableMapping all the same.
+
+    """
+    __slots__ = ('_layout', '_values')
+
+    __hash__ = None
+
+
+    def __init__(self, *args, **kwargs):
+        self._layout = _emptyLayout
+        self._values = []
+        self.update(*args, **kwargs)
+
+
+    def __getitem__(self, key):
+        return self._values[self._layout.index[key]]
+
+
+    def get(self, key, default=None):
+        i = self._layout.index.get(key)
+        if i is None:
+            return default
+        return self._values[i]
+
+
+    def __contains__(self, key):
+        return key in self._layout.index
+
+
+    has_key = __contains__
+
+
+    def __setitem__(self, key, value):
+        i = self._layout.index.get(key)
+        if i is None:
+            self._layout = self._layout.child(key)
+            self._values.append(value)
+        else:
+            self._values[i] = value
+
+
+    def __delitem__(self, key):
+        i = self._layout.index[key]
+        items = zip(self._layout.keys, self._values)
+        del items[i]
+        self.clear()
+        for key, value in items:
+            self[key] = value
+
+
+    def __iter__(self):
+        return iter(self._layout.keys)
+
+
+    def __len__(self):
+        return len(self._values)
+
+
+    def __eq__(self, other):
+        if isinstance(other, (Params, dict)):
+            return dict(self.iteritems()) == dict(other)
+        return NotImplemented
+
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+
+    iterkeys = __iter__
+
+
+    def itervalues(self):
+        return iter(self._values)
+
+
+    def iteritems(self):
+        return iter(zip(self._layout.keys, self._values))
+
+
+    def keys(self):
+        return list(self._layout.keys)
+
+
+    def values(self):
+        return list(self._values)
+
+
+    def items(self):
+        return zip(self._layout.keys, self._values)
+
+
+    def clear(self):
+        self._layout = _emptyLayout
+        self._values = []
+
+
+    def pop(self, key, default=_missing):
+        if key not in self._layout.index:
+            if default is _missing:
+                raise KeyError(key)
+            return default
+        value = self[key]
+        del self[key]
+        return value
+
+
+    def popitem(self):
+        if not self._values:
+            raise KeyError('popitem(): params are empty')
+        key = self._layout.keys[-1]
+        return key, self.pop(key)
+
+
+    def setdefault(self, key, default=None):
+        i = self._layout.index.get(key)
+        if i is None:
+            self[key] = default
+            return default
+        return self._values[i]
+
+
+    def update(self, *args, **kwargs):
+        if len(args) > 1:
+            raise TypeError('update expected at most 1 argument, got %d'
+                            % (len(args),))
+        if args:
+            other = args[0]
+            if hasattr(other, 'iteritems'):
+                other = other.iteritems()
+            elif hasattr(other, 'keys'):
+                other = [(key, other[key]) for key in other.keys()]
+            for key, value in other:
+                self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+
+MutableMapping.register(Params)
+
+
+class BaseChannel(object):
+    """Channel object, without an instance dict.
+
+    Subclasses that also declare __slots__ stay as compact as this;
+    Channel is the version that allows arbitrary attributes.  Unlike
+    Channel, BaseChannel keeps its params in a compact Params object
+    by default.
+
+    """
+    __slots__ = ('protocol', 'name', 'params', 'state', 'callerId',
+                 'variables', '_extensions', '_extensionsStart', 'linkedTo',
+                 'capturingDTMF')
+
+    # Class used to store params.  Params is compact; dict works too.
+
+    paramsClass = Params
+
+    # How many of the most recent Newexten entries to keep in our
+    # extension history (None for all of them, 0 for none).  Long-lived
+    # channels looping through the dialplan may want a bound.
+
+    extensionHistoryDepth = None
+
 
     def _synthesizeStateParams(self, desc):
         """Synthesize channelstate and channelstatedesc in our params."""
@@ -82,13 +292,13 @@ class Channel(object):
         """
         self.protocol = protocol
         self.name = name
-        self.params = {}
+        self.params = params = self.paramsClass()
 
         for key, value in newchannelMessage.iteritems():
             if key == 'channelstate':
-                self.params[key] = int(value)
+                params[key] = int(value)
             else:
-                self.params[key] = value
+                params[key] = value
 
         try:
             self.state = self.params['channelstate']
@@ -98,13 +308,14 @@ class Channel(object):
         self._setCallerId(newchannelMessage)
 
         self.variables = {}
-        self.extensions = []
+        self._extensions = []
+        self._extensionsStart = 0
         self.linkedTo = None
 
         self.capturingDTMF = False
 
 
-    def sendAction(self, actionName, fields):
+    def sendAction(self, actionName, fields, timeout=None):
         """Send an action on this channel.
 
         Returns a Deferred that will fire when a Success response
@@ -115,7 +326,7 @@ class Channel(object):
 
         """
         fields['channel'] = self.name
-        return self.protocol.sendAction(actionName, fields)
+        return self.protocol.sendAction(actionName, fields, timeout)
 
 
     def event_newstate(self, message):
@@ -160,7 +371,7 @@ class Channel(object):
         our variableSet method.
 
         """
-        variable = message['variable']
+        variable = intern(message['variable'])
         self.variables[variable] = value = message['value']
         self.variableSet(variable, value)
 
@@ -172,12 +383,12 @@ class Channel(object):
     def event_hangup(self, message):
         """Handle a hangup event.
 
-        Calls our hungUp method, then deletes the channel from the
-        protocol's channels dict.
+        Deletes the channel from the protocol's channels dict, then
+        calls our hungUp method.
 
         """
-        self.hungUp(int(message['cause']), message['cause-txt'])
         del self.protocol.channels[self.name]
+        self.hungUp(int(message['cause']), message['cause-txt'])
 
 
     def hungUp(self, cause, causeText):
@@ -205,21 +416,55 @@ class Channel(object):
         """Handle a newexten event.
 
         Records the context, extension, priority, application, and
-        application data in our extensions list and passes same to our
-        extensionEntered method.
+        application data in our extension history and passes same to our
+        extensionEntered method.  The context and exten params are
+        updated to where we are now.
 
         """
         data = (
-            message['context'],
+            intern(message['context']),
             message['extension'],
             int(message['priority']),
-            message['application'],
+            intern(message['application']),
             message['appdata']
         )
-        self.extensions.append(data)
+        self.params['context'], self.params['exten'] = data[:2]
+
+        # The history is a ring: once it holds extensionHistoryDepth
+        # entries, the oldest (at _extensionsStart) is overwritten.
+
+        depth = self.extensionHistoryDepth
+        history = self._extensions
+        if depth is None or len(history) < depth:
+            history.append(data)
+        elif history:
+            start = self._extensionsStart % len(history)
+            history[start] = data
+            self._extensionsStart = start + 1
+
         self.extensionEntered(*data)
 
 
+    def extensionHistory(self):
+        """Return our extension history as a list, oldest first.
+
+        Each entry is a tuple (context, extension, priority,
+        application, applicationData), as passed to extensionEntered.
+        Until a bounded history wraps around, this is the history list
+        itself rather than a copy, so don't change it.
+
+        """
+        history = self._extensions
+        start = self._extensionsStart % (len(history) or 1)
+        if not start:
+            return history
+        return history[start:] + history[:start]
+
+
+    extensions = property(extensionHistory,
+                          doc='Our extension history (see extensionHistory)')
+
+
     def extensionEntered(self, context, extension, priority, application,
                          applicationData):
         """Called when a new context/extension/priority is entered."""
@@ -399,4 +644,14 @@ class Channel(object):
         return d
 
 
+class Channel(BaseChannel):
+    """Channel object"""
+
+    # Channel's params stay a plain dict, as they always have been, so
+    # existing code can pass them to json.dumps and the like.  Set this
+    # to Params for the compact layout.
+
+    paramsClass = dict
+
+
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,164 @@
+# Copyright (c) 2013, 2014 Matt Behrens <matt@zigg.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+from twisted.application import internet
+from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.python import log
+
+from octothorpe.ami import AMIProtocol
+from octothorpe.base import BaseAMIProtocol
+
+
+"""Reconnecting Asterisk Manager Interface client"""
+
+
+class AMIClientMixin:
+    """Mixin for protocols built by an AMIClientFactory.
+
+    Mix it in ahead of AMIProtocol or one of its subclasses, e.g.:
+
+        class MyProtocol(AMIClientMixin, AsyncAGIProtocol):
+            ...
+
+    """
+    def bannerReceived(self, banner):
+        BaseAMIProtocol.bannerReceived(self, banner)
+        self.factory.protocolStarted(self)
+
+
+class AMIClientProtocol(AMIClientMixin, AMIProtocol):
+    """AMIProtocol for use with AMIClientFactory"""
+
+
+class AMIClientFactory(ReconnectingClientFactory):
+    """Factory keeping an AMI connection up.
+
+    username, secret -- credentials to log in with
+
+    Lost connections are retried with jittered exponential backoff (as
+    ReconnectingClientFactory does), and each new connection is logged
+    in.  Channels are carried over from one connection to the next:
+    the new protocol adopts them and brings them up to date against the
+    server (see AMIProtocol.adoptChannels), which is far less work than
+    starting over.  Everything else that was waiting on the lost
+    connection is erred back as soon as it goes.
+
+    Only a failed login drops the connection.  If syncing the channels
+    fails (say, the manager user may not list them), the failure is
+    logged and the protocol is ready all the same, with its
+    synchronized attribute left false.
+
+    """
+    protocol = AMIClientProtocol
+    maxDelay = 60
+
+    # If bootstrap is true, the channels already up on the first
+    # connection are fetched too (see AMIProtocol.bootstrap).
+
+    bootstrap = True
+
+
+    def __init__(self, username, secret):
+        self.username = username
+        self.secret = secret
+        self.currentProtocol = None
+        self._carriedChannels = {}
+
+
+    def buildProtocol(self, addr):
+        self.currentProtocol = ReconnectingClientFactory.buildProtocol(self,
+                                                                       addr)
+        return self.currentProtocol
+
+
+    def protocolStarted(self, protocol):
+        """Called by a protocol we built when its banner is received."""
+
+        d = protocol.loginMD5(self.username, self.secret)
+        d.addCallback(self._cbLoggedIn, protocol)
+        d.addErrback(self._ebConnect, protocol)
+
+
+    def _cbLoggedIn(self, result, protocol):
+        self.resetDelay()
+        carried, self._carriedChannels = self._carriedChannels, {}
+        if carried:
+            d = protocol.adoptChannels(carried)
+        elif self.bootstrap:
+            d = protocol.bootstrap()
+        else:
+            return self.protocolReady(protocol)
+        d.addCallbacks(lambda result: self.protocolReady(protocol),
+                       self._ebSync, errbackArgs=(protocol,))
+        return d
+
+
+    def _ebSync(self, failure, protocol):
+        log.err(failure, 'AMI channel sync failed')
+        if protocol.connected:
+            self.protocolReady(protocol)
+
+
+    def _ebConnect(self, failure, protocol):
+        log.err(failure, 'AMI connection setup failed')
+        if protocol.connected:
+            protocol.transport.loseConnection()
+
+
+    def protocolReady(self, protocol):
+        """Called when a protocol is logged in and its channels are synced.
+
+        Override this to start using the connection.
+
+        """
+
+
+    def clientConnectionLost(self, connector, reason):
+        protocol = self.currentProtocol
+        if protocol is not None:
+            self._carriedChannels.update(protocol.channels)
+            self.currentProtocol = None
+        ReconnectingClientFactory.clientConnectionLost(self, connector,
+                                                       reason)
+
+
+class AMIClientService(internet.TCPClient):
+    """Service keeping an AMI connection up.
+
+    host, port -- address of the manager interface
+
+    factory -- AMIClientFactory to connect with
+
+    Unlike a plain TCPClient, stopping the service stops the factory
+    from reconnecting.
+
+    """
+    def __init__(self, host, port, factory, *args, **kwargs):
+        internet.TCPClient.__init__(self, host, port, factory, *args,
+                                    **kwargs)
+        self.factory = factory
+
+
+    def startService(self):
+        self.factory.continueTrying = True
+        internet.TCPClient.startService(self)
+
+
+    def stopService(self):
+        self.factory.stopTrying()
+        return internet.TCPClient.stopService(self)
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,595 @@
+# Copyright (c) 2013, 2014 Matt Behrens <matt@zigg.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+from itertools import count
+from uuid import uuid4
+
+
+"""Transport-independent Asterisk Manager Interface core
+
+Nothing in here knows about Twisted or any other I/O framework: bytes
+are fed into an AMIParser and parsed messages are pulled back out,
+actions are serialized to strings, and responses are matched to
+whatever waiter object (Deferred, Future...) the caller registered.
+
+"""
+
+
+EVENT = 'event'
+RESPONSE = 'response'
+BODY = 'body'
+
+
+# AMI events by lowercased name, giving the properly-cased name (as
+# needed for Filter expressions) and the event class Asterisk sends the
+# event under (as used in Events masks).
+
+_eventClasses = {
+    'agi': [
+        'AsyncAGI', 'AGIExec',
+    ],
+    'agent': [
+        'AgentCalled', 'AgentComplete', 'AgentConnect', 'AgentDump',
+        'AgentRingNoAnswer', 'Agentlogin', 'Agentlogoff',
+        'QueueMemberAdded', 'QueueMemberPaused', 'QueueMemberRemoved',
+        'QueueMemberStatus',
+    ],
+    'call': [
+        'Bridge', 'ChanSpyStart', 'ChanSpyStop', 'Dial', 'Hangup',
+        'HangupRequest', 'Hold', 'Join', 'Leave', 'Link', 'LocalBridge',
+        'Masquerade', 'MusicOnHold', 'NewAccountCode', 'NewCallerid',
+        'NewConnectedLine', 'Newchannel', 'Newstate', 'OriginateResponse',
+        'ParkedCall', 'ParkedCallGiveUp', 'ParkedCallTimeOut', 'Pickup',
+        'Rename', 'SoftHangupRequest', 'Transfer', 'Unlink', 'UnParkedCall',
+    ],
+    'cdr': [
+        'Cdr',
+    ],
+    'cel': [
+        'CEL',
+    ],
+    'dialplan': [
+        'Newexten', 'VarSet',
+    ],
+    'dtmf': [
+        'DTMF',
+    ],
+    'log': [
+        'LogChannel',
+    ],
+    'reporting': [
+        'RTCPReceived', 'RTCPSent',
+    ],
+    'system': [
+        'ChannelReload', 'FullyBooted', 'PeerStatus', 'Registry', 'Reload',
+        'Shutdown',
+    ],
+    'user': [
+        'UserEvent',
+    ],
+}
+EVENTS = {}
+for eventClass, names in _eventClasses.iteritems():
+    for name in names:
+        EVENTS[name.lower()] = (name, eventClass)
+
+
+# Events that are only sent in response to an action (as items in its
+# EventList).  Asterisk sends them to the session that asked for them
+# whatever its Events mask and Filters say, so they need neither.
+
+RESPONSE_EVENTS = frozenset([
+    'coreshowchannel', 'coreshowchannelscomplete', 'status', 'statuscomplete',
+])
+
+
+def eventMask(events):
+    """Return the Events mask covering a set of event names.
+
+    events -- set of lowercased event names, or None for all events
+
+    Returns a comma-separated list of event classes, 'off' if there are
+    no events, or 'on' if any of the events' classes is unknown.
+
+    """
+    if events is None:
+        return 'on'
+    classes = set()
+    for event in events:
+        if event in RESPONSE_EVENTS:
+            continue
+        try:
+            classes.add(EVENTS[event][1])
+        except KeyError:
+            return 'on'
+    if not classes:
+        return 'off'
+    return ','.join(sorted(classes))
+
+
+def eventFilter(events):
+    """Return a Filter expression whitelisting a set of event names.
+
+    events -- set of lowercased event names
+
+    Returns None if there are no events, or if any of the events' proper
+    names is unknown.
+
+    """
+    try:
+        names = sorted([EVENTS[event][0] for event in events
+                        if event not in RESPONSE_EVENTS])
+    except KeyError:
+        return None
+    if not names:
+        return None
+    return 'Event: (%s)' % ('|'.join(names),)
+
+
+class ActionException(Exception):
+    """Error response to an action received"""
+
+
+class ActionTimeoutException(Exception):
+    """No response to an action (or other request) received in time"""
+
+    def __init__(self, kind, key):
+        self.kind = kind
+        self.key = key
+
+
+    def __repr__(self):
+        return '<%s kind=%r key=%r>' % (self.__class__.__name__, self.kind,
+                                       self.key)
+
+
+class ProtocolError(Exception):
+    """Protocol error"""
+
+
+class UnknownActionException(KeyError):
+    """Response to unknown action received"""
+
+
+def parseMessage(data):
+    """Parse a message.
+
+    data -- the message's lines, without the terminating blank line
+
+    Returns a tuple (kind, name, message, body), where kind is EVENT or
+    RESPONSE, name is the lowercased event name or the response, message
+    is the dict of remaining fields, and body is the body of a Follows
+    response (or None).
+
+    """
+    message = {}
+    body = None
+    if data:
+        for line in data.split('\r\n'):
+            if line.endswith('--END COMMAND--'):
+                response = message.get('response')
+                if response != 'Follows':
+                    raise ProtocolError('body in non-Follows response')
+                body = line[:-15]
+            else:
+                # Normalize the key by lowercasing, and don't require a
+                # space between the colon and value, since some AMI
+                # fields don't supply it.
+                key, value = line.split(':', 1)
+                message[key.lower()] = value.lstrip()
+
+    event = message.pop('event', None)
+    if event:
+        return EVENT, event.lower(), message, None
+
+    response = message.pop('response', None)
+    if response:
+        return RESPONSE, response, message, body
+
+    raise ProtocolError('bad message %r' % (message,))
+
+
+def serializeAction(fields):
+    """Serialize an action's fields into a single string."""
+
+    return ''.join([
+        key.lower() + ': ' + value + '\r\n'
+        for key, value in fields.iteritems()
+    ]) + '\r\n'
+
+
+def serializeMessage(kind, name, message, body=None):
+    """Serialize a parsed message back into a single string.
+
+    kind, name, message, body -- as returned by parseMessage
+
+    Event names get their proper case back where known.  Field names
+    stay lowercased (AMI treats them without regard to case), except
+    for ActionID, which is written first.
+
+    """
+    if kind is EVENT:
+        lines = ['Event: ' + EVENTS.get(name, (name,))[0]]
+    else:
+        lines = ['Response: ' + name]
+    actionid = message.get('actionid')
+    if actionid is not None:
+        lines.append('ActionID: ' + actionid)
+    lines.extend([key + ': ' + value
+                  for key, value in message.iteritems()
+                  if key != 'actionid'])
+    data = '\r\n'.join(lines) + '\r\n'
+    if body is not None:
+        data += body + '--END COMMAND--\r\n'
+    return data + '\r\n'
+
+
+def endsEventList(event, message):
+    """Return True if an event is the one ending an EventList."""
+
+    return (message.get('eventlist', '').lower() == 'complete' or
+            event.endswith('complete'))
+
+
+def resolveAction(pending, response, message, body):
+    """Match a response to a pending action.
+
+    pending -- dict of pending actions, keyed by ActionID
+
+    response, message, body -- as returned by parseMessage
+
+    The matching waiter is removed from pending and a tuple (waiter,
+    success, result) is returned.  If success is True, result is a
+    tuple (message, body) to call the waiter back with; otherwise it is
+    an ActionException to err it back with.
+
+    """
+    actionid = message.pop('actionid')
+    try:
+        waiter = pending.pop(actionid)
+    except KeyError:
+        raise UnknownActionException('unknown actionid %r' % (actionid,))
+    if response == 'Success':
+        return waiter, True, (message, None)
+    elif response == 'Error':
+        return waiter, False, ActionException(message)
+    elif response == 'Follows':
+        if body is None:
+            raise ProtocolError('no body on Follows response')
+        return waiter, True, (message, body)
+    else:
+        raise ProtocolError('bad response %r' % (response,))
+
+
+class IDGenerator(object):
+    """Generator of IDs unique to one connection.
+
+    Each call returns the next ID, made from a random per-generator
+    prefix and an increasing counter, so IDs never repeat across
+    connections (and a late response to an action sent on an earlier
+    connection can't be mistaken for one of ours).
+
+    """
+    def __init__(self, prefix=None):
+        if prefix is None:
+            prefix = uuid4().hex[:16]
+        self.prefix = prefix + '-'
+        self._counter = count(1)
+
+
+    def __call__(self):
+        return self.prefix + str(self._counter.next())
+
+
+class TimingWheel(object):
+    """Coarse-grained expiry tracker.
+
+    Entries are dropped into slots resolution seconds wide according to
+    their deadline; expire returns every entry whose slot has passed.
+    Adding and expiring are both cheap no matter how many entries there
+    are, at the cost of entries expiring up to resolution seconds late.
+
+    """
+    def __init__(self, resolution=1.0):
+        self.resolution = resolution
+        self._slots = {}
+        self._current = None
+        self._count = 0
+
+
+    def __len__(self):
+        return self._count
+
+
+    def add(self, deadline, entry):
+        """Add an entry to expire at deadline (in seconds)."""
+
+        slot = int(deadline / self.resolution)
+        if self._current is not None and slot < self._current:
+            slot = self._current
+        try:
+            self._slots[slot].append(entry)
+        except KeyError:
+            self._slots[slot] = [entry]
+        self._count += 1
+
+
+    def expire(self, now):
+        """Remove and return the entries whose deadlines have passed."""
+
+        last = int(now / self.resolution) - 1
+        if not self._slots:
+            self._current = last + 1
+            return []
+        if self._current is None:
+            self._current = min(self._slots)
+
+        expired = []
+        slots = self._slots
+        while self._current <= last and slots:
+            entries = slots.pop(self._current, None)
+            if entries:
+                expired.extend(entries)
+            self._current += 1
+        if not slots:
+            self._current = last + 1
+        self._count -= len(expired)
+        return expired
+
+
+class BodyLines(object):
+    """Receiver for a streamed Follows body that splits it into lines.
+
+    Pass one as sendAction's bodyReceived.  If lineReceived is given,
+    it is called with each line of the body as soon as the line is
+    complete, and nothing is kept.  Otherwise the chunks are kept as
+    they were received, and iterating over the BodyLines once the
+    action is done yields the lines, split as they are needed instead
+    of joining the whole body first.
+
+    """
+    def __init__(self, lineReceived=None):
+        self.lineReceived = lineReceived
+        self.chunks = []
+        self._partial = ''
+
+
+    def __call__(self, chunk):
+        if self.lineReceived is None:
+            if chunk:
+                self.chunks.append(chunk)
+        elif chunk is None:
+            if self._partial:
+                self.lineReceived(self._partial)
+                self._partial = ''
+        else:
+            lines = (self._partial + chunk).split('\n')
+            self._partial = lines.pop()
+            for line in lines:
+                self.lineReceived(line)
+
+
+    def __iter__(self):
+        partial = ''
+        for chunk in self.chunks:
+            start = 0
+            end = chunk.find('\n')
+            while end != -1:
+                yield partial + chunk[start:end]
+                partial = ''
+                start = end + 1
+                end = chunk.find('\n', start)
+            partial += chunk[start:]
+        if partial:
+            yield partial
+
+
+class AMIParser(object):
+    """Pull-style AMI parser.
+
+    Feed it received data with feed, then pull the banner out with
+    nextLine and messages out with nextMessage until they return None.
+
+    If wanted is set to a set of lowercased event names, events not
+    named in it are discarded after reading only their Event line; the
+    number discarded is kept in skipped.  If wanted is None, every
+    message is parsed.  Events whose ActionID is in listIDs (the items
+    of EventLists we are waiting on) are never discarded.
+
+    The bodies of Follows responses whose ActionID is in bodyIDs are
+    streamed rather than buffered whole; see nextMessage.
+
+    The text of the message most recently returned by nextMessage,
+    without its terminating blank line, is kept in raw.
+
+    """
+    wanted = None
+    listIDs = ()
+    bodyIDs = ()
+    raw = None
+
+
+    def __init__(self):
+        self._buffer = ''
+        self._pos = 0
+        self._body = None
+        self.skipped = 0
+
+
+    def feed(self, data):
+        """Add received data to the buffer."""
+
+        if self._pos:
+            self._buffer = self._buffer[self._pos:] + data
+            self._pos = 0
+        else:
+            self._buffer += data
+
+
+    def buffered(self):
+        """Return the length of buffered, not yet consumed data."""
+
+        return len(self._buffer) - self._pos
+
+
+    def clear(self):
+        """Discard all buffered data."""
+
+        self._buffer = ''
+        self._pos = 0
+        self._body = None
+
+
+    def nextLine(self):
+        """Consume and return the next line, or None if incomplete."""
+
+        start = self._pos
+        end = self._buffer.find('\r\n', start)
+        if end == -1:
+            return None
+        self._pos = end + 2
+        return self._buffer[start:end]
+
+
+    def nextMessage(self):
+        """Consume and parse the next message.
+
+        Returns a tuple as described for parseMessage, or None if no
+        complete message is buffered.  If the message cannot be parsed,
+        it is consumed anyway and a ProtocolError (or ValueError, for a
+        malformed line) is raised, so parsing can carry on afterward.
+
+        A streamed Follows body is returned piece by piece, as tuples
+        (BODY, 'Follows', message, chunk) with the response's fields in
+        message, as soon as it is received; the final piece comes in
+        the RESPONSE tuple that ends it.
+
+        """
+        if self._body is not None:
+            return self._nextBodyChunk()
+
+        data = self._buffer
+        wanted = self.wanted
+        while True:
+            start = self._pos
+            if (self.bodyIDs and
+                    data.startswith('Response: Follows\r\n', start)):
+                message, bodyStart = self._bodyHeaders(start)
+                if message is None:
+                    return None
+                if (bodyStart is not None and
+                        message.get('actionid') in self.bodyIDs):
+                    self._body = message
+                    self._pos = bodyStart
+                    return self._nextBodyChunk()
+
+            if data.startswith('\r\n', start):
+                end = start
+                self._pos = start + 2
+            else:
+                end = data.find('\r\n\r\n', start)
+                if end == -1:
+                    return None
+                self._pos = end + 4
+
+            if wanted is not None and data.startswith('Event:', start):
+                eol = data.find('\r\n', start, end)
+                if eol == -1:
+                    eol = end
+                if (data[start + 6:eol].strip().lower() not in wanted and
+                        not (self.listIDs and
+                             self._actionID(start, end) in self.listIDs)):
+                    self.skipped += 1
+                    continue
+
+            self.raw = raw = data[start:end]
+            return parseMessage(raw)
+
+
+    def _bodyHeaders(self, start):
+        """Parse the fields of a Follows response beginning at start.
+
+        Returns a tuple (message, bodyStart), where bodyStart is the
+        offset of the body, or None if there is no body.  If the fields
+        are not all buffered yet, message is None.
+
+        """
+        data = self._buffer
+        message = {}
+        pos = start
+        while True:
+            eol = data.find('\r\n', pos)
+            if eol == -1:
+                if data.find('\n', pos) == -1:
+                    return None, None
+                break
+            line = data[pos:eol]
+            if not line:
+                return message, None
+            if ('\n' in line or ':' not in line or
+                    line.endswith('--END COMMAND--')):
+                break
+            key, value = line.split(':', 1)
+            message[key.lower()] = value.lstrip()
+            pos = eol + 2
+        del message['response']
+        return message, pos
+
+
+    def _nextBodyChunk(self):
+        """Return the next piece of a streamed Follows body."""
+
+        data = self._buffer
+        start = self._pos
+        marker = data.find('--END COMMAND--', start)
+        if marker == -1:
+            # Hold back what could be the start of the marker.
+
+            end = len(data)
+            partial = data.find('-', max(start, end - 14))
+            while partial != -1:
+                if '--END COMMAND--'.startswith(data[partial:]):
+                    end = partial
+                    break
+                partial = data.find('-', partial + 1)
+        else:
+            end = data.find('\r\n\r\n', marker)
+            if end != -1:
+                message = self._body
+                self._body = None
+                self._pos = end + 4
+                return RESPONSE, 'Follows', message, data[start:marker]
+            end = marker
+        if end <= start:
+            return None
+        self._pos = end
+        return BODY, 'Follows', self._body, data[start:end]
+
+
+    def _actionID(self, start, end):
+        """Return the ActionID of the message between start and end."""
+
+        data = self._buffer
+        pos = data.find('\r\nActionID:', start, end)
+        if pos == -1:
+            return None
+        pos += 11
+        eol = data.find('\r\n', pos, end)
+        if eol == -1:
+            eol = end
+        return data[pos:eol].strip()
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
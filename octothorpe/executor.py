@@ -0,0 +1,144 @@
+# Copyright (c) 2013, 2014 Matt Behrens <matt@zigg.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+from collections import deque
+from functools import wraps
+
+from twisted.internet.defer import Deferred, maybeDeferred
+
+
+"""Running channel callbacks off the reactor thread, in order"""
+
+
+class OrderedPool(object):
+    """Runs functions in a thread pool, in order for each key.
+
+    threadpool -- pool to run functions in; defaults to the reactor's.
+    Anything with a callInThreadWithCallback method like ThreadPool's
+    will do (e.g. a front-end to a pool of processes).
+
+    reactor -- reactor to fire results on; defaults to the global one
+
+    Functions run with the same key run one at a time, in the order
+    they were given; functions with different keys may run at once.
+
+    """
+    def __init__(self, threadpool=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        if threadpool is None:
+            threadpool = reactor.getThreadPool()
+        self.threadpool = threadpool
+        self.reactor = reactor
+        self.queued = 0
+        self._queues = {}
+
+
+    def run(self, key, f, *args, **kwargs):
+        """Run f(*args, **kwargs) in the pool after earlier ones for key.
+
+        Returns a Deferred that fires with the result on the reactor
+        thread.
+
+        """
+        d = Deferred()
+        self.queued += 1
+        queue = self._queues.get(key)
+        if queue is None:
+            self._queues[key] = deque()
+            self._start(key, d, f, args, kwargs)
+        else:
+            queue.append((d, f, args, kwargs))
+        return d
+
+
+    def depth(self, key):
+        """Return the number of functions waiting or running for key."""
+
+        queue = self._queues.get(key)
+        if queue is None:
+            return 0
+        return len(queue) + 1
+
+
+    def _start(self, key, d, f, args, kwargs):
+        def onResult(success, result):
+            self.reactor.callFromThread(self._finished, key, d, success,
+                                        result)
+        self.threadpool.callInThreadWithCallback(onResult, f, *args,
+                                                 **kwargs)
+
+
+    def _finished(self, key, d, success, result):
+        self.queued -= 1
+        queue = self._queues[key]
+        if queue:
+            self._start(key, *queue.popleft())
+        else:
+            del self._queues[key]
+        if success:
+            d.callback(result)
+        else:
+            d.errback(result)
+
+
+def pooled(method):
+    """Decorate a Channel callback to run in its protocol's callbackPool.
+
+    Each channel's pooled callbacks run one at a time, in the order
+    they were called, while different channels' run at once.  The
+    decorated method returns a Deferred that fires with the result on
+    the reactor thread, so it is safe to send actions from callbacks
+    added to it (code running in the pool must use blockingCallFromThread
+    for that instead).  Exceptions go to the protocol's
+    handlerExceptionReceived, counted against the method but not
+    against any event, and the Deferred fires with None.
+
+    Code running in the pool must not read or change the channel's
+    state (its params, variables, state, extensions and so on): the
+    reactor thread goes on updating it meanwhile, and none of it is
+    safe to share between threads.  Pass in what the method needs as
+    arguments instead, e.g. dict(channel.params) taken by an
+    undecorated callback on the reactor thread.
+
+    If the protocol has no callbackPool, the method runs straight away.
+
+    Callbacks left undecorated still run on the reactor thread as soon
+    as they are called, so decorate all of those whose order matters.
+
+    """
+    name = method.__name__
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        protocol = self.protocol
+        pool = protocol.callbackPool
+        if pool is None:
+            d = maybeDeferred(method, self, *args, **kwargs)
+        else:
+            d = pool.run(self, method, self, *args, **kwargs)
+        d.addErrback(_ebPooled, protocol, getattr(self, name))
+        return d
+    return wrapper
+
+
+def _ebPooled(failure, protocol, handler):
+    try:
+        failure.raiseException()
+    except Exception, e:
+        protocol.handlerExceptionReceived(e, None, handler)
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
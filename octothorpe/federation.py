@@ -0,0 +1,326 @@
+# Copyright (c) 2013, 2014 Matt Behrens <matt@zigg.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+from twisted.application import service
+from twisted.internet.defer import fail
+
+from octothorpe.client import AMIClientFactory, AMIClientProtocol
+from octothorpe.client import AMIClientService
+from octothorpe.index import ChannelCounter, ChannelIndex
+from octothorpe.index import callerIdNumKey, paramKey, stateKey
+from octothorpe.index import technologyKey
+
+
+"""Many AMI servers behind one channel namespace"""
+
+
+def serverKey(channel):
+    """Key function giving the name of a channel's server."""
+
+    return channel.protocol.serverName
+
+
+def nameKey(channel):
+    """Key function giving a channel's name."""
+
+    return channel.name
+
+
+def qualifiedKey(key):
+    """Return a key function qualifying another's keys by server.
+
+    The keys are (server name, key) tuples.
+
+    """
+    def qualified(channel):
+        value = key(channel)
+        if value is None:
+            return None
+        return (channel.protocol.serverName, value)
+    return qualified
+
+
+class ServerUnavailableException(KeyError):
+    """No connection to the named server is ready"""
+
+
+class AMIFederationProtocol(AMIClientProtocol):
+    """AMIClientProtocol for one server of an AMIFederation.
+
+    Its own indexes and counters are cut down to the uniqueid index it
+    needs; the rest are kept once, across the federation.
+
+    """
+    defaultIndexes = (
+        ('uniqueid', paramKey('uniqueid'), (), True),
+    )
+    defaultCounters = ()
+
+    # Name of the server we are connected to; set by the factory.
+
+    serverName = None
+
+
+class AMIFederationFactory(AMIClientFactory):
+    """AMIClientFactory keeping up the connection to one server.
+
+    federation -- the AMIFederation
+
+    name -- name of the server
+
+    username, secret -- credentials to log in with
+
+    """
+    def __init__(self, federation, name, username, secret):
+        AMIClientFactory.__init__(self, username, secret)
+        self.federation = federation
+        self.name = name
+        self.protocol = federation.protocol
+        self.bootstrap = federation.bootstrap
+
+
+    def buildProtocol(self, addr):
+        protocol = AMIClientFactory.buildProtocol(self, addr)
+        protocol.serverName = self.name
+        return protocol
+
+
+    def protocolReady(self, protocol):
+        self.federation.serverReady(self.name, protocol)
+
+
+    def clientConnectionLost(self, connector, reason):
+        if self.currentProtocol is not None:
+            self.federation.serverLost(self.name, self.currentProtocol)
+        AMIClientFactory.clientConnectionLost(self, connector, reason)
+
+
+class AMIFederation(service.MultiService):
+    """Connections to many AMI servers, with one view of their channels.
+
+    Add servers with addServer; each gets its own reconnecting
+    connection, kept up while the federation is running.  Channels
+    are qualified by server name: the federation's indexes and
+    counters take in every connected server's channels, and their
+    keys are (server name, key) tuples where a key is only unique to
+    one server (e.g. ('pbx1', 'SIP/200-00000001') in the channel
+    index).  Channels keep acting on their own connection, so
+    Channel.sendAction goes to the right server, as does sendAction
+    given a server name.
+
+    A server's channels leave the indexes and counters while its
+    connection is down, and come back once it is resynced (see
+    AMIClientFactory).
+
+    """
+    protocol = AMIFederationProtocol
+    factoryClass = AMIFederationFactory
+
+    # If bootstrap is true, each server's channels already up are
+    # fetched when it first connects (see AMIClientFactory).
+
+    bootstrap = True
+
+    # Channel indexes and counters kept across all servers; see
+    # AMIProtocol.defaultIndexes and defaultCounters.
+
+    defaultIndexes = (
+        ('channel', qualifiedKey(nameKey), ('rename',), True),
+        ('uniqueid', qualifiedKey(paramKey('uniqueid')), (), True),
+        ('linkedid', qualifiedKey(paramKey('linkedid')), (), False),
+        ('calleridnum', callerIdNumKey, ('newcallerid',), False),
+        ('state', stateKey, ('newstate',), False),
+    )
+
+    defaultCounters = (
+        ('server', serverKey, ()),
+        ('state', stateKey, ('newstate',)),
+        ('context', paramKey('context'), ('newexten',)),
+        ('technology', technologyKey, ('rename',)),
+    )
+
+
+    def __init__(self):
+        service.MultiService.__init__(self)
+        self.factories = {}
+        self.protocols = {}
+        self.indexes = {}
+        self.counters = {}
+        for name, key, events, unique in self.defaultIndexes:
+            self.addIndex(name, key, events, unique)
+        for name, key, events in self.defaultCounters:
+            self.addCounter(name, key, events)
+
+
+    def addServer(self, name, host, port, username, secret):
+        """Add a server to the federation.
+
+        name -- name to qualify the server's channels with
+
+        host, port -- address of its manager interface
+
+        username, secret -- credentials to log in with
+
+        Returns the server's AMIFederationFactory.
+
+        """
+        factory = self.factories[name] = self.factoryClass(self, name,
+                                                           username, secret)
+        client = AMIClientService(host, port, factory)
+        client.setName(name)
+        client.setServiceParent(self)
+        return factory
+
+
+    def removeServer(self, name):
+        """Disconnect from a server and stop reconnecting to it.
+
+        Returns a Deferred (or None) as for MultiService.removeService.
+
+        """
+        del self.factories[name]
+        return self.removeService(self.getServiceNamed(name))
+
+
+    def serverReady(self, name, protocol):
+        """Called when a server's connection is logged in and synced.
+
+        Its channels join the federation's indexes and counters.
+
+        """
+        self.protocols[name] = protocol
+        for tracker in self._trackers():
+            protocol.addTracker(tracker)
+
+
+    def serverLost(self, name, protocol):
+        """Called when a server's connection is lost.
+
+        Its channels leave the federation's indexes and counters.
+
+        """
+        if self.protocols.get(name) is not protocol:
+            return
+        del self.protocols[name]
+        for tracker in self._trackers():
+            protocol.removeTracker(tracker)
+            for channel in protocol.channels.itervalues():
+                tracker.remove(channel)
+
+
+    def _trackers(self):
+        return self.indexes.values() + self.counters.values()
+
+
+    def sendAction(self, server, actionName, fields, *args, **kwargs):
+        """Send an action to a server.
+
+        server -- name of the server
+
+        The other arguments and the result are as for
+        BaseAMIProtocol.sendAction; if the server isn't connected, the
+        Deferred fails with ServerUnavailableException.
+
+        """
+        protocol = self.protocols.get(server)
+        if protocol is None:
+            return fail(ServerUnavailableException(server))
+        return protocol.sendAction(actionName, fields, *args, **kwargs)
+
+
+    def channel(self, server, name):
+        """Return the Channel with a name on a server, or None."""
+
+        return self.indexes['channel'].get((server, name))
+
+
+    def addIndex(self, name, key, events=(), unique=False):
+        """Add a channel index across all servers.
+
+        As AMIProtocol.addIndex; use qualifiedKey to qualify keys that
+        are only unique to one server.
+
+        """
+        if name in self.indexes:
+            self.removeIndex(name)
+        index = self.indexes[name] = ChannelIndex(key, events, unique)
+        self._addTracker(index)
+        return index
+
+
+    def removeIndex(self, name):
+        """Remove a channel index."""
+
+        self._removeTracker(self.indexes.pop(name))
+
+
+    def findChannels(self, name, key):
+        """Look a key up in a channel index, as AMIProtocol.findChannels."""
+
+        return self.indexes[name].get(key)
+
+
+    def addCounter(self, name, key, events=()):
+        """Add an aggregate channel counter across all servers.
+
+        As AMIProtocol.addCounter.
+
+        """
+        if name in self.counters:
+            self.removeCounter(name)
+
+        def changed(key, count):
+            self.countChanged(name, key, count)
+
+        counter = self.counters[name] = ChannelCounter(key, events, changed)
+        self._addTracker(counter)
+        return counter
+
+
+    def removeCounter(self, name):
+        """Remove an aggregate channel counter."""
+
+        self._removeTracker(self.counters.pop(name))
+
+
+    def _addTracker(self, tracker):
+        for protocol in self.protocols.itervalues():
+            protocol.addTracker(tracker)
+
+
+    def _removeTracker(self, tracker):
+        for protocol in self.protocols.itervalues():
+            protocol.removeTracker(tracker)
+
+
+    def counts(self):
+        """Return a snapshot of the aggregate channel counts.
+
+        As AMIProtocol.counts, over the channels of all connected
+        servers.
+
+        """
+        snapshot = dict([(name, counter.counts.copy())
+                         for name, counter in self.counters.iteritems()])
+        snapshot['total'] = sum([len(protocol.channels)
+                                 for protocol in self.protocols.itervalues()])
+        return snapshot
+
+
+    def countChanged(self, name, key, count):
+        """Called when an aggregate channel count changes."""
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
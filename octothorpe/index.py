@@ -0,0 +1,228 @@
+# Copyright (c) 2013, 2014 Matt Behrens <matt@zigg.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+"""Secondary indexes and aggregate counters over channels"""
+
+
+def paramKey(param):
+    """Return a key function giving a channel's value for a param."""
+
+    def key(channel):
+        return channel.params.get(param)
+    return key
+
+
+def variableKey(variable):
+    """Return a key function giving a channel's value for a variable.
+
+    Indexes using it should be re-keyed after VarSet events.
+
+    """
+    def key(channel):
+        return channel.variables.get(variable)
+    return key
+
+
+def stateKey(channel):
+    """Key function giving a channel's state."""
+
+    return channel.state
+
+
+def callerIdNumKey(channel):
+    """Key function giving a channel's caller ID number."""
+
+    return channel.callerId[0]
+
+
+def technologyKey(channel):
+    """Key function giving a channel's technology (e.g. SIP)."""
+
+    return channel.name.split('/', 1)[0]
+
+
+class ChannelIndex(object):
+    """Index of channels by a key computed from each channel.
+
+    key -- function returning a channel's key, or None if the channel
+    should not be indexed
+
+    events -- names of events after which a channel's key should be
+    recomputed
+
+    unique -- if True, each key maps to a single channel; otherwise,
+    each key maps to a set of channels
+
+    """
+    def __init__(self, key, events=(), unique=False):
+        self.key = key
+        self.events = frozenset(events)
+        self.unique = unique
+        self._index = {}
+        self._keys = {}
+
+
+    def __len__(self):
+        return len(self._keys)
+
+
+    def add(self, channel):
+        """Index a channel (or re-index it, if its key changed)."""
+
+        key = self.key(channel)
+        try:
+            oldKey = self._keys[channel]
+        except KeyError:
+            pass
+        else:
+            if oldKey == key:
+                return
+            self._discard(channel, oldKey)
+
+        if key is None:
+            return
+        self._keys[channel] = key
+        if self.unique:
+            self._index[key] = channel
+        else:
+            try:
+                self._index[key].add(channel)
+            except KeyError:
+                self._index[key] = set([channel])
+
+
+    def remove(self, channel):
+        """Remove a channel from the index, if it is there."""
+
+        try:
+            key = self._keys.pop(channel)
+        except KeyError:
+            return
+        self._discard(channel, key)
+
+
+    def _discard(self, channel, key):
+        """Remove channel from the entry for key."""
+
+        self._keys.pop(channel, None)
+        if self.unique:
+            if self._index.get(key) is channel:
+                del self._index[key]
+        else:
+            channels = self._index[key]
+            channels.discard(channel)
+            if not channels:
+                del self._index[key]
+
+
+    def get(self, key):
+        """Look up a key.
+
+        Returns the channel (or None) for a unique index, or a set of
+        channels (possibly empty) otherwise.
+
+        """
+        if self.unique:
+            return self._index.get(key)
+        return set(self._index.get(key, ()))
+
+
+    def keys(self):
+        """Return the keys in the index."""
+
+        return self._index.keys()
+
+
+    def count(self, key):
+        """Return the number of channels with a key."""
+
+        if self.unique:
+            return int(key in self._index)
+        return len(self._index.get(key, ()))
+
+
+class ChannelCounter(object):
+    """Count of channels by a key computed from each channel.
+
+    key, events -- as for ChannelIndex
+
+    changed -- if set, function called with (key, count) whenever the
+    count for a key changes
+
+    Counts are kept in the counts dict; keys whose count drops to zero
+    are removed from it.
+
+    """
+    def __init__(self, key, events=(), changed=None):
+        self.key = key
+        self.events = frozenset(events)
+        self.changed = changed
+        self.counts = {}
+        self._keys = {}
+
+
+    def __len__(self):
+        return len(self._keys)
+
+
+    def _adjust(self, key, delta):
+        """Adjust the count for key by delta."""
+
+        count = self.counts.get(key, 0) + delta
+        if count:
+            self.counts[key] = count
+        else:
+            del self.counts[key]
+        if self.changed is not None:
+            self.changed(key, count)
+
+
+    def add(self, channel):
+        """Count a channel (or recount it, if its key changed)."""
+
+        key = self.key(channel)
+        try:
+            oldKey = self._keys[channel]
+        except KeyError:
+            pass
+        else:
+            if oldKey == key:
+                return
+            del self._keys[channel]
+            self._adjust(oldKey, -1)
+
+        if key is None:
+            return
+        self._keys[channel] = key
+        self._adjust(key, 1)
+
+
+    def remove(self, channel):
+        """Stop counting a channel, if it is counted."""
+
+        try:
+            key = self._keys.pop(channel)
+        except KeyError:
+            return
+        self._adjust(key, -1)
+
+
+    def get(self, key):
+        """Return the number of channels with a key."""
+
+        return self.counts.get(key, 0)
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
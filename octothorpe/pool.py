@@ -0,0 +1,206 @@
+# Copyright (c) 2013, 2014 Matt Behrens <matt@zigg.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+from twisted.application import service
+from twisted.internet.defer import fail
+
+from octothorpe.client import AMIClientFactory, AMIClientProtocol
+from octothorpe.client import AMIClientService
+
+
+"""Pool of AMI connections sharing the action load"""
+
+
+class PoolUnavailableException(Exception):
+    """No connection in the pool is ready"""
+
+
+class AMIPoolFactory(AMIClientFactory):
+    """AMIClientFactory keeping up one connection of an AMIPool.
+
+    pool -- the AMIPool
+
+    events -- True for the connection events are received on
+
+    """
+    def __init__(self, pool, events):
+        AMIClientFactory.__init__(self, pool.username, pool.secret)
+        self.pool = pool
+        self.events = events
+        self.protocol = pool.protocol
+        self.bootstrap = events and pool.bootstrap
+
+
+    def buildProtocol(self, addr):
+        protocol = AMIClientFactory.buildProtocol(self, addr)
+        if not self.events:
+            protocol.receiveEvents = False
+            protocol.bootstrapChannels = False
+            protocol.reconcileInterval = None
+        return protocol
+
+
+    def protocolReady(self, protocol):
+        self.pool.protocolReady(protocol, self.events)
+
+
+    def clientConnectionLost(self, connector, reason):
+        if self.currentProtocol is not None:
+            self.pool.protocolLost(self.currentProtocol)
+        AMIClientFactory.clientConnectionLost(self, connector, reason)
+
+
+class AMIPool(object):
+    """Pool of logged-in AMI connections to one server.
+
+    username, secret -- credentials to log in with
+
+    size -- number of connections to keep up
+
+    Asterisk works through each manager session's actions one at a
+    time, so a single connection caps action throughput.  A pool keeps
+    several connections up (each with its own AMIPoolFactory, found in
+    factories) and sends each action on the ready connection with the
+    fewest actions in flight or queued.  Events are only received on
+    one of them, eventProtocol, which keeps the channels as usual; the
+    others log in asking for no events at all.
+
+    sendAction and originateCEP work as they do on AMIProtocol.
+
+    """
+    protocol = AMIClientProtocol
+    factoryClass = AMIPoolFactory
+
+    # If bootstrap is true, the events connection fetches the channels
+    # already up when it first connects (see AMIClientFactory).
+
+    bootstrap = True
+
+
+    def __init__(self, username, secret, size=4):
+        self.username = username
+        self.secret = secret
+        self.eventProtocol = None
+        self.protocols = []
+        self.factories = [self.factoryClass(self, index == 0)
+                          for index in range(size)]
+
+
+    def protocolReady(self, protocol, events):
+        """Called when one of our connections is logged in.
+
+        events -- True if it is the connection events are received on
+
+        """
+        if events:
+            self.eventProtocol = protocol
+        self.protocols.append(protocol)
+
+
+    def protocolLost(self, protocol):
+        """Called when one of our connections is lost."""
+
+        if protocol in self.protocols:
+            self.protocols.remove(protocol)
+        if protocol is self.eventProtocol:
+            self.eventProtocol = None
+
+
+    def pickProtocol(self):
+        """Return the ready connection with the fewest actions pending.
+
+        Raises PoolUnavailableException if no connection is ready.
+
+        """
+        if not self.protocols:
+            raise PoolUnavailableException()
+        return min(self.protocols, key=lambda protocol:
+                   protocol.actionsInFlight() + protocol.actionsQueued())
+
+
+    def sendAction(self, actionName, fields, *args, **kwargs):
+        """Send an action on the least busy connection.
+
+        Arguments and result are as for BaseAMIProtocol.sendAction; if
+        no connection is ready, the Deferred fails with
+        PoolUnavailableException.
+
+        """
+        try:
+            protocol = self.pickProtocol()
+        except PoolUnavailableException, e:
+            return fail(e)
+        return protocol.sendAction(actionName, fields, *args, **kwargs)
+
+
+    def _originate(self, channel, message, callerId=None):
+        # The OriginateResponse will only be received on eventProtocol,
+        # so the origination is made pending there before the action is
+        # sent, wherever it goes.
+
+        events = self.eventProtocol
+        if events is None:
+            return fail(PoolUnavailableException())
+        actionid = events.generateID()
+        message.update({
+            'actionid': actionid,
+            'channel': channel,
+            'async': 'true',
+        })
+
+        if callerId is not None:
+            message['callerid'] = callerId
+
+        queued = events.originateQueued((None, None), actionid)
+        d = self.sendAction('Originate', message)
+        d.addCallbacks(lambda result: queued, self._ebOriginate,
+                       errbackArgs=(events, actionid))
+        return d
+
+
+    def _ebOriginate(self, failure, events, actionid):
+        events.pendingOrigs.pop(actionid, None)
+        return failure
+
+
+    def originateCEP(self, channel, context, exten, priority):
+        """Originate a call to a channel/exten/priority.
+
+        As AMIProtocol.originateCEP.
+
+        """
+        return self._originate(channel, {
+            'context': context,
+            'exten': exten,
+            'priority': str(priority),
+        })
+
+
+class AMIPoolService(service.MultiService):
+    """Service keeping the connections of an AMIPool up.
+
+    host, port -- address of the manager interface
+
+    pool -- AMIPool to connect
+
+    """
+    def __init__(self, host, port, pool):
+        service.MultiService.__init__(self)
+        self.pool = pool
+        for factory in pool.factories:
+            AMIClientService(host, port, factory).setServiceParent(self)
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,447 @@
+# Copyright (c) 2013, 2014 Matt Behrens <matt@zigg.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+try:
+    from hashlib import md5
+except ImportError: # pragma: no cover
+    from md5 import md5
+import re
+from random import SystemRandom
+
+from twisted.application import internet, service
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import Protocol, ServerFactory
+
+from octothorpe.ami import AMIProtocol
+from octothorpe.client import AMIClientFactory, AMIClientMixin
+from octothorpe.client import AMIClientService
+from octothorpe.core import AMIParser, ActionException, EVENTS
+from octothorpe.core import RESPONSE, endsEventList, serializeMessage
+
+
+"""AMI proxy sharing one manager session among many clients"""
+
+
+# The ActionID line of a message, which is all we rewrite in events
+# routed back to a client.
+
+ACTIONID_LINE = re.compile(r'^ActionID:[^\r\n]*\r\n', re.I | re.M)
+
+
+class AMIProxyUpstream(AMIClientMixin, AMIProtocol):
+    """Upstream connection of an AMIProxy.
+
+    Every event is handed to the proxy to fan out, rather than being
+    dispatched to channels.
+
+    """
+    def bannerReceived(self, banner):
+        self.factory.proxy.banner = banner
+        AMIClientMixin.bannerReceived(self, banner)
+
+
+    def eventReceived(self, event, message):
+        self.factory.proxy.eventReceived(event, message, self.parser.raw)
+
+
+class AMIProxyClientFactory(AMIClientFactory):
+    """AMIClientFactory keeping the upstream connection of an AMIProxy up.
+
+    proxy -- the AMIProxy
+
+    username, secret -- credentials to log in with
+
+    """
+    protocol = AMIProxyUpstream
+    bootstrap = False
+
+
+    def __init__(self, proxy, username, secret):
+        AMIClientFactory.__init__(self, username, secret)
+        self.proxy = proxy
+
+
+    def protocolReady(self, protocol):
+        self.proxy.upstream = protocol
+
+
+    def clientConnectionLost(self, connector, reason):
+        if self.currentProtocol is not None:
+            self.proxy.upstreamLost(self.currentProtocol)
+        AMIClientFactory.clientConnectionLost(self, connector, reason)
+
+
+class AMIProxyServerProtocol(Protocol):
+    """Manager interface served to one client of an AMIProxy.
+
+    Login, Challenge, Logoff, Events and Filter actions are handled
+    here; every other action is forwarded upstream once the client has
+    logged in.  Events are sent to the client as its Events mask and
+    Filters allow, much as Asterisk would.
+
+    """
+    MAX_LENGTH = 16384
+
+
+    def connectionMade(self):
+        self.proxy = self.factory.proxy
+        self.parser = AMIParser()
+        self._lines = []
+        self.loggedIn = False
+        self.challenge = None
+        self.eventClasses = None
+        self.includes = []
+        self.excludes = []
+        self.transport.write(self.proxy.banner + '\r\n')
+
+
+    def connectionLost(self, reason):
+        self.proxy.clients.discard(self)
+
+
+    def dataReceived(self, data):
+        parser = self.parser
+        parser.feed(data)
+        while True:
+            line = parser.nextLine()
+            if line is None:
+                break
+            if line:
+                self._lines.append(line)
+            elif self._lines:
+                fields = {}
+                for line in self._lines:
+                    key, colon, value = line.partition(':')
+                    fields[key.strip().lower()] = value.strip()
+                self._lines = []
+                self.actionReceived(fields)
+            if self.transport.disconnecting:
+                parser.clear()
+                return
+
+        if parser.buffered() > self.MAX_LENGTH:
+            parser.clear()
+            self.transport.loseConnection()
+
+
+    def actionReceived(self, fields):
+        """An action was received from the client.
+
+        fields -- the action's fields, with lowercased names
+
+        """
+        actionid = fields.pop('actionid', None)
+        action = fields.get('action', '').lower()
+        handler = getattr(self, 'action_' + action, None)
+        if handler is not None:
+            handler(actionid, fields)
+        elif not self.loggedIn:
+            self.respond(actionid, 'Error', {'message': 'Permission denied'})
+        else:
+            self.proxy.forwardAction(self, actionid, fields)
+
+
+    def respond(self, actionid, response, message, body=None):
+        """Send a response to the client."""
+
+        if actionid is not None:
+            message['actionid'] = actionid
+        self.transport.write(serializeMessage(RESPONSE, response, message,
+                                              body))
+
+
+    def action_challenge(self, actionid, fields):
+        self.challenge = str(SystemRandom().randint(0, 2 ** 31 - 1))
+        self.respond(actionid, 'Success', {'challenge': self.challenge})
+
+
+    def action_login(self, actionid, fields):
+        if not self.proxy.checkLogin(fields, self.challenge):
+            self.respond(actionid, 'Error',
+                         {'message': 'Authentication failed'})
+            return
+        self.loggedIn = True
+        self.setEventMask(fields.get('events', 'on'))
+        self.proxy.clients.add(self)
+        self.respond(actionid, 'Success',
+                     {'message': 'Authentication accepted'})
+
+
+    def action_logoff(self, actionid, fields):
+        self.respond(actionid, 'Goodbye',
+                     {'message': 'Thanks for all the fish.'})
+        self.transport.loseConnection()
+
+
+    def action_events(self, actionid, fields):
+        if not self.loggedIn:
+            self.respond(actionid, 'Error', {'message': 'Permission denied'})
+            return
+        self.setEventMask(fields.get('eventmask', 'on'))
+        self.respond(actionid, 'Success', {
+            'events': 'Off' if self.eventClasses == frozenset() else 'On',
+        })
+
+
+    def action_filter(self, actionid, fields):
+        if not self.loggedIn:
+            self.respond(actionid, 'Error', {'message': 'Permission denied'})
+            return
+        expression = fields.get('filter', '')
+        filters = self.includes
+        if expression.startswith('!'):
+            expression = expression[1:]
+            filters = self.excludes
+        try:
+            filters.append(re.compile(expression, re.I | re.M))
+        except re.error:
+            self.respond(actionid, 'Error',
+                         {'message': 'Filter Not Added'})
+            return
+        self.respond(actionid, 'Success',
+                     {'message': 'Filter Added Successfully'})
+
+
+    def setEventMask(self, mask):
+        """Set the classes of events to send, from an Events mask.
+
+        mask -- 'on', 'off' or a comma-separated list of event classes
+
+        """
+        mask = mask.lower()
+        if mask in ('on', 'yes', 'true'):
+            self.eventClasses = None
+        elif mask in ('off', 'no', 'false'):
+            self.eventClasses = frozenset()
+        else:
+            self.eventClasses = frozenset([eventClass.strip()
+                                           for eventClass in mask.split(',')])
+
+
+    def wantsEvent(self, event):
+        """Return True if our Events mask lets an event through.
+
+        Events we don't know the class of only get through a mask of
+        'on'.
+
+        """
+        eventClasses = self.eventClasses
+        if eventClasses is None:
+            return True
+        try:
+            return EVENTS[event][1] in eventClasses
+        except KeyError:
+            return False
+
+
+    def filterAccepts(self, data):
+        """Return True if our Filters let a serialized event through."""
+
+        for expression in self.excludes:
+            if expression.search(data):
+                return False
+        if not self.includes:
+            return True
+        for expression in self.includes:
+            if expression.search(data):
+                return True
+        return False
+
+
+class AMIProxyServerFactory(ServerFactory):
+    """Factory for the client connections of an AMIProxy."""
+
+    protocol = AMIProxyServerProtocol
+
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+
+class AMIProxy(object):
+    """One upstream manager session shared by many local clients.
+
+    username, secret -- credentials to log in upstream with
+
+    users -- dict of usernames and secrets clients may log in with, or
+    None to let any client in
+
+    clientFactory keeps the upstream connection up, and serverFactory
+    serves clients.  Each action a client sends is forwarded upstream
+    under an ActionID of our own, and the response (and any EventList
+    items, or the OriginateResponse of an async Originate) is sent
+    back to that client under its own ActionID.  Each other event
+    received upstream is serialized once, at most, and the same string
+    is written to every client whose Events mask and Filters let it
+    through.
+
+    """
+    banner = 'Asterisk Call Manager/1.3'
+    clientFactoryClass = AMIProxyClientFactory
+    serverFactoryClass = AMIProxyServerFactory
+
+    # A client's async Originate is routed back to it until its
+    # OriginateResponse arrives, or for originateTimeout seconds.
+
+    originateTimeout = 300
+
+
+    def __init__(self, username, secret, users=None):
+        self.users = users
+        self.upstream = None
+        self.clients = set()
+        self.routes = {}
+        self.pendingOrigs = {}
+        self.clientFactory = self.clientFactoryClass(self, username, secret)
+        self.serverFactory = self.serverFactoryClass(self)
+
+
+    def checkLogin(self, fields, challenge):
+        """Return True if a client's Login action should be accepted.
+
+        fields -- the Login action's fields
+
+        challenge -- the challenge we sent the client, or None
+
+        """
+        if self.users is None:
+            return True
+        try:
+            secret = self.users[fields.get('username')]
+        except KeyError:
+            return False
+        if fields.get('authtype', '').lower() == 'md5':
+            return (challenge is not None and fields.get('key') ==
+                    md5(challenge + secret).hexdigest())
+        return fields.get('secret') == secret
+
+
+    def upstreamLost(self, protocol):
+        """Called when the upstream connection is lost."""
+
+        if protocol is self.upstream:
+            self.upstream = None
+        self.routes.clear()
+        self.pendingOrigs.clear()
+
+
+    def forwardAction(self, client, actionid, fields):
+        """Forward an action from a client upstream.
+
+        actionid -- the client's ActionID for it (or None)
+
+        """
+        upstream = self.upstream
+        if upstream is None:
+            client.respond(actionid, 'Error',
+                           {'message': 'Upstream not connected'})
+            return
+        ourID = fields['actionid'] = upstream.generateID()
+        self.routes[ourID] = (client, actionid)
+        action = fields.pop('action')
+        if (action.lower() == 'originate' and
+                fields.get('async', '').lower() in ('true', 'yes', '1')):
+            orig = self.pendingOrigs[ourID] = Deferred()
+            orig.addErrback(self._ebOriginateExpired, ourID)
+            upstream.expireAfter(self.originateTimeout, self.pendingOrigs,
+                                 ourID, orig, 'originate')
+        d = upstream.sendAction(action, fields)
+        d.addCallbacks(self._cbForwarded, self._ebForwarded,
+                       callbackArgs=(ourID,), errbackArgs=(ourID,))
+
+
+    def _cbForwarded(self, (message, body), ourID):
+        if (message.get('eventlist', '').lower() == 'start' or
+                ourID in self.pendingOrigs):
+            route = self.routes.get(ourID)
+        else:
+            route = self.routes.pop(ourID, None)
+        if route is not None:
+            client, actionid = route
+            response = 'Success' if body is None else 'Follows'
+            client.respond(actionid, response, message, body)
+
+
+    def _ebForwarded(self, failure, ourID):
+        self.pendingOrigs.pop(ourID, None)
+        route = self.routes.pop(ourID, None)
+        if route is not None:
+            client, actionid = route
+            if failure.check(ActionException):
+                message = failure.value.args[0]
+            else:
+                message = {'message': failure.getErrorMessage()}
+            client.respond(actionid, 'Error', message)
+
+
+    def _ebOriginateExpired(self, failure, ourID):
+        self.routes.pop(ourID, None)
+
+
+    def eventReceived(self, event, message, raw):
+        """Fan an event received upstream out to our clients.
+
+        raw -- the event as received, which is passed on unchanged but
+        for its ActionID
+
+        """
+
+        ourID = message.get('actionid')
+        if ourID is not None and ourID in self.routes:
+            orig = None
+            if event == 'originateresponse':
+                orig = self.pendingOrigs.pop(ourID, None)
+            if orig is not None or endsEventList(event, message):
+                client, actionid = self.routes.pop(ourID)
+            else:
+                client, actionid = self.routes[ourID]
+            if orig is not None:
+                orig.callback(None)
+            if actionid is None:
+                line = ''
+            else:
+                line = 'ActionID: ' + actionid + '\r\n'
+            client.transport.write(ACTIONID_LINE.sub(
+                lambda match: line, raw + '\r\n', 1) + '\r\n')
+            return
+
+        data = raw + '\r\n\r\n'
+        for client in self.clients:
+            if client.wantsEvent(event) and client.filterAccepts(data):
+                client.transport.write(data)
+
+
+class AMIProxyService(service.MultiService):
+    """Service running an AMIProxy.
+
+    host, port -- address of the upstream manager interface
+
+    proxy -- the AMIProxy
+
+    listenPort -- port to serve clients on
+
+    interface -- address to serve clients on; defaults to loopback
+
+    """
+    def __init__(self, host, port, proxy, listenPort, interface='127.0.0.1'):
+        service.MultiService.__init__(self)
+        self.proxy = proxy
+        AMIClientService(host, port,
+                         proxy.clientFactory).setServiceParent(self)
+        internet.TCPServer(listenPort, proxy.serverFactory,
+                           interface=interface).setServiceParent(self)
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
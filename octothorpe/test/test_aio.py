@@ -0,0 +1,126 @@
+# Copyright (c) 2013, 2014 Matt Behrens <matt@zigg.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+
+from mock import Mock
+from twisted.trial import unittest
+
+try:
+    from octothorpe.aio import AsyncioAMIProtocol, asyncio
+    from octothorpe.aio import ConnectionLostException
+except ImportError: # pragma: no cover
+    AsyncioAMIProtocol = None
+from octothorpe.core import ActionException
+from octothorpe.test.test_base import disassembleMessage
+
+
+"""Tests for octothorpe.aio"""
+
+
+class AsyncioAMIProtocolTestCase(unittest.TestCase):
+    """Test case for the asyncio AMI protocol"""
+
+    if AsyncioAMIProtocol is None: # pragma: no cover
+        skip = 'neither asyncio nor trollius is available'
+
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.protocol = AsyncioAMIProtocol(loop=self.loop)
+        self.transport = Mock()
+        self.protocol.connection_made(self.transport)
+
+
+    def tearDown(self):
+        self.loop.close()
+
+
+    def _sentMessage(self):
+        (data,), kwargs = self.transport.write.call_args
+        return disassembleMessage(data)
+
+
+    def test_eventReceived(self):
+        """Start and receive an event"""
+
+        self.protocol.event_foo = Mock()
+        self.protocol.data_received(
+            'Asterisk Call Manager/1.3\r\n'
+            'Event: Foo\r\n'
+            'Key: Value\r\n'
+            '\r\n'
+        )
+        self.assertTrue(self.protocol.started)
+        self.protocol.event_foo.assert_called_once_with({'key': 'Value'})
+
+
+    def test_badBanner(self):
+        """Connection is closed on a bad banner"""
+
+        self.protocol.data_received('220 i.aint.no.asterisk ESMTP Foo\r\n')
+        self.assertTrue(self.transport.close.called)
+        self.assertFalse(self.protocol.started)
+
+
+    def test_actionSuccess(self):
+        """Send an action and get a success response"""
+
+        self.protocol.started = True
+        future = self.protocol.sendAction('Bar', {'key': 'Value'})
+        fields = self._sentMessage()
+        self.assertEqual(fields['action'], 'Bar')
+        self.assertEqual(fields['key'], 'Value')
+
+        self.protocol.data_received(
+            'Response: Success\r\n'
+            'ActionID: ' + fields['actionid'] + '\r\n'
+            'Key2: Value2\r\n'
+            '\r\n'
+        )
+        self.assertEqual(future.result(), ({'key2': 'Value2'}, None))
+
+
+    def test_actionError(self):
+        """Send an action and get an error response"""
+
+        self.protocol.started = True
+        future = self.protocol.sendAction('Bar', {})
+        self.protocol.data_received(
+            'Response: Error\r\n'
+            'ActionID: ' + self._sentMessage()['actionid'] + '\r\n'
+            '\r\n'
+        )
+        self.assertIsInstance(future.exception(), ActionException)
+
+
+    def test_connectionLostFailsPending(self):
+        """Actions waiting on a lost connection fail"""
+
+        self.protocol.started = True
+        first = self.protocol.sendAction('Foo', {})
+        second = self.protocol.sendAction('Bar', {})
+        second.cancel()
+        self.protocol.connection_lost(None)
+        self.assertIsInstance(first.exception(), ConnectionLostException)
+        self.assertEqual(self.protocol.pendingActions, {})
+
+        self.protocol.connection_made(self.transport)
+        future = self.protocol.sendAction('Foo', {})
+        reason = IOError('connection reset')
+        self.protocol.connection_lost(reason)
+        self.assertIs(future.exception(), reason)
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
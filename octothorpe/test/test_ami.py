@@ -19,12 +19,15 @@ except ImportError: # pragma: no coverage
     from md5 import md5
 
 from mock import Mock
+from twisted.internet.task import Clock
 from twisted.trial import unittest
 from twisted.test import proto_helpers
 
 from octothorpe.ami import AMIProtocol, OriginateException
-from octothorpe.base import ActionException, ProtocolError
-from octothorpe.channel import Channel, STATE_DOWN
+from octothorpe.base import ActionException, ActionTimeoutException
+from octothorpe.base import ProtocolError
+from octothorpe.channel import BaseChannel, Channel, STATE_DOWN
+from octothorpe.index import variableKey
 from octothorpe.test.test_base import disassembleMessage
 
 
@@ -38,6 +41,7 @@ class AMIProtocolTestCase(unittest.TestCase):
         """Set up the protocol"""
 
         self.protocol = cls()
+        self.protocol.clock = self.clock = Clock()
         self.transport = proto_helpers.StringTransport()
         self.protocol.makeConnection(self.transport)
 
@@ -71,6 +75,7 @@ class AMIProtocolTestCase(unittest.TestCase):
         self.assertEqual(fields['authtype'], 'MD5')
         self.assertEqual(fields['username'], 'username')
         self.assertEqual(fields['key'], md5('foo' + 'secret').hexdigest())
+        self.assertEqual(fields['events'], 'call,dialplan,dtmf')
 
         return d, fields
 
@@ -99,6 +104,243 @@ class AMIProtocolTestCase(unittest.TestCase):
         return d
 
 
+    def test_bootstrapAfterLogin(self):
+        """Channels are bootstrapped after logging in, if asked"""
+
+        self.protocol.bootstrapChannels = True
+        d, fields = self._startAndLoginMD5()
+        self.transport.clear()
+        self.protocol.dataReceived(
+            'Response: Success\r\n'
+            'ActionID: ' + fields['actionid'] + '\r\n'
+            '\r\n'
+        )
+        fields = disassembleMessage(self.transport.value())
+        self.assertEqual(fields['action'], 'CoreShowChannels')
+        return d
+
+
+    def _startBootstrap(self):
+        """Helper to start a bootstrap and accept its action"""
+
+        self.protocol.started = True
+        self.protocol.newChannel = Mock()
+        self.protocol.channelsSynchronized = Mock()
+        d = self.protocol.bootstrap()
+        fields = disassembleMessage(self.transport.value())
+        self.assertEqual(fields['action'], 'CoreShowChannels')
+        return d, fields['actionid']
+
+
+    def test_bootstrap(self):
+        """Channels already up are bootstrapped"""
+
+        d, actionid = self._startBootstrap()
+        self.protocol.dataReceived(
+            'Response: Success\r\n'
+            'ActionID: ' + actionid + '\r\n'
+            'EventList: start\r\n'
+            'Message: Channels will follow\r\n'
+            '\r\n'
+            'Event: CoreShowChannel\r\n'
+            'ActionID: ' + actionid + '\r\n'
+            'Channel: Foo/202-0\r\n'
+            'UniqueID: 1.0\r\n'
+            'Context: default\r\n'
+            'Extension: 303\r\n'
+            'Priority: 1\r\n'
+            'ChannelState: 4\r\n'
+            'ChannelStateDesc: Ring\r\n'
+            'Application: Dial\r\n'
+            'ApplicationData: Bar/303\r\n'
+            'CallerIDnum: 202\r\n'
+            'BridgedChannel: Bar/303-0\r\n'
+            '\r\n'
+            'Event: Newstate\r\n'
+            'Channel: Foo/202-0\r\n'
+            'ChannelState: 6\r\n'
+            'ChannelStateDesc: Up\r\n'
+            '\r\n'
+            'Event: CoreShowChannel\r\n'
+            'ActionID: ' + actionid + '\r\n'
+            'Channel: Bar/303-0\r\n'
+            'UniqueID: 1.1\r\n'
+            'Context: default\r\n'
+            'Extension: \r\n'
+            'Priority: 1\r\n'
+            'ChannelState: 6\r\n'
+            'ChannelStateDesc: Up\r\n'
+            'Application: AppDial\r\n'
+            'ApplicationData: (Outgoing Line)\r\n'
+            'CallerIDnum: 303\r\n'
+            'BridgedChannel: Foo/202-0\r\n'
+            '\r\n'
+        )
+        self.assertEqual(self.protocol.channels, {})
+        self.protocol.dataReceived(
+            'Event: CoreShowChannelsComplete\r\n'
+            'ActionID: ' + actionid + '\r\n'
+            'EventList: Complete\r\n'
+            'ListItems: 2\r\n'
+            '\r\n'
+        )
+
+        foo = self.protocol.channels['Foo/202-0']
+        bar = self.protocol.channels['Bar/303-0']
+        self.assertEqual(foo.callerId, ('202', None))
+        self.assertEqual(foo.state, 6)
+        assert foo.linkedTo is bar
+        assert bar.linkedTo is foo
+        assert self.protocol.channelByUniqueId('1.1') is bar
+        self.assertEqual(self.protocol.counts()['state'], {6: 2})
+        self.assertEqual(self.protocol.newChannel.call_count, 2)
+        self.protocol.channelsSynchronized.assert_called_once_with()
+        self.assertTrue(self.protocol.synchronized)
+        d.addCallback(self.assertEqual, 2)
+        return d
+
+
+    def test_bootstrapNewchannelRace(self):
+        """A Newchannel racing the listing doesn't count a channel twice"""
+
+        d, actionid = self._startBootstrap()
+        self.protocol.dataReceived(
+            'Response: Success\r\n'
+            'ActionID: ' + actionid + '\r\n'
+            'EventList: start\r\n'
+            '\r\n'
+            'Event: CoreShowChannel\r\n'
+            'ActionID: ' + actionid + '\r\n'
+            'Channel: SIP/202-0\r\n'
+            'UniqueID: 1.0\r\n'
+            'ChannelState: 6\r\n'
+            'ChannelStateDesc: Up\r\n'
+            'CallerIDnum: 202\r\n'
+            '\r\n'
+            'Event: Newchannel\r\n'
+            'Channel: SIP/202-0\r\n'
+            'ChannelState: 0\r\n'
+            'ChannelStateDesc: Down\r\n'
+            'CallerIDNum: 202\r\n'
+            'Uniqueid: 1.0\r\n'
+            '\r\n'
+            'Event: CoreShowChannelsComplete\r\n'
+            'ActionID: ' + actionid + '\r\n'
+            'EventList: Complete\r\n'
+            '\r\n'
+        )
+        channel = self.protocol.channels['SIP/202-0']
+        self.assertEqual(channel.state, 6)
+        self.assertEqual(self.protocol.counts(), {
+            'total': 1,
+            'state': {6: 1},
+            'context': {},
+            'technology': {'SIP': 1},
+        })
+        self.assertEqual(self.protocol.newChannel.call_count, 1)
+
+        # A Newchannel reusing a known name replaces the old channel.
+
+        self._newChannelEvent('SIP/202-0', '1.1', '1.1', '202')
+        assert self.protocol.channelByUniqueId('1.0') is None
+        self.assertEqual(self.protocol.counts()['state'], {STATE_DOWN: 1})
+
+        self.protocol.dataReceived(
+            'Event: Hangup\r\n'
+            'Cause: 16\r\n'
+            'Cause-Txt: Normal Clearing\r\n'
+            'Channel: SIP/202-0\r\n'
+            '\r\n'
+        )
+        self.assertEqual(self.protocol.counts()['total'], 0)
+        self.assertEqual(self.protocol.counts()['state'], {})
+        for index in self.protocol.indexes.itervalues():
+            self.assertEqual(len(index), 0)
+        return d
+
+
+    def test_bootstrapError(self):
+        """A failed bootstrap is reported"""
+
+        d, actionid = self._startBootstrap()
+        self.protocol.dataReceived(
+            'Response: Error\r\n'
+            'ActionID: ' + actionid + '\r\n'
+            'Message: Permission denied\r\n'
+            '\r\n'
+        )
+        self.assertFalse(self.protocol.synchronized)
+        self.assertFailure(d, ActionException)
+        return d
+
+
+    def test_reconcile(self):
+        """Channels whose Hangup was missed are evicted"""
+
+        self.protocol.started = True
+        self.protocol.reconcileSliceSize = 1
+        self.protocol.channelVanished = Mock()
+        foo = self._newChannelEvent('Foo/202-0', '1.0', '1.0', '202')
+        bar = self._newChannelEvent('Bar/303-0', '1.1', '1.0', '303')
+        self.transport.clear()
+
+        d = self.protocol.reconcile()
+        self.assertRaises(ProtocolError, self.protocol.reconcile)
+        fields = disassembleMessage(self.transport.value())
+        self.assertEqual(fields['action'], 'CoreShowChannels')
+        actionid = fields['actionid']
+        self.protocol.dataReceived(
+            'Response: Success\r\n'
+            'ActionID: ' + actionid + '\r\n'
+            'EventList: start\r\n'
+            '\r\n'
+            'Event: CoreShowChannel\r\n'
+            'ActionID: ' + actionid + '\r\n'
+            'Channel: Bar/303-0\r\n'
+            'UniqueID: 1.1\r\n'
+            '\r\n'
+            'Event: CoreShowChannel\r\n'
+            'ActionID: ' + actionid + '\r\n'
+            'Channel: Baz/404-0\r\n'
+            'UniqueID: 1.2\r\n'
+            '\r\n'
+            'Event: CoreShowChannelsComplete\r\n'
+            'ActionID: ' + actionid + '\r\n'
+            'EventList: Complete\r\n'
+            'ListItems: 2\r\n'
+            '\r\n'
+        )
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(0)
+
+        self.assertEqual(self.protocol.channels, {'Bar/303-0': bar})
+        self.assertIsNone(self.protocol.channelByUniqueId('1.0'))
+        self.protocol.channelVanished.assert_called_once_with('Foo/202-0',
+                                                              foo)
+        self.assertEqual(self.protocol.reconcileStats, {
+            'runs': 1,
+            'vanished': 1,
+            'lastVanished': 1,
+            'lastMissing': 1,
+        })
+        d.addCallback(self.assertEqual, [foo])
+        return d
+
+
+    def test_reconcilePeriodically(self):
+        """Reconciliation can be repeated periodically"""
+
+        self.protocol.started = True
+        self.protocol.startReconciling(60)
+        self.clock.advance(59)
+        self.assertEqual(self.transport.value(), '')
+        self.clock.advance(1)
+        fields = disassembleMessage(self.transport.value())
+        self.assertEqual(fields['action'], 'CoreShowChannels')
+        self.protocol.stopReconciling()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
     def test_channelClass(self):
         """Use of channelClass to spawn a custom class"""
 
@@ -122,6 +364,32 @@ class AMIProtocolTestCase(unittest.TestCase):
         self.assertIn('Foo/201-0', self.protocol.channels)
 
 
+    def test_slottedChannelClass(self):
+        """Events are dispatched to slotted channels"""
+
+        class TestChannel(BaseChannel):
+            __slots__ = ()
+
+        class TestAMIProtocol(AMIProtocol):
+            channelClass = TestChannel
+
+        self._setUpProtocol(TestAMIProtocol)
+        self.protocol.started = True
+        self.protocol.dataReceived(
+            'Event: Newchannel\r\n'
+            'Channel: Foo/201-0\r\n'
+            'ChannelState: 0\r\n'
+            'ChannelStateDesc: Down\r\n'
+            '\r\n'
+            'Event: Newstate\r\n'
+            'Channel: Foo/201-0\r\n'
+            'ChannelState: 6\r\n'
+            'ChannelStateDesc: Up\r\n'
+            '\r\n'
+        )
+        self.assertEqual(self.protocol.channels['Foo/201-0'].state, 6)
+
+
     def test_newChannel(self):
         """New channel created"""
 
@@ -236,6 +504,28 @@ class AMIProtocolTestCase(unittest.TestCase):
         protoHandler.assert_called_once_with({'channel': 'Bar/303-0'})
 
 
+    def test_handledEvents(self):
+        """Events handled by the protocol or channelClass are parsed"""
+
+        handled = self.protocol.handledEvents()
+        self.assertIn('newchannel', handled)
+        self.assertIn('originateresponse', handled)
+        self.assertIn('newstate', handled)
+        self.assertNotIn('rtcpsent', handled)
+
+
+    def test_unhandledEventSkipped(self):
+        """Events nobody handles are skipped"""
+
+        channel = self._startAndSpawnChannel()
+        self.protocol.dataReceived(
+            'Event: RTCPSent\r\n'
+            'Channel: Foo/202-0\r\n'
+            '\r\n'
+        )
+        self.assertEqual(self.protocol.parser.skipped, 1)
+
+
     def test_newState(self):
         """Channel state changed"""
 
@@ -359,6 +649,25 @@ class AMIProtocolTestCase(unittest.TestCase):
         self.assertNotIn('Foo/202-0', self.protocol.channels)
 
 
+    def test_hungUpRaises(self):
+        """Channel is deleted even if hungUp raises"""
+
+        channel = self._startAndSpawnChannel()
+        channel.hungUp = Mock(side_effect=ValueError)
+        self.protocol.dataReceived(
+            'Event: Hangup\r\n'
+            'Cause: 16\r\n'
+            'Cause-Txt: Normal Clearing\r\n'
+            'Channel: Foo/202-0\r\n'
+            'Uniqueid: 1234567890.0\r\n'
+            '\r\n'
+        )
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertNotIn('Foo/202-0', self.protocol.channels)
+        self.assertIsNone(self.protocol.channelByUniqueId('1234567890.0'))
+        self.assertEqual(self.protocol.counts()['total'], 0)
+
+
     def test_renamed(self):
         """Channel was renamed"""
 
@@ -395,6 +704,168 @@ class AMIProtocolTestCase(unittest.TestCase):
         assert self.protocol.channels['Bar/303-0'] is channel
 
 
+    def _newChannelEvent(self, name, uniqueid, linkedid, number):
+        """Helper to deliver a Newchannel event"""
+
+        self.protocol.dataReceived(
+            'Event: Newchannel\r\n'
+            'CallerIDName: \r\n'
+            'CallerIDNum: ' + number + '\r\n'
+            'Channel: ' + name + '\r\n'
+            'ChannelState: 0\r\n'
+            'ChannelStateDesc: Down\r\n'
+            'Uniqueid: ' + uniqueid + '\r\n'
+            'Linkedid: ' + linkedid + '\r\n'
+            '\r\n'
+        )
+        return self.protocol.channels[name]
+
+
+    def test_indexes(self):
+        """Secondary indexes follow channel events"""
+
+        self.protocol.started = True
+        foo = self._newChannelEvent('Foo/202-0', '1.0', '1.0', '202')
+        bar = self._newChannelEvent('Bar/303-0', '1.1', '1.0', '303')
+
+        assert self.protocol.channelByUniqueId('1.0') is foo
+        assert self.protocol.channelByUniqueId('1.1') is bar
+        self.assertEqual(self.protocol.findChannels('linkedid', '1.0'),
+                         set([foo, bar]))
+        self.assertEqual(self.protocol.findChannels('calleridnum', '202'),
+                         set([foo]))
+        self.assertEqual(self.protocol.findChannels('state', STATE_DOWN),
+                         set([foo, bar]))
+
+        self.protocol.dataReceived(
+            'Event: Newstate\r\n'
+            'Channel: Bar/303-0\r\n'
+            'ChannelState: 6\r\n'
+            'ChannelStateDesc: Up\r\n'
+            '\r\n'
+            'Event: NewCallerid\r\n'
+            'CallerIDName: John Doe\r\n'
+            'CallerIDNum: 8885551212\r\n'
+            'Channel: Foo/202-0\r\n'
+            '\r\n'
+        )
+        self.assertEqual(self.protocol.findChannels('state', STATE_DOWN),
+                         set([foo]))
+        self.assertEqual(self.protocol.findChannels('state', 6), set([bar]))
+        self.assertEqual(self.protocol.findChannels('calleridnum', '202'),
+                         set())
+        self.assertEqual(
+            self.protocol.findChannels('calleridnum', '8885551212'),
+            set([foo]))
+
+        self.protocol.dataReceived(
+            'Event: Hangup\r\n'
+            'Cause: 16\r\n'
+            'Cause-Txt: Normal Clearing\r\n'
+            'Channel: Foo/202-0\r\n'
+            '\r\n'
+        )
+        self.assertIsNone(self.protocol.channelByUniqueId('1.0'))
+        self.assertEqual(self.protocol.findChannels('linkedid', '1.0'),
+                         set([bar]))
+        self.assertEqual(
+            self.protocol.findChannels('calleridnum', '8885551212'),
+            set())
+        for index in self.protocol.indexes.itervalues():
+            self.assertEqual(len(index), 1)
+
+
+    def test_indexesAfterHandlerError(self):
+        """Indexes and counts follow a change even if a callback raises"""
+
+        self.protocol.started = True
+        foo = self._newChannelEvent('Foo/202-0', '1.0', '1.0', '202')
+        foo.newState = Mock(side_effect=ValueError)
+        self.protocol.dataReceived(
+            'Event: Newstate\r\n'
+            'Channel: Foo/202-0\r\n'
+            'ChannelState: 6\r\n'
+            'ChannelStateDesc: Up\r\n'
+            '\r\n'
+        )
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(self.protocol.findChannels('state', STATE_DOWN),
+                         set())
+        self.assertEqual(self.protocol.findChannels('state', 6), set([foo]))
+        self.assertEqual(self.protocol.counts()['state'], {6: 1})
+
+
+    def test_customIndex(self):
+        """Custom indexes over variables can be added and removed"""
+
+        channel = self._startAndSpawnChannel()
+        index = self.protocol.addIndex('customer', variableKey('CUSTOMER'),
+                                       ['varset'])
+        self.assertEqual(len(index), 0)
+
+        channel.variables['CUSTOMER'] = '42'
+        index = self.protocol.addIndex('customer', variableKey('CUSTOMER'),
+                                       ['varset'])
+        self.assertEqual(self.protocol.findChannels('customer', '42'),
+                         set([channel]))
+
+        self.protocol.dataReceived(
+            'Event: VarSet\r\n'
+            'Channel: Foo/202-0\r\n'
+            'Variable: CUSTOMER\r\n'
+            'Value: 43\r\n'
+            '\r\n'
+        )
+        self.assertEqual(self.protocol.findChannels('customer', '42'), set())
+        self.assertEqual(self.protocol.findChannels('customer', '43'),
+                         set([channel]))
+
+        self.protocol.removeIndex('customer')
+        self.assertNotIn('customer', self.protocol.indexes)
+        self.assertNotIn('varset', self.protocol._trackersByEvent)
+
+
+    def test_counts(self):
+        """Aggregate counts follow channel events"""
+
+        self.protocol.started = True
+        self.protocol.countChanged = Mock()
+        self._newChannelEvent('SIP/202-0', '1.0', '1.0', '202')
+        self._newChannelEvent('SIP/303-0', '1.1', '1.0', '303')
+        self._newChannelEvent('IAX2/404-0', '1.2', '1.2', '404')
+        self.protocol.countChanged.assert_any_call('technology', 'SIP', 2)
+
+        self.protocol.dataReceived(
+            'Event: Newstate\r\n'
+            'Channel: SIP/303-0\r\n'
+            'ChannelState: 6\r\n'
+            'ChannelStateDesc: Up\r\n'
+            '\r\n'
+            'Event: Newexten\r\n'
+            'Channel: SIP/303-0\r\n'
+            'Context: default\r\n'
+            'Extension: 202\r\n'
+            'Priority: 1\r\n'
+            'Application: Dial\r\n'
+            'AppData: SIP/202\r\n'
+            '\r\n'
+            'Event: Hangup\r\n'
+            'Cause: 16\r\n'
+            'Cause-Txt: Normal Clearing\r\n'
+            'Channel: IAX2/404-0\r\n'
+            '\r\n'
+        )
+        self.assertEqual(self.protocol.counts(), {
+            'total': 2,
+            'state': {STATE_DOWN: 1, 6: 1},
+            'context': {'default': 1},
+            'technology': {'SIP': 2},
+        })
+        self.protocol.countChanged.assert_any_call('state', STATE_DOWN, 1)
+        self.protocol.countChanged.assert_any_call('context', 'default', 1)
+        self.protocol.countChanged.assert_any_call('technology', 'IAX2', 0)
+
+
     def test_extensionEntered(self):
         """Channel enters a new context/extension/priority"""
 
@@ -477,8 +948,10 @@ class AMIProtocolTestCase(unittest.TestCase):
             'CallerID2: 303\r\n'
             '\r\n'
         )
-        self.assertTrue(lose.called)
-        self.assertEqual(len(self.flushLoggedErrors(ProtocolError)), 1)
+        self.assertFalse(lose.called)
+        self.assertEqual(len(self.flushLoggedErrors(ProtocolError)), 2)
+        self.assertEqual(self.protocol.handlerErrorCounts,
+                         {'Channel.event_link': 2})
 
 
     def test_unlinked(self):
@@ -501,8 +974,8 @@ class AMIProtocolTestCase(unittest.TestCase):
             'CallerID2: 303\r\n'
             '\r\n'
         )
-        self.assertTrue(lose.called)
-        self.assertEqual(len(self.flushLoggedErrors(ProtocolError)), 1)
+        self.assertFalse(lose.called)
+        self.assertEqual(len(self.flushLoggedErrors(ProtocolError)), 2)
         self.protocol.dataReceived(
             'Event: Unlink\r\n'
             'Channel1: Foo/202-0\r\n'
@@ -527,8 +1000,8 @@ class AMIProtocolTestCase(unittest.TestCase):
             'CallerID2: 303\r\n'
             '\r\n'
         )
-        self.assertTrue(lose.called)
-        self.assertEqual(len(self.flushLoggedErrors(ProtocolError)), 1)
+        self.assertFalse(lose.called)
+        self.assertEqual(len(self.flushLoggedErrors(ProtocolError)), 2)
 
 
     def test_dialed(self):
@@ -547,7 +1020,7 @@ class AMIProtocolTestCase(unittest.TestCase):
             'Uniqueid: 1234567890.0\r\n'
             '\r\n'
         )
-        self.assertTrue(lose.called)
+        self.assertFalse(lose.called)
         self.assertEqual(len(self.flushLoggedErrors(ProtocolError)), 1)
 
         self.protocol.dataReceived(
@@ -595,6 +1068,36 @@ class AMIProtocolTestCase(unittest.TestCase):
         channel.dialBegun.assert_called_once_with('Bar/303-0', None)
 
 
+    def test_customRoute(self):
+        """Subclasses can add routes for other events"""
+
+        class TestChannel(Channel):
+            event_dialbegin = Mock()
+
+        class TestAMIProtocol(AMIProtocol):
+            channelClass = TestChannel
+            routes = dict(AMIProtocol.routes,
+                          dialbegin=(('channel', 'destchannel'),))
+
+        self._setUpProtocol(TestAMIProtocol)
+        self.protocol.started = True
+        for name in ('Foo/202-0', 'Bar/303-0'):
+            self.protocol.dataReceived(
+                'Event: Newchannel\r\n'
+                'Channel: ' + name + '\r\n'
+                'ChannelState: 0\r\n'
+                'ChannelStateDesc: Down\r\n'
+                '\r\n'
+            )
+        self.protocol.dataReceived(
+            'Event: DialBegin\r\n'
+            'Channel: Foo/202-0\r\n'
+            'DestChannel: Bar/303-0\r\n'
+            '\r\n'
+        )
+        self.assertEqual(len(TestChannel.event_dialbegin.mock_calls), 2)
+
+
     def test_channelReloadDistribution(self):
         """ChannelReload event called on AMIProtocol"""
 
@@ -678,6 +1181,34 @@ class AMIProtocolTestCase(unittest.TestCase):
         self.assertEqual(len(cbSuccess.mock_calls), 1)
 
 
+    def test_originateTimeout(self):
+        """Originate without an OriginateResponse times out"""
+
+        self._startAndSpawnChannel()
+        self.protocol.originateTimeout = 30
+        lose = self.transport.loseConnection = Mock()
+        d = self.protocol.originateCEP('Foo/202', 'context', 'exten', 1)
+        actionid = disassembleMessage(self.transport.value())['actionid']
+        self.protocol.dataReceived(
+            'Response: Success\r\n'
+            'ActionID: ' + actionid + '\r\n'
+            '\r\n'
+        )
+        self.assertFailure(d, ActionTimeoutException)
+        self.clock.advance(31)
+        self.assertEqual(self.protocol.pendingOrigs, {})
+        self.assertEqual(self.protocol.expiredCounts, {'originate': 1})
+
+        self.protocol.dataReceived(
+            'Event: OriginateResponse\r\n'
+            'ActionID: ' + actionid + '\r\n'
+            'Response: Success\r\n'
+            '\r\n'
+        )
+        self.assertFalse(lose.called)
+        return d
+
+
     def test_OriginateExceptionRepr(self):
         """repr() of an OriginateException"""
 
@@ -703,7 +1234,7 @@ class AMIProtocolTestCase(unittest.TestCase):
             'Digit: 5\r\n'
             '\r\n'
         )
-        self.assertTrue(lose.called)
+        self.assertFalse(lose.called)
         self.assertEqual(len(self.flushLoggedErrors(ProtocolError)), 1)
 
         lose = self.transport.loseConnection = Mock()
@@ -717,7 +1248,7 @@ class AMIProtocolTestCase(unittest.TestCase):
             'Digit: 5\r\n'
             '\r\n'
         )
-        self.assertTrue(lose.called)
+        self.assertFalse(lose.called)
         self.assertEqual(len(self.flushLoggedErrors(ProtocolError)), 1)
 
 
@@ -16,12 +16,13 @@
 from urllib import quote
 
 from mock import Mock
+from twisted.internet.task import Clock
 from twisted.trial import unittest
 from twisted.test import proto_helpers
 
 from octothorpe.asyncagi import AGIException, AsyncAGIProtocol, AsyncAGIChannel
 from octothorpe.asyncagi import ResultException, UnknownCommandException
-from octothorpe.base import ProtocolError
+from octothorpe.base import ActionTimeoutException, ProtocolError
 from octothorpe.test.test_base import disassembleMessage
 
 
@@ -33,6 +34,7 @@ class AsyncAGIProtocolTestCase(unittest.TestCase):
 
     def setUp(self):
         self.protocol = AsyncAGIProtocol()
+        self.protocol.clock = self.clock = Clock()
         self.transport = proto_helpers.StringTransport()
         self.protocol.makeConnection(self.transport)
         self.protocol.started = True
@@ -212,6 +214,28 @@ class AsyncAGIProtocolTestCase(unittest.TestCase):
         }))
 
 
+    def test_originateAsyncAGITimeout(self):
+        """AsyncAGI origination without an AsyncAGI Start times out"""
+
+        self.protocol.originateTimeout = 30
+        d, channel, message = self._setUpOriginateAsyncAGI()
+        self.protocol.dataReceived(
+            'Event: OriginateResponse\r\n'
+            'ActionID: ' + message['actionid'] + '\r\n'
+            'Channel: Foo/202-0\r\n'
+            'Response: Success\r\n'
+            'Uniqueid: 1234567890.0\r\n'
+            '\r\n'
+        )
+        self.assertEqual(len(self.protocol.pendingAsyncOrigs), 1)
+
+        self.clock.advance(30 + self.protocol.timeoutResolution)
+        self.assertEqual(self.protocol.pendingAsyncOrigs, {})
+        self.assertEqual(self.protocol.expiredCounts, {'asyncorig': 1})
+        self.assertFailure(d, ActionTimeoutException)
+        return d
+
+
     def test_AGI(self):
         """Successfully run an AGI command"""
 
@@ -280,6 +304,27 @@ class AsyncAGIProtocolTestCase(unittest.TestCase):
         return d
 
 
+    def test_AGITimeout(self):
+        """AGI command without an AsyncAGI Exec times out"""
+
+        self.protocol.agiTimeout = 10
+        channel = self._spawnChannel()
+        d = channel.sendAGI('EXEC Playback hello-world')
+        message = disassembleMessage(self.transport.value())
+        self.protocol.dataReceived(
+            'Response: Success\r\n'
+            'ActionID: ' + message['actionid'] + '\r\n'
+            '\r\n'
+        )
+        self.assertEqual(len(channel.pendingAGI), 1)
+
+        self.clock.advance(10 + self.protocol.timeoutResolution)
+        self.assertEqual(channel.pendingAGI, {})
+        self.assertEqual(self.protocol.expiredCounts, {'agi': 1})
+        self.assertFailure(d, ActionTimeoutException)
+        return d
+
+
     def test_unknownCommandId(self):
         """Connection is not dropped on an unknown command"""
 
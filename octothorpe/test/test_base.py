@@ -13,11 +13,19 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 
-from mock import Mock
+import gc
+from weakref import ref
+
+from mock import Mock, call
+from twisted.internet.defer import DeferredList
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
 from twisted.trial import unittest
 from twisted.test import proto_helpers
 
 from octothorpe.base import BaseAMIProtocol, ActionException, ProtocolError
+from octothorpe.base import ActionTimeoutException
 
 
 """Tests for octothorpe.base"""
@@ -31,11 +39,92 @@ def disassembleMessage(data):
         raise ValueError('unterminated message (%r)' % (data,))
     fields = {}
     for line in lines[:-2]:
-        key, value = line.split(': ', 2)
+        key, value = line.split(': ', 1)
         fields[key.lower()] = value
     return fields
 
 
+def respondToAction(testCase, protocol, transport, action, response):
+    """Check the action a protocol sent and feed it a response.
+
+    response may use %(actionid)s for the action's ActionID.  Returns
+    the action's fields.
+
+    """
+    fields = disassembleMessage(transport.value())
+    transport.clear()
+    testCase.assertEqual(fields['action'], action)
+    protocol.dataReceived(response % {'actionid': fields['actionid']})
+    return fields
+
+
+def connectAndLogIn(testCase, factory, banner='Asterisk Call Manager/1.3'):
+    """Connect a protocol built by a client factory and log it in.
+
+    The protocol is sent a banner, then answered as Asterisk would
+    answer an MD5 login.  Returns (protocol, transport, fields), where
+    fields are those of the Login action.
+
+    """
+    protocol = factory.buildProtocol(None)
+    transport = proto_helpers.StringTransport()
+    protocol.makeConnection(transport)
+    protocol.dataReceived(banner + '\r\n')
+    respondToAction(testCase, protocol, transport, 'Challenge',
+        'Response: Success\r\n'
+        'ActionID: %(actionid)s\r\n'
+        'Challenge: foo\r\n'
+        '\r\n'
+    )
+    fields = respondToAction(testCase, protocol, transport, 'Login',
+        'Response: Success\r\n'
+        'ActionID: %(actionid)s\r\n'
+        '\r\n'
+    )
+    return protocol, transport, fields
+
+
+def respondToCoreShowChannels(testCase, protocol, transport, channels):
+    """Check a protocol sent CoreShowChannels and list channels to it.
+
+    channels -- list of (name, uniqueid, state, state description)
+
+    """
+    listing = ''.join([
+        'Event: CoreShowChannel\r\n'
+        'ActionID: %(actionid)s\r\n'
+        'Channel: ' + name + '\r\n'
+        'UniqueID: ' + uniqueid + '\r\n'
+        'ChannelState: ' + str(state) + '\r\n'
+        'ChannelStateDesc: ' + desc + '\r\n'
+        'CallerIDnum: 202\r\n'
+        '\r\n'
+        for name, uniqueid, state, desc in channels
+    ])
+    return respondToAction(testCase, protocol, transport, 'CoreShowChannels',
+        'Response: Success\r\n'
+        'ActionID: %(actionid)s\r\n'
+        'EventList: start\r\n'
+        '\r\n' +
+        listing +
+        'Event: CoreShowChannelsComplete\r\n'
+        'ActionID: %(actionid)s\r\n'
+        'EventList: Complete\r\n'
+        '\r\n'
+    )
+
+
+def useClock(factory, clock):
+    """Make a client factory, and the protocols it builds, use clock."""
+
+    class TestProtocol(factory.protocol):
+        pass
+
+    TestProtocol.clock = clock
+    factory.protocol = TestProtocol
+    factory.clock = clock
+
+
 class DisassembleMessageTestCase(unittest.TestCase):
     """Test the disassembleMessage helper.
     
@@ -80,6 +169,7 @@ class BaseAMIProtocolTestCase(unittest.TestCase):
 
     def setUp(self):
         self.protocol = BaseAMIProtocol()
+        self.protocol.clock = self.clock = Clock()
         self.transport = proto_helpers.StringTransport()
         self.protocol.makeConnection(self.transport)
 
@@ -133,6 +223,110 @@ class BaseAMIProtocolTestCase(unittest.TestCase):
         )
 
 
+    def test_unhandledEventSkipped(self):
+        """Events nobody handles are not parsed"""
+
+        self.protocol.event_foo = Mock()
+        self.protocol.eventReceived = Mock()
+        self.protocol.started = True
+        self.protocol.dataReceived(
+            'Event: Bar\r\n'
+            'This line would not parse\r\n'
+            '\r\n'
+            'Event: Foo\r\n'
+            '\r\n'
+        )
+        self.protocol.eventReceived.assert_called_once_with('foo', {})
+        self.assertEqual(self.protocol.parser.skipped, 1)
+
+
+    def test_handlerAddedLater(self):
+        """Handlers added to a class later are parsed for"""
+
+        class TestProtocol(BaseAMIProtocol):
+            def event_foo(self, message):
+                pass
+
+        self.assertEqual(TestProtocol().handledEvents(), set(['foo']))
+        TestProtocol.event_bar = Mock()
+        self.protocol = TestProtocol()
+        self.protocol.makeConnection(self.transport)
+        self.protocol.started = True
+        self.protocol.dataReceived('Event: Bar\r\nKey: Value\r\n\r\n')
+        TestProtocol.event_bar.assert_called_once_with({'key': 'Value'})
+
+
+    def test_refreshHandledEvents(self):
+        """The handled set is kept until refreshHandledEvents is called"""
+
+        self.protocol.started = True
+        self.protocol.dataReceived('Event: Foo\r\n\r\n')
+        self.protocol.handledEvents = Mock(return_value=frozenset())
+        self.protocol.event_foo = Mock()
+        self.protocol.dataReceived('Event: Foo\r\n\r\n')
+        self.assertFalse(self.protocol.handledEvents.called)
+        self.assertFalse(self.protocol.event_foo.called)
+
+        self.protocol.refreshHandledEvents()
+        self.protocol.dataReceived('Event: Foo\r\n\r\n')
+        self.protocol.event_foo.assert_called_once_with({})
+
+
+    def test_eventReceivedOverrideGetsEverything(self):
+        """Overriding eventReceived disables skipping"""
+
+        class TestProtocol(BaseAMIProtocol):
+            def eventReceived(self, event, message):
+                self.received.append(event)
+
+        self.protocol = TestProtocol()
+        self.protocol.makeConnection(self.transport)
+        self.protocol.received = []
+        self.protocol.started = True
+        self.protocol.dataReceived('Event: Bar\r\n\r\n')
+        self.assertEqual(self.protocol.received, ['bar'])
+
+
+    def test_bannerAndEventsInOneChunk(self):
+        """Receive a banner and several events in one chunk"""
+
+        self.protocol.event_foo = Mock()
+        self.protocol.dataReceived(
+            'Asterisk Call Manager/1.3\r\n'
+            'Event: Foo\r\n'
+            'Key: Value\r\n'
+            '\r\n'
+            'Event: Foo\r\n'
+            'Key: Value2\r\n'
+            '\r\n'
+        )
+        self.assertTrue(self.protocol.started)
+        self.assertEqual(self.protocol.event_foo.mock_calls, [
+            call({'key': 'Value'}),
+            call({'key': 'Value2'}),
+        ])
+
+
+    def test_eventSplitAcrossChunks(self):
+        """Receive an event delivered a byte at a time"""
+
+        self.protocol.event_foo = Mock()
+        self.protocol.started = True
+        for byte in 'Event: Foo\r\nKey: Value\r\n\r\n':
+            self.assertFalse(self.protocol.event_foo.called)
+            self.protocol.dataReceived(byte)
+        self.protocol.event_foo.assert_called_once_with({'key': 'Value'})
+
+
+    def test_lengthLimitExceeded(self):
+        """Connection is dropped on an overlong unterminated message"""
+
+        self.protocol.started = True
+        lose = self.transport.loseConnection = Mock()
+        self.protocol.dataReceived('Foo: ' + 'x' * self.protocol.MAX_LENGTH)
+        self.assertTrue(lose.called)
+
+
     def test_unknownActionID(self):
         """Connection is not dropped on an unknown action"""
 
@@ -160,6 +354,41 @@ class BaseAMIProtocolTestCase(unittest.TestCase):
         self.assertEqual(fields['actionid'], 'bar-baz-quux')
 
 
+    def test_setEventMask(self):
+        """Set the event mask from our handlers"""
+
+        self.protocol.started = True
+        self.protocol.event_dtmf = Mock()
+        self.protocol.event_fullybooted = Mock()
+        self.protocol.setEventMask()
+
+        fields = disassembleMessage(self.transport.value())
+        self.assertEqual(fields['action'], 'Events')
+        self.assertEqual(fields['eventmask'], 'dtmf,system')
+
+
+    def test_eventMaskUnknownEvent(self):
+        """Ask for all events if we handle one we can't classify"""
+
+        self.protocol.event_dtmf = Mock()
+        self.protocol.event_foo = Mock()
+        self.assertEqual(self.protocol.eventMask(), 'on')
+
+
+    def test_addEventFilter(self):
+        """Add a whitelist filter for our handlers"""
+
+        self.protocol.started = True
+        self.protocol.event_dtmf = Mock()
+        self.protocol.event_fullybooted = Mock()
+        self.protocol.addEventFilter()
+
+        fields = disassembleMessage(self.transport.value())
+        self.assertEqual(fields['action'], 'Filter')
+        self.assertEqual(fields['operation'], 'Add')
+        self.assertEqual(fields['filter'], 'Event: (DTMF|FullyBooted)')
+
+
     def _startAndSendAction(self):
         """Helper to start the protocol and send an action"""
 
@@ -178,6 +407,122 @@ class BaseAMIProtocolTestCase(unittest.TestCase):
         return d, fields['actionid']
 
 
+    def test_actionIDsUniqueAcrossConnections(self):
+        """ActionIDs are not reused after reconnecting"""
+
+        d, first = self._startAndSendAction()
+        self.transport.clear()
+        self.protocol.makeConnection(self.transport)
+        d, second = self._startAndSendAction()
+        self.assertNotEqual(first, second)
+
+
+    def test_sendActionSingleWrite(self):
+        """An action is written with a single write"""
+
+        self.protocol.started = True
+        write = self.transport.write = Mock()
+        self.protocol.sendAction('Foo', {'key': 'Value'})
+        self.assertEqual(len(write.mock_calls), 1)
+
+
+    def test_coalesceActions(self):
+        """Actions sent in one iteration are written together"""
+
+        self.protocol = BaseAMIProtocol()
+        self.protocol.clock = clock = Clock()
+        self.protocol.coalesceActions = True
+        self.protocol.makeConnection(self.transport)
+        self.protocol.started = True
+        writeSequence = self.transport.writeSequence = Mock()
+
+        self.protocol.sendAction('Foo', {'actionid': '1'})
+        self.protocol.sendAction('Bar', {'actionid': '2'})
+        self.assertFalse(writeSequence.called)
+
+        clock.advance(0)
+        (data,), kwargs = writeSequence.call_args
+        self.assertEqual(len(writeSequence.mock_calls), 1)
+        self.assertEqual(
+            [disassembleMessage(message)['action'] for message in data],
+            ['Foo', 'Bar']
+        )
+
+
+    def test_maxActionsInFlight(self):
+        """Actions beyond the in-flight window are queued"""
+
+        self.protocol.started = True
+        self.protocol.maxActionsInFlight = 1
+        d1 = self.protocol.sendAction('Foo', {'actionid': '1'})
+        d2 = self.protocol.sendAction('Bar', {'actionid': '2'})
+        capacity = Mock()
+        self.protocol.waitForCapacity().addCallback(capacity)
+
+        self.assertEqual(disassembleMessage(self.transport.value()),
+                         {'action': 'Foo', 'actionid': '1'})
+        self.assertEqual(self.protocol.actionsInFlight(), 1)
+        self.assertEqual(self.protocol.actionsQueued(), 1)
+
+        self.transport.clear()
+        self.protocol.dataReceived('Response: Success\r\nActionID: 1\r\n\r\n')
+        self.assertEqual(disassembleMessage(self.transport.value()),
+                         {'action': 'Bar', 'actionid': '2'})
+        self.assertEqual(self.protocol.actionsInFlight(), 1)
+        self.assertEqual(self.protocol.actionsQueued(), 0)
+        self.assertFalse(capacity.called)
+
+        self.protocol.dataReceived('Response: Success\r\nActionID: 2\r\n\r\n')
+        self.assertTrue(capacity.called)
+        self.assertEqual(self.protocol.actionsInFlight(), 0)
+
+
+    def test_actionTimeout(self):
+        """An action without a response times out"""
+
+        self.protocol.started = True
+        lose = self.transport.loseConnection = Mock()
+        d = self.protocol.sendAction('Foo', {'actionid': '1'}, timeout=5)
+        self.assertFailure(d, ActionTimeoutException)
+
+        self.clock.advance(5)
+        self.assertIn('1', self.protocol.pendingActions)
+        self.clock.advance(1)
+        self.assertNotIn('1', self.protocol.pendingActions)
+        self.assertEqual(self.protocol.expiredCounts, {'action': 1})
+
+        self.protocol.dataReceived('Response: Success\r\nActionID: 1\r\n\r\n')
+        self.assertFalse(lose.called)
+        return d
+
+
+    def test_actionDefaultTimeout(self):
+        """Actions answered in time don't time out"""
+
+        self.protocol.started = True
+        self.protocol.actionTimeout = 5
+        d = self.protocol.sendAction('Foo', {'actionid': '1'})
+        self.protocol.dataReceived('Response: Success\r\nActionID: 1\r\n\r\n')
+        self.clock.advance(10)
+        self.assertEqual(self.protocol.expiredCounts, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        return d
+
+
+    def test_answeredActionReleased(self):
+        """Answered actions aren't kept alive until their timeouts"""
+
+        self.protocol.started = True
+        d = self.protocol.sendAction('Foo', {'actionid': '1'}, timeout=5)
+        self.protocol.dataReceived('Response: Success\r\nActionID: 1\r\n\r\n')
+        answered = ref(d)
+        del d
+        gc.collect()
+        self.assertIdentical(answered(), None)
+        self.clock.advance(10)
+        self.assertEqual(self.protocol.expiredCounts, {})
+
+
     def test_actionSuccess(self):
         """Send an action and get a success response"""
 
@@ -277,4 +622,238 @@ class BaseAMIProtocolTestCase(unittest.TestCase):
         self.assertEqual(len(self.flushLoggedErrors(ProtocolError)), 1)
 
 
+    def _sendListAction(self, eventList):
+        """Helper to send a list action and receive its list"""
+
+        self.protocol.started = True
+        self.protocol.event_peerentry = Mock()
+        d = self.protocol.sendAction('SIPpeers', {}, eventList=eventList)
+        actionid = disassembleMessage(self.transport.value())['actionid']
+        self.protocol.dataReceived(
+            'Response: Success\r\n'
+            'ActionID: ' + actionid + '\r\n'
+            'EventList: start\r\n'
+            'Message: Peer status list will follow\r\n'
+            '\r\n'
+            'Event: PeerEntry\r\n'
+            'ActionID: ' + actionid + '\r\n'
+            'ObjectName: 202\r\n'
+            '\r\n'
+            'Event: PeerEntry\r\n'
+            'ObjectName: 303\r\n'
+            '\r\n'
+        )
+        self.assertFalse(d.called)
+        self.protocol.dataReceived(
+            'Event: PeerEntry\r\n'
+            'ActionID: ' + actionid + '\r\n'
+            'ObjectName: 404\r\n'
+            '\r\n'
+            'Event: PeerlistComplete\r\n'
+            'EventList: Complete\r\n'
+            'ListItems: 2\r\n'
+            'ActionID: ' + actionid + '\r\n'
+            '\r\n'
+        )
+        self.protocol.event_peerentry.assert_called_once_with(
+            {'objectname': '303'})
+        self.assertEqual(self.protocol.pendingLists, {})
+        return d
+
+
+    def test_actionEventListCollected(self):
+        """Send an action and collect its EventList"""
+
+        d = self._sendListAction(True)
+        d.addCallback(self.assertEqual, (
+            [('peerentry', {'objectname': '202'}),
+             ('peerentry', {'objectname': '404'})],
+            {'eventlist': 'Complete', 'listitems': '2'},
+        ))
+        return d
+
+
+    def test_actionEventListStreamed(self):
+        """Send an action and stream its EventList"""
+
+        itemReceived = Mock()
+        d = self._sendListAction(itemReceived)
+        self.assertEqual(itemReceived.call_count, 2)
+        itemReceived.assert_called_with('peerentry', {'objectname': '404'})
+        d.addCallback(self.assertEqual,
+                      (None, {'eventlist': 'Complete', 'listitems': '2'}))
+        return d
+
+
+    def test_actionEventListError(self):
+        """Send a list action and get an error response"""
+
+        self.protocol.started = True
+        d = self.protocol.sendAction('SIPpeers', {}, eventList=True)
+        actionid = disassembleMessage(self.transport.value())['actionid']
+        self.protocol.dataReceived(
+            'Response: Error\r\n'
+            'ActionID: ' + actionid + '\r\n'
+            '\r\n'
+        )
+        self.assertEqual(self.protocol._listModes, {})
+        self.assertFailure(d, ActionException)
+        return d
+
+
+    def test_actionFollowsStreamed(self):
+        """Send a command action and stream its body"""
+
+        self.protocol.started = True
+        chunks = []
+        d = self.protocol.sendAction('Command', {'command': 'foo'},
+                                     bodyReceived=chunks.append)
+        actionid = disassembleMessage(self.transport.value())['actionid']
+        line = 'x' * 99 + '\n'
+        self.protocol.dataReceived(
+            'Response: Follows\r\n'
+            'ActionID: ' + actionid + '\r\n'
+        )
+        for i in range(self.protocol.MAX_LENGTH / 1000 + 1):
+            self.protocol.dataReceived(line * 10)
+        self.protocol.dataReceived('--END COMMAND--\r\n\r\n')
+
+        self.assertFalse(self.transport.disconnecting)
+        self.assertEqual(chunks[-1], None)
+        self.assertEqual(''.join(chunks[:-1]),
+                         line * 10 * (self.protocol.MAX_LENGTH / 1000 + 1))
+        self.assertEqual(self.protocol._bodyReceivers, {})
+        d.addCallback(self.assertEqual, ({}, None))
+        return d
+
+
+    def _setUpFaultyProtocol(self, **attrs):
+        """Helper to set up a protocol with a buggy event handler"""
+
+        class FaultyProtocol(BaseAMIProtocol):
+            def event_foo(self, message):
+                return message['bar']
+
+        for key, value in attrs.iteritems():
+            setattr(FaultyProtocol, key, value)
+        self.protocol = FaultyProtocol()
+        self.protocol.clock = self.clock
+        self.protocol.makeConnection(self.transport)
+        self.protocol.started = True
+        lose = self.transport.loseConnection = Mock()
+        return lose
+
+
+    def test_handlerExceptionIsolated(self):
+        """Exceptions in handlers are counted, not fatal"""
+
+        lose = self._setUpFaultyProtocol()
+        self.protocol.dataReceived('Event: Foo\r\n\r\n' * 2)
+        self.assertFalse(lose.called)
+        self.assertEqual(len(self.flushLoggedErrors(KeyError)), 2)
+        self.assertEqual(self.protocol.handlerErrorCounts,
+                         {'FaultyProtocol.event_foo': 2})
+        self.assertEqual(self.protocol.eventErrorCounts, {'foo': 2})
+
+
+    def test_handlerExceptionNotIsolated(self):
+        """Exceptions in handlers can be made fatal"""
+
+        lose = self._setUpFaultyProtocol(isolateHandlerErrors=False)
+        self.protocol.dataReceived('Event: Foo\r\n\r\n')
+        self.assertTrue(lose.called)
+        self.assertEqual(len(self.flushLoggedErrors(KeyError)), 1)
+
+
+    def test_errorBudget(self):
+        """Too many handler exceptions too quickly are fatal"""
+
+        lose = self._setUpFaultyProtocol(errorBudget=(2, 10))
+        self.protocol.dataReceived('Event: Foo\r\n\r\n' * 2)
+        self.clock.advance(10)
+        self.protocol.dataReceived('Event: Foo\r\n\r\n' * 2)
+        self.assertFalse(lose.called)
+        self.protocol.dataReceived('Event: Foo\r\n\r\n')
+        self.assertTrue(lose.called)
+        self.assertEqual(len(self.flushLoggedErrors(KeyError)), 5)
+
+
+    def test_handlerExceptionNamed(self):
+        """Exceptions are counted under the handler dispatched to"""
+
+        class FaultyProtocol(BaseAMIProtocol):
+            def event_foo(self, message):
+                return int(message['bar'])
+
+            def event_baz(self, message):
+                raise ProtocolError('inconsistent state')
+
+        self.protocol = FaultyProtocol()
+        self.protocol.makeConnection(self.transport)
+        self.protocol.started = True
+        lose = self.transport.loseConnection = Mock()
+        self.protocol.dataReceived('Event: Foo\r\nBar: x\r\n\r\n'
+                                   'Event: Baz\r\n\r\n')
+        self.assertFalse(lose.called)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(len(self.flushLoggedErrors(ProtocolError)), 1)
+        self.assertEqual(self.protocol.handlerErrorCounts, {
+            'FaultyProtocol.event_foo': 1,
+            'FaultyProtocol.event_baz': 1,
+        })
+
+
+    def test_connectionLostFailsPending(self):
+        """Everything waiting on a lost connection is erred back"""
+
+        self.protocol.started = True
+        self.protocol.maxActionsInFlight = 1
+        sent = self.protocol.sendAction('Foo', {})
+        queued = self.protocol.sendAction('Bar', {})
+        waiter = self.protocol.waitForCapacity()
+        self.protocol.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(self.protocol.actionsInFlight(), 0)
+        self.assertEqual(self.protocol.actionsQueued(), 0)
+        for d in [sent, queued, waiter]:
+            self.assertFailure(d, ConnectionDone)
+        return DeferredList([sent, queued, waiter])
+
+
+    def test_timeSliced(self):
+        """Messages are dispatched in slices, pausing at the high water"""
+
+        class SlicedProtocol(BaseAMIProtocol):
+            sliceBudget = 0
+            highWaterMark = 40
+            lowWaterMark = 20
+
+            def event_foo(self, message):
+                self.received.append(message['bar'])
+
+        self.protocol = SlicedProtocol()
+        self.protocol.clock = self.clock
+        self.protocol.received = []
+        self.protocol.makeConnection(self.transport)
+        self.protocol.dataReceived('Asterisk Call Manager/1.1\r\n' +
+                                   'Event: Foo\r\nBar: %d\r\n\r\n' * 3
+                                   % (1, 2, 3))
+        self.assertEqual(self.protocol.received, [])
+        self.assertEqual(self.transport.producerState, 'paused')
+
+        # Other calls get a turn between slices.
+
+        seen = []
+        self.clock.callLater(0, lambda: seen.append(
+            (list(self.protocol.received), self.transport.producerState)))
+        self.clock.advance(0)
+        self.assertEqual(seen, [(['1'], 'paused')])
+        self.assertEqual(self.protocol.received, ['1', '2', '3'])
+        self.assertEqual(self.transport.producerState, 'producing')
+
+        self.protocol.dataReceived('Event: Foo\r\nBar: 4\r\n\r\n')
+        self.clock.advance(0)
+        self.assertEqual(self.protocol.received, ['1', '2', '3', '4'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
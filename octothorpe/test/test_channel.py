@@ -0,0 +1,184 @@
+# Copyright (c) 2013, 2014 Matt Behrens <matt@zigg.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+
+import json
+from collections import MutableMapping
+
+from mock import Mock
+from twisted.trial import unittest
+
+from octothorpe.channel import BaseChannel, Channel, Params
+
+
+"""Tests for octothorpe.channel"""
+
+
+class ParamsTestCase(unittest.TestCase):
+    """Test case for the compact params store"""
+
+    def test_mapping(self):
+        """Params behaves like a dict"""
+
+        params = Params({'foo': 'Foo', 'bar': 'Bar'})
+        params['baz'] = 'Baz'
+        params['foo'] = 'Quux'
+        self.assertEqual(params, {'foo': 'Quux', 'bar': 'Bar', 'baz': 'Baz'})
+        self.assertEqual(params.get('bar'), 'Bar')
+        self.assertEqual(params.get('nope'), None)
+        self.assertIn('baz', params)
+        self.assertEqual(len(params), 3)
+
+        del params['bar']
+        self.assertEqual(params, {'foo': 'Quux', 'baz': 'Baz'})
+        self.assertRaises(KeyError, params.__getitem__, 'bar')
+
+
+    def test_mappingMethods(self):
+        """Params has the rest of the dict methods too"""
+
+        params = Params(foo='Foo')
+        self.assertEqual(params.setdefault('foo', 'Quux'), 'Foo')
+        self.assertEqual(params.setdefault('bar', 'Bar'), 'Bar')
+        self.assertEqual(params.items(), [('foo', 'Foo'), ('bar', 'Bar')])
+        self.assertEqual(params.keys(), ['foo', 'bar'])
+        self.assertEqual(params.values(), ['Foo', 'Bar'])
+        self.assertEqual(params.pop('foo'), 'Foo')
+        self.assertEqual(params.pop('foo', None), None)
+        self.assertRaises(KeyError, params.pop, 'foo')
+        self.assertEqual(params.popitem(), ('bar', 'Bar'))
+        self.assertRaises(KeyError, params.popitem)
+        params.update([('baz', 'Baz')], quux='Quux')
+        self.assertNotEqual(params, {})
+        params.clear()
+        self.assertEqual(params, {})
+        self.assertIsInstance(params, MutableMapping)
+
+
+    def test_slotted(self):
+        """Params objects have no instance dict"""
+
+        self.assertFalse(hasattr(Params(), '__dict__'))
+
+
+    def test_sharedLayout(self):
+        """Params built up the same way share a key layout"""
+
+        first = Params()
+        second = Params()
+        for params in (first, second):
+            params['foo'] = 'Foo'
+            params['bar'] = 'Bar'
+        self.assertIs(first._layout, second._layout)
+
+
+class BaseChannelTestCase(unittest.TestCase):
+    """Test case for slotted channels"""
+
+    def test_slotted(self):
+        """A slotted subclass has no instance dict"""
+
+        class SlottedChannel(BaseChannel):
+            __slots__ = ()
+
+        channel = SlottedChannel(None, 'Foo/202-0', {
+            'channel': 'Foo/202-0',
+            'channelstate': '0',
+        })
+        self.assertFalse(hasattr(channel, '__dict__'))
+        self.assertEqual(channel.state, 0)
+        self.assertIsInstance(channel.params, Params)
+
+
+    def test_channelParams(self):
+        """Channel keeps its params in a plain dict"""
+
+        channel = Channel(None, 'Foo/202-0', {
+            'channel': 'Foo/202-0',
+            'channelstate': '0',
+        })
+        self.assertIsInstance(channel.params, dict)
+        self.assertEqual(json.loads(json.dumps(channel.params))['channel'],
+                         'Foo/202-0')
+
+
+    def test_channelAllowsAttributes(self):
+        """Channel still allows arbitrary attributes"""
+
+        channel = Channel(None, 'Foo/202-0', {
+            'channel': 'Foo/202-0',
+            'channelstate': '0',
+        })
+        channel.foo = 'bar'
+        self.assertEqual(channel.foo, 'bar')
+
+
+class ExtensionHistoryTestCase(unittest.TestCase):
+    """Test case for the bounded extension history"""
+
+    def _enter(self, channel, count):
+        for priority in range(1, count + 1):
+            channel.event_newexten({
+                'context': 'default',
+                'extension': '400',
+                'priority': str(priority),
+                'application': 'NoOp',
+                'appdata': '',
+            })
+
+
+    def _spawnChannel(self, depth):
+        channel = Channel(None, 'Foo/202-0', {
+            'channel': 'Foo/202-0',
+            'channelstate': '0',
+        })
+        channel.extensionHistoryDepth = depth
+        channel.extensionEntered = Mock()
+        return channel
+
+
+    def test_bounded(self):
+        """Only the most recent entries are kept, in order"""
+
+        channel = self._spawnChannel(3)
+        self._enter(channel, 5)
+        self.assertEqual(
+            [entry[2] for entry in channel.extensionHistory()],
+            [3, 4, 5]
+        )
+        self.assertEqual(channel.extensions, channel.extensionHistory())
+        self.assertEqual(len(channel.extensionEntered.mock_calls), 5)
+
+
+    def test_disabled(self):
+        """A depth of 0 keeps no history but still notifies"""
+
+        channel = self._spawnChannel(0)
+        self._enter(channel, 2)
+        self.assertEqual(channel.extensionHistory(), [])
+        self.assertEqual(len(channel.extensionEntered.mock_calls), 2)
+
+
+    def test_unbounded(self):
+        """By default everything is kept, and not copied to be read"""
+
+        self.assertIsNone(Channel.extensionHistoryDepth)
+        channel = self._spawnChannel(None)
+        self._enter(channel, 150)
+        self.assertEqual(len(channel.extensionHistory()), 150)
+        self.assertIs(channel.extensions, channel.extensions)
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
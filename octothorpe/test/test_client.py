@@ -0,0 +1,129 @@
+# Copyright (c) 2013, 2014 Matt Behrens <matt@zigg.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+from mock import Mock
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+
+from octothorpe.client import AMIClientFactory, AMIClientService
+from octothorpe.core import ActionException
+from octothorpe.test.test_base import connectAndLogIn, respondToAction
+from octothorpe.test.test_base import respondToCoreShowChannels, useClock
+
+
+"""Tests for octothorpe.client"""
+
+
+class AMIClientFactoryTestCase(unittest.TestCase):
+    """Test case for the reconnecting client factory"""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.factory = AMIClientFactory('username', 'secret')
+        useClock(self.factory, self.clock)
+        self.factory.protocolReady = Mock()
+
+
+    def _connect(self, channels):
+        """Helper to connect, log in and list channels"""
+
+        protocol, transport, fields = connectAndLogIn(self, self.factory)
+        protocol.channelVanished = Mock()
+        respondToCoreShowChannels(self, protocol, transport, channels)
+        self.factory.protocolReady.assert_called_with(protocol)
+        return protocol
+
+
+    def test_reconnect(self):
+        """Channels are carried over and resynced after reconnecting"""
+
+        protocol = self._connect([
+            ('Foo/202-0', '1.0', 4, 'Ring'),
+            ('Bar/303-0', '1.1', 4, 'Ring'),
+        ])
+        foo = protocol.channels['Foo/202-0']
+        foo.newState = Mock()
+        d = protocol.sendAction('Ping', {})
+
+        connector = Mock()
+        reason = Failure(ConnectionDone())
+        protocol.connectionLost(reason)
+        self.factory.clientConnectionLost(connector, reason)
+        self.assertFailure(d, ConnectionDone)
+        self.clock.advance(self.factory.maxDelay)
+        connector.connect.assert_called_once_with()
+
+        protocol = self._connect([
+            ('Foo/202-0', '1.0', 6, 'Up'),
+            ('Baz/404-0', '1.2', 4, 'Ring'),
+        ])
+        self.assertEqual(sorted(protocol.channels),
+                         ['Baz/404-0', 'Foo/202-0'])
+        assert protocol.channels['Foo/202-0'] is foo
+        assert foo.protocol is protocol
+        foo.newState.assert_called_once_with(6, 'Up')
+        self.assertEqual(protocol.counts()['state'], {4: 1, 6: 1})
+        self.assertEqual(protocol.channelVanished.call_count, 1)
+        return d
+
+
+    def test_bootstrapChannelsProtocol(self):
+        """A protocol bootstrapping itself is only bootstrapped once"""
+
+        self.factory.protocol.bootstrapChannels = True
+        protocol = self._connect([('Foo/202-0', '1.0', 4, 'Ring')])
+        self.assertFalse(protocol.transport.disconnecting)
+        foo = protocol.channels['Foo/202-0']
+
+        reason = Failure(ConnectionDone())
+        protocol.connectionLost(reason)
+        self.factory.clientConnectionLost(Mock(), reason)
+        self.clock.advance(self.factory.maxDelay)
+        protocol = self._connect([('Foo/202-0', '1.0', 4, 'Ring')])
+        self.assertFalse(protocol.transport.disconnecting)
+        assert protocol.channels['Foo/202-0'] is foo
+        self.assertEqual(self.factory.protocolReady.call_count, 2)
+
+
+    def test_syncFailure(self):
+        """A failed channel sync is logged but keeps the connection"""
+
+        protocol, transport, fields = connectAndLogIn(self, self.factory)
+        respondToAction(self, protocol, transport, 'CoreShowChannels',
+            'Response: Error\r\n'
+            'ActionID: %(actionid)s\r\n'
+            'Message: Permission denied\r\n'
+            '\r\n'
+        )
+        self.assertEqual(len(self.flushLoggedErrors(ActionException)), 1)
+        self.assertFalse(transport.disconnecting)
+        self.assertFalse(protocol.synchronized)
+        self.factory.protocolReady.assert_called_once_with(protocol)
+
+
+    def test_serviceStopsTrying(self):
+        """Stopping the service stops reconnection"""
+
+        service = AMIClientService('localhost', 5038, self.factory)
+        service._getConnection = Mock()
+        service.startService()
+        self.assertTrue(self.factory.continueTrying)
+        service.stopService()
+        self.assertFalse(self.factory.continueTrying)
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
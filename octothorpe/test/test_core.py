@@ -0,0 +1,272 @@
+# Copyright (c) 2013, 2014 Matt Behrens <matt@zigg.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+
+from twisted.trial import unittest
+
+from octothorpe.core import AMIParser, BODY, EVENT, RESPONSE, ProtocolError
+from octothorpe.core import BodyLines
+from octothorpe.core import IDGenerator, TimingWheel
+from octothorpe.core import (ActionException, UnknownActionException,
+                             eventFilter, eventMask, parseMessage,
+                             resolveAction, serializeAction,
+                             serializeMessage)
+from octothorpe.test.test_base import disassembleMessage
+
+
+"""Tests for octothorpe.core"""
+
+
+class AMIParserTestCase(unittest.TestCase):
+    """Test case for the transport-independent parser"""
+
+    def setUp(self):
+        self.parser = AMIParser()
+
+
+    def test_banner(self):
+        """Pull the banner out as a line"""
+
+        self.parser.feed('Asterisk Call Manager/1.3\r\nEvent: Foo\r\n')
+        self.assertEqual(self.parser.nextLine(), 'Asterisk Call Manager/1.3')
+        self.assertEqual(self.parser.nextMessage(), None)
+
+
+    def test_messages(self):
+        """Pull several messages out of one feed"""
+
+        self.parser.feed(
+            'Event: Foo\r\n'
+            'Key: Value\r\n'
+            '\r\n'
+            'Response: Follows\r\n'
+            'ActionID: 1\r\n'
+            'foo bar\n--END COMMAND--\r\n'
+            '\r\n'
+            'Response: Succ'
+        )
+        self.assertEqual(self.parser.nextMessage(),
+                         (EVENT, 'foo', {'key': 'Value'}, None))
+        self.assertEqual(self.parser.raw, 'Event: Foo\r\nKey: Value')
+        self.assertEqual(self.parser.nextMessage(),
+                         (RESPONSE, 'Follows', {'actionid': '1'}, 'foo bar\n'))
+        self.assertEqual(self.parser.nextMessage(), None)
+        self.parser.feed('ess\r\n\r\n')
+        self.assertEqual(self.parser.nextMessage(),
+                         (RESPONSE, 'Success', {}, None))
+        self.assertEqual(self.parser.buffered(), 0)
+
+
+    def test_badMessageIsConsumed(self):
+        """A bad message raises but parsing carries on after it"""
+
+        self.parser.feed('Foo: Bar\r\n\r\nEvent: Baz\r\n\r\n')
+        self.assertRaises(ProtocolError, self.parser.nextMessage)
+        self.assertEqual(self.parser.nextMessage(), (EVENT, 'baz', {}, None))
+
+
+    def test_streamedBody(self):
+        """Follows bodies named in bodyIDs are returned piece by piece"""
+
+        self.parser.bodyIDs = set(['1'])
+        self.parser.feed(
+            'Response: Follows\r\n'
+            'Privilege: Command\r\n'
+            'ActionID: 1\r\n'
+            'foo: bar\nbaz'
+        )
+        message = {'privilege': 'Command', 'actionid': '1'}
+        self.assertEqual(self.parser.nextMessage(),
+                         (BODY, 'Follows', message, 'foo: bar\nbaz'))
+        self.assertEqual(self.parser.nextMessage(), None)
+        self.parser.feed(' quux\n--END COM')
+        self.assertEqual(self.parser.nextMessage(),
+                         (BODY, 'Follows', message, ' quux\n'))
+        self.assertEqual(self.parser.nextMessage(), None)
+        self.parser.feed('MAND--\r\n\r\nEvent: Foo\r\n\r\n')
+        self.assertEqual(self.parser.nextMessage(),
+                         (RESPONSE, 'Follows', message, ''))
+        self.assertEqual(self.parser.nextMessage(), (EVENT, 'foo', {}, None))
+
+
+    def test_unstreamedBody(self):
+        """Follows bodies not named in bodyIDs are returned whole"""
+
+        self.parser.bodyIDs = set(['2'])
+        self.parser.feed(
+            'Response: Follows\r\n'
+            'ActionID: 1\r\n'
+            'foo\n'
+        )
+        self.assertEqual(self.parser.nextMessage(), None)
+        self.parser.feed('--END COMMAND--\r\n\r\n')
+        self.assertEqual(self.parser.nextMessage(),
+                         (RESPONSE, 'Follows', {'actionid': '1'}, 'foo\n'))
+
+
+class BodyLinesTestCase(unittest.TestCase):
+    """Test case for splitting streamed bodies into lines"""
+
+    def test_iterate(self):
+        """Lines are split out of the kept chunks"""
+
+        lines = BodyLines()
+        for chunk in ['foo\nb', 'ar\n', '', 'baz\nquux', None]:
+            lines(chunk)
+        self.assertEqual(list(lines), ['foo', 'bar', 'baz', 'quux'])
+
+
+    def test_lineReceived(self):
+        """Lines are passed on as they are completed"""
+
+        received = []
+        lines = BodyLines(received.append)
+        lines('foo\nb')
+        self.assertEqual(received, ['foo'])
+        lines('ar\nbaz')
+        self.assertEqual(received, ['foo', 'bar'])
+        lines(None)
+        self.assertEqual(received, ['foo', 'bar', 'baz'])
+        self.assertEqual(lines.chunks, [])
+
+
+class ActionTestCase(unittest.TestCase):
+    """Test case for action serialization and response matching"""
+
+    def test_serializeAction(self):
+        """Serialize an action"""
+
+        fields = {'Action': 'Foo', 'ActionID': '1', 'Key': 'Value'}
+        self.assertEqual(disassembleMessage(serializeAction(fields)),
+                         {'action': 'Foo', 'actionid': '1', 'key': 'Value'})
+
+
+    def test_serializeMessage(self):
+        """Serialize parsed messages back into messages"""
+
+        self.assertEqual(
+            serializeMessage(EVENT, 'newchannel',
+                             {'channel': 'SIP/200-0', 'actionid': '1'}),
+            'Event: Newchannel\r\n'
+            'ActionID: 1\r\n'
+            'channel: SIP/200-0\r\n'
+            '\r\n'
+        )
+        data = serializeMessage(RESPONSE, 'Follows', {'privilege': 'Command'},
+                                'foo\nbar\n')
+        self.assertEqual(parseMessage(data[:-4]),
+                         (RESPONSE, 'Follows', {'privilege': 'Command'},
+                          'foo\nbar\n'))
+
+
+    def test_resolveSuccess(self):
+        """Match a Success response to its waiter"""
+
+        waiter = object()
+        pending = {'1': waiter}
+        message = {'actionid': '1', 'k': 'v'}
+        self.assertEqual(resolveAction(pending, 'Success', message, None),
+                         (waiter, True, ({'k': 'v'}, None)))
+        self.assertEqual(pending, {})
+
+
+    def test_resolveError(self):
+        """Match an Error response to its waiter"""
+
+        pending = {'1': None}
+        waiter, success, result = resolveAction(pending, 'Error',
+                                                {'actionid': '1'}, None)
+        self.assertFalse(success)
+        self.assertIsInstance(result, ActionException)
+
+
+    def test_resolveUnknown(self):
+        """Fail to match a response to an unknown action"""
+
+        self.assertRaises(UnknownActionException, resolveAction, {},
+                          'Success', {'actionid': '1'}, None)
+
+
+class IDGeneratorTestCase(unittest.TestCase):
+    """Test case for the ID generator"""
+
+    def test_counter(self):
+        """IDs are a prefix plus a counter"""
+
+        generateID = IDGenerator('foo')
+        self.assertEqual(generateID(), 'foo-1')
+        self.assertEqual(generateID(), 'foo-2')
+
+
+    def test_uniquePrefixes(self):
+        """Generators get distinct prefixes"""
+
+        self.assertNotEqual(IDGenerator()(), IDGenerator()())
+
+
+class TimingWheelTestCase(unittest.TestCase):
+    """Test case for the timing wheel"""
+
+    def test_expire(self):
+        """Entries expire once their slot has passed"""
+
+        wheel = TimingWheel(1.0)
+        wheel.add(10.5, 'a')
+        wheel.add(12.0, 'b')
+        wheel.add(10.2, 'c')
+        self.assertEqual(len(wheel), 3)
+        self.assertEqual(wheel.expire(10.9), [])
+        self.assertEqual(wheel.expire(11.0), ['a', 'c'])
+        self.assertEqual(wheel.expire(12.5), [])
+        self.assertEqual(wheel.expire(1000.0), ['b'])
+        self.assertEqual(len(wheel), 0)
+
+
+    def test_addInPast(self):
+        """Entries added with a passed deadline expire in the next slot"""
+
+        wheel = TimingWheel(1.0)
+        wheel.expire(20.0)
+        wheel.add(5.0, 'a')
+        self.assertEqual(wheel.expire(21.0), ['a'])
+
+
+class EventMaskTestCase(unittest.TestCase):
+    """Test case for event masks and filters"""
+
+    def test_eventMask(self):
+        """Work out event masks"""
+
+        self.assertEqual(eventMask(None), 'on')
+        self.assertEqual(eventMask(set()), 'off')
+        self.assertEqual(eventMask(set(['newstate', 'varset', 'hangup'])),
+                         'call,dialplan')
+        self.assertEqual(eventMask(set(['newstate', 'foo'])), 'on')
+        self.assertEqual(eventMask(set(['newstate', 'coreshowchannel'])),
+                         'call')
+
+
+    def test_eventFilter(self):
+        """Work out event filters"""
+
+        self.assertEqual(eventFilter(set(['newstate', 'varset'])),
+                         'Event: (Newstate|VarSet)')
+        self.assertEqual(eventFilter(set(['newstate', 'foo'])), None)
+        self.assertEqual(eventFilter(set(['newstate', 'statuscomplete'])),
+                         'Event: (Newstate)')
+        self.assertEqual(eventFilter(set()), None)
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,164 @@
+# Copyright (c) 2013, 2014 Matt Behrens <matt@zigg.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+import time
+
+from twisted.internet.defer import DeferredList
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+
+from octothorpe.ami import AMIProtocol
+from octothorpe.channel import Channel
+from octothorpe.executor import OrderedPool, pooled
+
+
+"""Tests for octothorpe.executor"""
+
+
+class FakeThreadPool(object):
+    """Thread pool that runs functions only when told to"""
+
+    def __init__(self):
+        self.calls = []
+
+
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        self.calls.append((onResult, f, args, kwargs))
+
+
+    def runNext(self):
+        onResult, f, args, kwargs = self.calls.pop(0)
+        try:
+            result = f(*args, **kwargs)
+        except:
+            onResult(False, Failure())
+        else:
+            onResult(True, result)
+
+
+class FakeReactor(object):
+    """Reactor that runs functions called from threads straight away"""
+
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+class OrderedPoolTestCase(unittest.TestCase):
+    """Test case for the ordered pool"""
+
+    def setUp(self):
+        self.threadpool = FakeThreadPool()
+        self.pool = OrderedPool(self.threadpool, FakeReactor())
+
+
+    def test_order(self):
+        """Functions with one key run one at a time, in order"""
+
+        first = self.pool.run('a', lambda: 1)
+        second = self.pool.run('a', lambda: 2)
+        other = self.pool.run('b', lambda: 3)
+        self.assertEqual(len(self.threadpool.calls), 2)
+        self.assertEqual(self.pool.depth('a'), 2)
+        self.assertEqual(self.pool.depth('c'), 0)
+        self.assertEqual(self.pool.queued, 3)
+
+        self.threadpool.runNext()
+        self.assertEqual(self.successResultOf(first), 1)
+        self.assertEqual(len(self.threadpool.calls), 2)
+        self.threadpool.runNext()
+        self.assertEqual(self.successResultOf(other), 3)
+        self.assertNoResult(second)
+        self.threadpool.runNext()
+        self.assertEqual(self.successResultOf(second), 2)
+        self.assertEqual(self.pool.queued, 0)
+        self.assertEqual(self.pool._queues, {})
+
+
+    def test_threads(self):
+        """Functions with one key never overlap in a real thread pool"""
+
+        threadpool = ThreadPool(4, 4)
+        threadpool.start()
+        self.addCleanup(threadpool.stop)
+        pool = OrderedPool(threadpool)
+        running = set()
+        results = {'a': [], 'b': []}
+
+        def work(key, i):
+            assert key not in running
+            running.add(key)
+            time.sleep(0.001)
+            results[key].append(i)
+            running.remove(key)
+
+        d = DeferredList([pool.run(key, work, key, i)
+                          for i in range(20) for key in 'ab'],
+                         fireOnOneErrback=True, consumeErrors=True)
+
+        def check(result):
+            self.assertEqual(results, {'a': range(20), 'b': range(20)})
+            self.assertEqual(pool.queued, 0)
+        return d.addCallback(check)
+
+
+    def test_pooledCallback(self):
+        """Pooled channel callbacks run in the protocol's pool"""
+
+        variables = []
+
+        class TestChannel(Channel):
+            @pooled
+            def variableSet(self, variable, value):
+                if variable == 'fail':
+                    raise ValueError(value)
+                variables.append((variable, value))
+                return value
+
+        class TestProtocol(AMIProtocol):
+            channelClass = TestChannel
+            callbackPool = self.pool
+
+        protocol = TestProtocol()
+        protocol.makeConnection(proto_helpers.StringTransport())
+        protocol.started = True
+        protocol.dataReceived(
+            'Event: Newchannel\r\n'
+            'Channel: SIP/200-0\r\n'
+            'ChannelState: 0\r\n'
+            'ChannelStateDesc: Down\r\n'
+            'CallerIDNum: 200\r\n'
+            'Uniqueid: 1.0\r\n'
+            '\r\n'
+        )
+        channel = protocol.channels['SIP/200-0']
+        d = channel.variableSet('foo', 'bar')
+        channel.variableSet('fail', 'baz')
+        self.assertEqual(protocol.callbacksQueued(), 2)
+        self.assertEqual(variables, [])
+
+        self.threadpool.runNext()
+        self.assertEqual(self.successResultOf(d), 'bar')
+        self.threadpool.runNext()
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(protocol.handlerErrorCounts,
+                         {'TestChannel.variableSet': 1})
+        self.assertEqual(protocol.eventErrorCounts, {})
+        self.assertEqual(protocol.callbacksQueued(), 0)
+        self.assertEqual(variables, [('foo', 'bar')])
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,115 @@
+# Copyright (c) 2013, 2014 Matt Behrens <matt@zigg.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+from mock import Mock
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+
+from octothorpe.federation import AMIFederation
+from octothorpe.federation import ServerUnavailableException
+from octothorpe.test.test_base import connectAndLogIn, disassembleMessage
+from octothorpe.test.test_base import respondToCoreShowChannels, useClock
+
+
+"""Tests for octothorpe.federation"""
+
+
+class AMIFederationTestCase(unittest.TestCase):
+    """Test case for the multi-server federation"""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.federation = AMIFederation()
+        for name in ('pbx1', 'pbx2'):
+            factory = self.federation.addServer(name, 'localhost', 5038,
+                                                'username', 'secret')
+            useClock(factory, self.clock)
+
+
+    def _connect(self, server, channels):
+        """Helper to connect to a server, log in and list channels"""
+
+        protocol, transport, fields = connectAndLogIn(
+            self, self.federation.factories[server])
+        respondToCoreShowChannels(self, protocol, transport, [
+            (name, uniqueid, 4, 'Ring') for name, uniqueid in channels
+        ])
+        assert self.federation.protocols[server] is protocol
+        return protocol
+
+
+    def test_namespace(self):
+        """Channels are qualified by server and act on their own server"""
+
+        pbx1 = self._connect('pbx1', [('SIP/200-0', '1.0')])
+        pbx2 = self._connect('pbx2', [('SIP/200-0', '1.0'),
+                                      ('IAX2/300-0', '1.1')])
+        federation = self.federation
+
+        one = federation.channel('pbx1', 'SIP/200-0')
+        two = federation.channel('pbx2', 'SIP/200-0')
+        assert one is pbx1.channels['SIP/200-0']
+        assert two is pbx2.channels['SIP/200-0']
+        assert federation.findChannels('uniqueid', ('pbx2', '1.0')) is two
+        self.assertEqual(len(federation.findChannels('calleridnum', '202')),
+                         3)
+        self.assertEqual(federation.counts(), {
+            'server': {'pbx1': 1, 'pbx2': 2},
+            'state': {4: 3},
+            'context': {},
+            'technology': {'SIP': 2, 'IAX2': 1},
+            'total': 3,
+        })
+        self.assertEqual(pbx1.indexes.keys(), ['uniqueid'])
+
+        two.sendAction('Hangup', {})
+        self.assertEqual(disassembleMessage(pbx2.transport.value())
+                         ['channel'], 'SIP/200-0')
+        self.assertEqual(pbx1.transport.value(), '')
+        federation.sendAction('pbx1', 'Ping', {})
+        self.assertEqual(disassembleMessage(pbx1.transport.value())
+                         ['action'], 'Ping')
+        self.failureResultOf(federation.sendAction('pbx3', 'Ping', {}),
+                             ServerUnavailableException)
+
+
+    def test_serverLost(self):
+        """A lost server's channels leave the federation until resynced"""
+
+        pbx1 = self._connect('pbx1', [('SIP/200-0', '1.0')])
+        self._connect('pbx2', [('SIP/300-0', '1.0')])
+        federation = self.federation
+        federation.countChanged = Mock()
+
+        reason = Failure(ConnectionDone())
+        pbx1.connectionLost(reason)
+        federation.factories['pbx1'].clientConnectionLost(Mock(), reason)
+        self.assertEqual(federation.channel('pbx1', 'SIP/200-0'), None)
+        self.assertEqual(federation.counts()['server'], {'pbx2': 1})
+        federation.countChanged.assert_any_call('server', 'pbx1', 0)
+        self.failureResultOf(federation.sendAction('pbx1', 'Ping', {}),
+                             ServerUnavailableException)
+
+        self.clock.advance(federation.factories['pbx1'].maxDelay)
+        pbx1 = self._connect('pbx1', [('SIP/200-0', '1.0')])
+        assert federation.channel('pbx1', 'SIP/200-0') is \
+            pbx1.channels['SIP/200-0']
+        self.assertEqual(federation.counts()['server'],
+                         {'pbx1': 1, 'pbx2': 1})
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
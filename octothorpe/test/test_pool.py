@@ -0,0 +1,128 @@
+# Copyright (c) 2013, 2014 Matt Behrens <matt@zigg.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+from mock import Mock
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+
+from octothorpe.ami import OriginateException
+from octothorpe.pool import AMIPool, PoolUnavailableException
+from octothorpe.test.test_base import connectAndLogIn, respondToAction
+from octothorpe.test.test_base import useClock
+
+
+"""Tests for octothorpe.pool"""
+
+
+class AMIPoolTestCase(unittest.TestCase):
+    """Test case for the connection pool"""
+
+    def setUp(self):
+        self.clock = Clock()
+
+        class TestPool(AMIPool):
+            bootstrap = False
+
+        self.pool = TestPool('username', 'secret', size=2)
+        for factory in self.pool.factories:
+            useClock(factory, self.clock)
+
+
+    def _connect(self, factory):
+        """Helper to connect and log in one of the pool's factories"""
+
+        protocol, transport, fields = connectAndLogIn(self, factory)
+        return protocol, fields
+
+
+    def _connectAll(self):
+        """Helper to connect the events and actions connections"""
+
+        events, fields = self._connect(self.pool.factories[0])
+        self.assertNotEqual(fields['events'], 'off')
+        actions, fields = self._connect(self.pool.factories[1])
+        self.assertEqual(fields['events'], 'off')
+        self.assertEqual(self.pool.protocols, [events, actions])
+        assert self.pool.eventProtocol is events
+        return events, actions
+
+
+    def test_sendAction(self):
+        """Actions go to the connection with the fewest pending"""
+
+        events, actions = self._connectAll()
+        first = self.pool.sendAction('Ping', {})
+        second = self.pool.sendAction('Ping', {})
+        self.assertEqual(events.actionsInFlight(), 1)
+        self.assertEqual(actions.actionsInFlight(), 1)
+
+        respondToAction(self, actions, actions.transport, 'Ping',
+            'Response: Success\r\n'
+            'ActionID: %(actionid)s\r\n'
+            '\r\n'
+        )
+        self.assertEqual(self.successResultOf(second), ({}, None))
+        self.pool.sendAction('Ping', {})
+        self.assertEqual(actions.actionsInFlight(), 1)
+        self.assertEqual(events.actionsInFlight(), 1)
+        self.assertNoResult(first)
+
+
+    def test_originateCEP(self):
+        """Originations sent elsewhere complete on the events connection"""
+
+        events, actions = self._connectAll()
+        self.pool.sendAction('Ping', {})
+        d = self.pool.originateCEP('SIP/200', 'default', '100', 1)
+        fields = respondToAction(self, actions, actions.transport, 'Originate',
+            'Response: Success\r\n'
+            'ActionID: %(actionid)s\r\n'
+            'Message: Originate successfully queued\r\n'
+            '\r\n'
+        )
+        self.assertEqual(fields['channel'], 'SIP/200')
+        self.assertNoResult(d)
+
+        events.dataReceived(
+            'Event: OriginateResponse\r\n'
+            'ActionID: ' + fields['actionid'] + '\r\n'
+            'Response: Failure\r\n'
+            'Reason: 0\r\n'
+            '\r\n'
+        )
+        self.failureResultOf(d, OriginateException)
+        self.assertEqual(events.pendingOrigs, {})
+
+
+    def test_unavailable(self):
+        """Lost connections leave the pool"""
+
+        events, actions = self._connectAll()
+        reason = Failure(ConnectionDone())
+        for factory in self.pool.factories:
+            factory.currentProtocol.connectionLost(reason)
+            factory.clientConnectionLost(Mock(), reason)
+        self.assertEqual(self.pool.protocols, [])
+        self.assertIdentical(self.pool.eventProtocol, None)
+        self.failureResultOf(self.pool.sendAction('Ping', {}),
+                             PoolUnavailableException)
+        self.failureResultOf(
+            self.pool.originateCEP('SIP/200', 'default', '100', 1),
+            PoolUnavailableException)
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,285 @@
+# Copyright (c) 2013, 2014 Matt Behrens <matt@zigg.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+from hashlib import md5
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+
+from octothorpe.proxy import AMIProxy
+from octothorpe.test.test_base import connectAndLogIn, disassembleMessage
+from octothorpe.test.test_base import respondToAction, useClock
+
+
+"""Tests for octothorpe.proxy"""
+
+
+class AMIProxyTestCase(unittest.TestCase):
+    """Test case for the AMI proxy"""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.proxy = AMIProxy('username', 'secret',
+                              users={'app': 'password'})
+        useClock(self.proxy.clientFactory, self.clock)
+
+
+    def _connectUpstream(self):
+        """Helper to connect the upstream session and log it in"""
+
+        protocol, self.upstreamTransport, fields = connectAndLogIn(
+            self, self.proxy.clientFactory)
+        self.assertEqual(fields['events'], 'on')
+        assert self.proxy.upstream is protocol
+        return protocol
+
+
+    def _respondUpstream(self, action, response):
+        """Helper to check the action sent upstream and respond to it"""
+
+        return respondToAction(self, self.proxy.upstream,
+                               self.upstreamTransport, action, response)
+
+
+    def _connectClient(self, **fields):
+        """Helper to connect a client and log it in"""
+
+        client = self.proxy.serverFactory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        client.makeConnection(transport)
+        self.assertEqual(transport.value(), self.proxy.banner + '\r\n')
+        transport.clear()
+        fields.update({'ActionID': 'login', 'Username': 'app',
+                       'Secret': 'password'})
+        self._send(client, 'Login', **fields)
+        self.assertEqual(self._received(client), {
+            'response': 'Success',
+            'actionid': 'login',
+            'message': 'Authentication accepted',
+        })
+        return client
+
+
+    def _send(self, client, action, **fields):
+        """Helper to send an action from a client"""
+
+        client.dataReceived('Action: ' + action + '\r\n' + ''.join([
+            key + ': ' + value + '\r\n' for key, value in fields.iteritems()
+        ]) + '\r\n')
+
+
+    def _received(self, client):
+        """Helper to return the message a client was sent"""
+
+        data = client.transport.value()
+        client.transport.clear()
+        return disassembleMessage(data)
+
+
+    def test_login(self):
+        """Clients must log in with known credentials"""
+
+        self._connectUpstream()
+        client = self.proxy.serverFactory.buildProtocol(None)
+        client.makeConnection(proto_helpers.StringTransport())
+        client.transport.clear()
+
+        self._send(client, 'Ping', ActionID='1')
+        self.assertEqual(self._received(client)['message'],
+                         'Permission denied')
+        self._send(client, 'Login', ActionID='2', Username='app',
+                   Secret='wrong')
+        self.assertEqual(self._received(client)['response'], 'Error')
+
+        self._send(client, 'Challenge', ActionID='3', AuthType='MD5')
+        challenge = self._received(client)['challenge']
+        self._send(client, 'Login', ActionID='4', AuthType='MD5',
+                   Username='app',
+                   Key=md5(challenge + 'password').hexdigest())
+        self.assertEqual(self._received(client)['response'], 'Success')
+        assert client in self.proxy.clients
+
+
+    def test_forwardAction(self):
+        """Actions are forwarded under our own ActionIDs"""
+
+        self._connectUpstream()
+        first = self._connectClient()
+        second = self._connectClient()
+        self._send(first, 'Getvar', ActionID='1', Variable='foo')
+        firstFields = disassembleMessage(self.upstreamTransport.value())
+        self.upstreamTransport.clear()
+        self._send(second, 'Getvar', ActionID='1', Variable='bar')
+
+        fields = disassembleMessage(self.upstreamTransport.value())
+        self.assertEqual(fields['variable'], 'bar')
+        self.assertNotEqual(fields['actionid'], '1')
+        self.proxy.upstream.dataReceived(
+            'Response: Error\r\n'
+            'ActionID: ' + fields['actionid'] + '\r\n'
+            'Message: No such variable\r\n'
+            '\r\n'
+        )
+        self.assertEqual(self._received(second), {
+            'response': 'Error',
+            'actionid': '1',
+            'message': 'No such variable',
+        })
+        self.assertEqual(first.transport.value(), '')
+
+        self.assertEqual(firstFields['variable'], 'foo')
+        self.proxy.upstream.dataReceived(
+            'Response: Success\r\n'
+            'ActionID: ' + firstFields['actionid'] + '\r\n'
+            'Variable: foo\r\n'
+            'Value: 42\r\n'
+            '\r\n'
+        )
+        self.assertEqual(self._received(first), {
+            'response': 'Success',
+            'actionid': '1',
+            'variable': 'foo',
+            'value': '42',
+        })
+        self.assertEqual(self.proxy.routes, {})
+
+
+    def test_forwardEventList(self):
+        """EventList items go back to the client that asked"""
+
+        self._connectUpstream()
+        first = self._connectClient()
+        second = self._connectClient()
+        self._send(first, 'CoreShowChannels', ActionID='list')
+        self._respondUpstream('CoreShowChannels',
+            'Response: Success\r\n'
+            'ActionID: %(actionid)s\r\n'
+            'EventList: start\r\n'
+            '\r\n'
+            'Event: CoreShowChannel\r\n'
+            'ActionID: %(actionid)s\r\n'
+            'Channel: SIP/200-0\r\n'
+            '\r\n'
+            'Event: CoreShowChannelsComplete\r\n'
+            'ActionID: %(actionid)s\r\n'
+            'EventList: Complete\r\n'
+            '\r\n'
+        )
+        messages = [disassembleMessage(data + '\r\n\r\n') for data in
+                    first.transport.value().split('\r\n\r\n')[:-1]]
+        self.assertEqual([message['actionid'] for message in messages],
+                         ['list'] * 3)
+        self.assertEqual(messages[1]['channel'], 'SIP/200-0')
+        self.assertEqual(second.transport.value(), '')
+        self.assertEqual(self.proxy.routes, {})
+
+
+    def test_forwardOriginate(self):
+        """Async OriginateResponses go back to the client that asked"""
+
+        upstream = self._connectUpstream()
+        first = self._connectClient()
+        second = self._connectClient()
+        self._send(first, 'Originate', ActionID='mine-1', Async='true',
+                   Channel='SIP/200', Application='Playback')
+        fields = self._respondUpstream('Originate',
+            'Response: Success\r\n'
+            'ActionID: %(actionid)s\r\n'
+            'Message: Originate successfully queued\r\n'
+            '\r\n'
+        )
+        self.assertEqual(self._received(first)['actionid'], 'mine-1')
+        assert fields['actionid'] in self.proxy.routes
+
+        upstream.dataReceived(
+            'Event: OriginateResponse\r\n'
+            'Privilege: call,all\r\n'
+            'ActionID: ' + fields['actionid'] + '\r\n'
+            'Response: Success\r\n'
+            'Channel: SIP/200-0\r\n'
+            '\r\n'
+        )
+        self.assertEqual(first.transport.value(),
+                         'Event: OriginateResponse\r\n'
+                         'Privilege: call,all\r\n'
+                         'ActionID: mine-1\r\n'
+                         'Response: Success\r\n'
+                         'Channel: SIP/200-0\r\n'
+                         '\r\n')
+        first.transport.clear()
+        self.assertEqual(second.transport.value(), '')
+        self.assertEqual(self.proxy.routes, {})
+        self.assertEqual(self.proxy.pendingOrigs, {})
+
+        self._send(first, 'Originate', ActionID='mine-2', Async='yes',
+                   Channel='SIP/200', Application='Playback')
+        self._respondUpstream('Originate',
+            'Response: Success\r\n'
+            'ActionID: %(actionid)s\r\n'
+            '\r\n'
+        )
+        self.clock.advance(self.proxy.originateTimeout +
+                           upstream.timeoutResolution)
+        self.assertEqual(self.proxy.routes, {})
+        self.assertEqual(self.proxy.pendingOrigs, {})
+        self.assertEqual(upstream.expiredCounts, {'originate': 1})
+
+
+    def test_fanOut(self):
+        """Events go to the clients whose masks and filters allow them"""
+
+        upstream = self._connectUpstream()
+        everything = self._connectClient()
+        calls = self._connectClient(Events='call')
+        filtered = self._connectClient()
+        self._send(filtered, 'Filter', ActionID='f', Operation='Add',
+                   Filter='!Channel: SIP/.*')
+        self.assertEqual(self._received(filtered)['response'], 'Success')
+        nothing = self._connectClient(Events='off')
+
+        data = (
+            'Event: Newchannel\r\n'
+            'Channel: SIP/200-0\r\n'
+            '\r\n'
+            'Event: PeerStatus\r\n'
+            'Peer: SIP/200\r\n'
+            '\r\n'
+            'Event: SomethingNew\r\n'
+            'CamelCase: Value\r\n'
+            '\r\n'
+        )
+        upstream.dataReceived(data)
+        self.assertEqual(everything.transport.value(), data)
+        self.assertEqual(calls.transport.value(), data.split('Event: P')[0])
+        self.assertEqual(filtered.transport.value(),
+                         data.split('\r\n\r\n', 1)[1])
+        self.assertEqual(nothing.transport.value(), '')
+
+
+    def test_upstreamUnavailable(self):
+        """Actions fail while there is no upstream session"""
+
+        self.proxy.users = None
+        client = self._connectClient()
+        self._send(client, 'Ping', ActionID='1')
+        self.assertEqual(self._received(client), {
+            'response': 'Error',
+            'actionid': '1',
+            'message': 'Upstream not connected',
+        })
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4